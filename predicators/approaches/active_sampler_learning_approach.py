@@ -37,7 +37,7 @@ from predicators.structs import NSRT, Array, GroundAtom, LowLevelTrajectory, \
 # Dataset for sampler learning: includes (s, option, s', label) per param opt.
 _OptionSamplerDataset = List[Tuple[State, _Option, State, Any]]
 _SamplerDataset = Dict[ParameterizedOption, _OptionSamplerDataset]
-_ScoreFn = Callable[[State, Sequence[Object], List[Array]], List[float]]
+_ScoreFn = Callable[[State, Sequence[Object], Sequence[Array]], Array]
 
 
 class ActiveSamplerLearningApproach(OnlineNSRTLearningApproach):
@@ -579,7 +579,7 @@ class _FittedQWrappedSamplerLearner(_WrappedSamplerLearner):
         if ground_nsrt.parent not in self._nsrt_score_fns:  # pragma: no cover
             return 0.0
         score_fn = self._nsrt_score_fns[ground_nsrt.parent]
-        return score_fn(state, ground_nsrt.objects, [option.params])[0]
+        return float(score_fn(state, ground_nsrt.objects, [option.params])[0])
 
     def _sample_options_from_state(self,
                                    state: State,
@@ -773,41 +773,44 @@ def _wrap_object_specific_samplers_with_epsilon(
     return _wrapped_sampler
 
 
-def _vector_score_fn_to_score_fn(vector_fn: Callable[[Array], float],
-                                 nsrt: NSRT) -> _ScoreFn:
-    """Helper for _classifier_to_score_fn() and _regressor_to_score_fn()."""
+def _batch_score_fn_to_score_fn(batch_fn: Callable[[Array], Array],
+                                nsrt: NSRT) -> _ScoreFn:
+    """Helper for _classifier_to_score_fn() and _regressor_to_score_fn().
+
+    batch_fn maps the inputs for all the candidates, as the rows of a
+    two-dimensional array, to their scores.
+    """
 
     def _score_fn(state: State, objects: Sequence[Object],
-                  param_lst: List[Array]) -> List[float]:
-        xs = [
-            utils.construct_active_sampler_input(state, objects, p,
-                                                 nsrt.option)
-            for p in param_lst
-        ]
-        scores = [vector_fn(x) for x in xs]
-        return scores
+                  param_lst: Sequence[Array]) -> Array:
+        X = utils.construct_active_sampler_inputs(state, objects,
+                                                  np.array(param_lst),
+                                                  nsrt.option)
+        return batch_fn(X)
 
     return _score_fn
 
 
 def _classifier_to_score_fn(classifier: BinaryClassifier,
                             nsrt: NSRT) -> _ScoreFn:
-    return _vector_score_fn_to_score_fn(classifier.predict_proba, nsrt)
+    return _batch_score_fn_to_score_fn(classifier.predict_proba_batch, nsrt)
 
 
 def _classifier_ensemble_to_score_fn(classifier: BinaryClassifierEnsemble,
                                      nsrt: NSRT, test_time: bool) -> _ScoreFn:
     if test_time:
-        return _vector_score_fn_to_score_fn(
-            lambda x: np.mean(classifier.predict_member_probas(x), dtype=float
-                              ), nsrt)
+        return _batch_score_fn_to_score_fn(
+            lambda X: np.mean(classifier.predict_member_probas_batch(X),
+                              axis=1), nsrt)
     # If we want the exploration score function, then we need to compute the
     # entropy.
-    return _vector_score_fn_to_score_fn(
-        lambda x: utils.entropy(
-            float(np.mean(classifier.predict_member_probas(x)))), nsrt)
+    return _batch_score_fn_to_score_fn(
+        lambda X: np.array([
+            utils.entropy(float(p)) for p in np.mean(
+                classifier.predict_member_probas_batch(X), axis=1)
+        ]), nsrt)
 
 
 def _regressor_to_score_fn(regressor: MLPRegressor, nsrt: NSRT) -> _ScoreFn:
-    fn = lambda v: regressor.predict(v)[0]
-    return _vector_score_fn_to_score_fn(fn, nsrt)
+    fn = lambda X: regressor.predict_batch(X)[:, 0]
+    return _batch_score_fn_to_score_fn(fn, nsrt)
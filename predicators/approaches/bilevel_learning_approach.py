@@ -12,14 +12,17 @@ import wandb
 import yaml
 import random
 import itertools
+import multiprocessing
 import json
+import hashlib
 import logging
+from dataclasses import dataclass
 from z3 import *
 from tqdm import tqdm
 from gym.spaces import Box
 from tqdm import tqdm
-from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, \
-    Sequence, Set, Tuple, TypeVar
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Iterator, List, \
+    Optional, Sequence, Set, Tuple, TypeVar
 
 import numpy as np
 import dill as pkl
@@ -37,17 +40,21 @@ from predicators import utils
 from predicators.approaches import ApproachFailure
 from predicators.approaches.nsrt_learning_approach import NSRTLearningApproach
 from predicators.gnn.neupi import setup_neupi_mlp_net, setup_neupi_optimizer, HierachicalMCTSearcher
-from predicators.gnn.neupi_utils import train_predicate_model, get_single_neupi_prediction, \
+from predicators.gnn.neupi_utils import train_predicate_model, train_predicate_models_ensemble, \
+    get_single_neupi_prediction, \
     compute_guidance_vector, select_columns, distill_learned_ae_vector, check_learned_ap_vector, \
     gen_pretty_pred_name, two2one, one2two, prob_three2two, inferece_dataloader, name2quantifier_types, \
     parse_basic_pred_name
 from predicators.gnn.gnn_utils import GraphTransC2DDataset, compute_normalizers, action_graph_batch_collate, \
-    normalize_graph
+    normalize_graph, pack_graphs, get_packed_graph, save_packed_graphs, load_packed_graphs, \
+    pack_graph_trans_datasets, get_ensemble_dataloader
 from predicators.planning import PlanningFailure, PlanningTimeout, \
     analyse_with_fast_downward
 from predicators.ground_truth_models import get_dummy_nsrts
 from predicators.nsrt_learning.segmentation import segment_trajectory
 from predicators.nsrt_learning.nsrt_learning_main import learn_nsrts_from_data
+from predicators.nsrt_learning.strips_learning.belief_learner import \
+    BeliefPartition
 from predicators.settings import CFG
 from predicators.predicate_search_score_functions import _OperatorBeliefScoreFunction
 from predicators.structs import Dataset, GroundAtom, GroundAtomTrajectory, LowLevelTrajectoryReward, \
@@ -74,18 +81,11 @@ def train_val_model_in_parallel(curr_pred, ent_idx, pred_save_path, ae_vector, i
                 config=utils.get_important_cfg(CFG, pred_config))
         wandb.run.name = wandb_run_name + "_pred_" + pred_config['name'] + "_init_" + str(n)
 
-    train_dataloader = DataLoader(train_dataset,
-                                    batch_size=pred_config['batch_size'],
-                                    shuffle=True,
-                                    num_workers=0,
-                                    pin_memory=False,
-                                    collate_fn=action_graph_batch_collate)
-    val_dataloader = DataLoader(val_dataset,
-                                batch_size=pred_config['batch_size'],
-                                shuffle=False,
-                                num_workers=0,
-                                pin_memory=False,
-                                collate_fn=action_graph_batch_collate)
+    # the datasets are PackedGraphTransDatasets in shared memory
+    train_dataloader = train_dataset.get_dataloader(pred_config['batch_size'],
+                                                    shuffle=True)
+    val_dataloader = val_dataset.get_dataloader(pred_config['batch_size'],
+                                                shuffle=False)
     model = setup_neupi_mlp_net(train_dataset,
                                 curr_pred.arity,
                                 pred_config['architecture'],
@@ -218,11 +218,179 @@ def train_val_model_single(curr_pred, ent_idx, pred_save_path, ae_vector, iterat
     # Put result in the queue
     return save_path_model, best_val_loss
 
+def _get_successive_halving_selector(curr_pred, ent_idx, ae_vectors, pred_config, ae_row_name_dict, \
+                                     node_feature_to_index, models, val_datasets):
+    """Get a select_models function for train_predicate_models_ensemble().
+
+    pred_config["successive_halving"] has "min_epochs" and "eta", both ints
+    (see predicators/config/blocks_engrave/pred_all.yaml). After
+    min_epochs, min_epochs * eta, min_epochs * eta^2, ... epochs, only the
+    best 1/eta of the models still being trained keep training. Models are
+    ranked by the guidance (as in compute_guidance_vector(), lower is
+    better) of their best checkpoint so far, then by validation loss.
+    """
+    min_epochs = pred_config["successive_halving"]["min_epochs"]
+    eta = pred_config["successive_halving"]["eta"]
+    # The rungs are compared to integer epoch counts, and eta divides the
+    # number of models to keep.
+    if not (isinstance(min_epochs, int) and min_epochs > 0):
+        raise ValueError("successive_halving min_epochs must be a positive "
+                         f"int, got {min_epochs}.")
+    if not (isinstance(eta, int) and eta >= 2):
+        raise ValueError("successive_halving eta must be an int >= 2, got "
+                         f"{eta}.")
+    rungs = set()
+    rung = min_epochs
+    while rung < pred_config["epochs"]:
+        rungs.add(rung)
+        rung *= eta
+
+    def _select_models(num_epochs_done, active, best_weights, best_val_losses):
+        if num_epochs_done not in rungs or len(active) == 1:
+            return active
+        guidances = {}
+        for m in active:
+            model = copy.deepcopy(models[m])
+            if best_weights[m]:
+                model.load_state_dict(best_weights[m])
+            learned_ae_vector = distill_learned_ae_vector(
+                val_datasets[m].get_dataloader(pred_config['batch_size'], shuffle=False), \
+                pred_config['gumbel_temp'], 0.5, model, curr_pred, ent_idx, \
+                ae_row_name_dict, node_feature_to_index, CFG.device)
+            guidances[m] = compute_guidance_vector(
+                                learned_ae_vector,
+                                ae_vectors[m],
+                                min_prob=CFG.neupi_entropy_entry_min,
+                                max_prob=CFG.neupi_entropy_entry_max,
+                                entropy_w=CFG.neupi_entropy_w,
+                                loss_w=CFG.neupi_loss_w).sum().item()
+        num_keep = max(1, -(-len(active) // eta))
+        keep = sorted(active, key=lambda m: (guidances[m], best_val_losses[m]))[:num_keep]
+        logging.info(f"Successive halving after {num_epochs_done} epochs: guidance "
+                     f"{ {m: round(g, 4) for m, g in guidances.items()} }, keep training {sorted(keep)}")
+        return sorted(keep)
+
+    return _select_models
+
+def train_val_models_ensemble(curr_pred, ent_idx, pred_save_path, ae_vectors, iteration, pred_config, \
+                              ae_row_name_dict, node_feature_to_index, edge_feature_to_index, \
+                              train_datasets, val_datasets):
+    # The datasets are PackedGraphTransDatasets that differ only in their
+    # targets, so all the models are trained on one pass over the data.
+    logging.info(f"Predicat {curr_pred.arity} Iteration {iteration} | Training {len(ae_vectors)} models together")
+    train_dataloader = get_ensemble_dataloader(train_datasets, pred_config['batch_size'], shuffle=True)
+    val_dataloader = get_ensemble_dataloader(val_datasets, pred_config['batch_size'], shuffle=False)
+    models = []
+    optimizers = []
+    schedulers = []
+    for _ in ae_vectors:
+        model = setup_neupi_mlp_net(train_datasets[0],
+                                    curr_pred.arity,
+                                    pred_config['architecture'],
+                                    node_feat2inx=node_feature_to_index,
+                                    edge_feat2inx=edge_feature_to_index)
+        optimizer, scheduler = setup_neupi_optimizer(model, \
+                                                     pred_config['optimizer'], \
+                                                     pred_config['lr_scheduler'])
+        models.append(model)
+        optimizers.append(optimizer)
+        schedulers.append(scheduler)
+    if "quick_skip" not in pred_config:
+        pred_config["quick_skip"] = None
+    select_models = None
+    if pred_config.get("successive_halving"):
+        select_models = _get_successive_halving_selector(
+            curr_pred, ent_idx, ae_vectors, pred_config, ae_row_name_dict, \
+            node_feature_to_index, models, val_datasets)
+    results = train_predicate_models_ensemble(
+        iteration,
+        models,
+        train_dataloader,
+        val_dataloader,
+        optimizers=optimizers,
+        super_label=CFG.neupi_super_label,
+        num_epochs=pred_config["epochs"],
+        val_freq=pred_config['val_freq'],
+        device=CFG.device,
+        schedulers=schedulers,
+        quick_skip=pred_config["quick_skip"],
+        select_models=select_models
+    )
+    model_paths_loss = []
+    for n, (ae_vector, model, (best_model_dict, best_val_loss)) in \
+            enumerate(zip(ae_vectors, models, results)):
+        logging.info("Model {} Trained".format(n))
+        logging.info("Corresponding AE Vector: {}".format(ae_vector[:, 0]))
+        if ae_vector.shape[-1] == 2:
+            logging.info("Corresponding AE Vector (Del): {}".format(ae_vector[:, 1]))
+        model.load_state_dict(best_model_dict)
+        # for basic predicates, always using 0.5 as decision boundary
+        learned_ae_vector = distill_learned_ae_vector(
+                val_datasets[n].get_dataloader(pred_config['batch_size'], shuffle=False), \
+                pred_config['gumbel_temp'], 0.5, model, curr_pred, ent_idx, \
+                ae_row_name_dict, node_feature_to_index, CFG.device)
+        learned_guidance = compute_guidance_vector(
+                                            learned_ae_vector,
+                                            ae_vector,
+                                            min_prob=CFG.neupi_entropy_entry_min,
+                                            max_prob=CFG.neupi_entropy_entry_max,
+                                            entropy_w=CFG.neupi_entropy_w,
+                                            loss_w=CFG.neupi_loss_w)
+        logging.info("Model {}".format(n))
+        logging.info("Learned AE Guidance (Lower better): {}".format(learned_guidance))
+        save_path_model = os.path.join(pred_save_path, f"iter_{iteration}_{n}_model.pth")
+        torch.save(best_model_dict, save_path_model)
+        save_path_guidance = os.path.join(pred_save_path, f"iter_{iteration}_{n}_guidance.pth")
+        torch.save(learned_guidance, save_path_guidance)
+        save_path_ae_vector = os.path.join(pred_save_path, f"iter_{iteration}_{n}_ae_vector.pth")
+        torch.save(ae_vector, save_path_ae_vector)
+        model_paths_loss.append((save_path_model, best_val_loss))
+    return model_paths_loss
+
+# Set by BilevelLearningApproach._score_predicate_sets() right before forking
+# the workers: the score function and the (matrix, predicates, ent idx) of
+# each candidate predicate set.
+_PREDICATE_SET_SCORING_CONTEXT: Optional[Tuple[
+    _OperatorBeliefScoreFunction, List[Tuple[torch.Tensor, List[Predicate],
+                                             List[List[int]]]]]] = None
+
+
+def _score_predicate_set_in_worker(
+        candidate_idx: int) -> Tuple[float, Optional[BeliefPartition]]:
+    """Score one candidate of the forked _PREDICATE_SET_SCORING_CONTEXT.
+
+    Only the index is sent, since predicates hold classifiers that may
+    not be picklable. The partition of the candidate is sent back, so
+    that the next search level can start from it.
+    """
+    assert _PREDICATE_SET_SCORING_CONTEXT is not None
+    score_function, candidates = _PREDICATE_SET_SCORING_CONTEXT
+    try_matrix, try_predicates, try_pred_ent_idx = candidates[candidate_idx]
+    score = score_function.evaluate(try_matrix, try_predicates,
+                                    try_pred_ent_idx, CFG.strips_learner)
+    return score, score_function.get_belief_partition(
+        try_matrix, try_predicates, try_pred_ent_idx)
+
 ################################################################################
 #                                 Approach                                     #
 ################################################################################
 
 
+@dataclass(frozen=True)
+class _GraphifyTypePlan:
+    """Where the features of one object type go in the graph node features.
+
+    Scalar features are gathered with scalar_src from the object's feature
+    vector and scattered to scalar_dst. Point cloud / normal features are
+    flattened and scattered to the columns in array_dst.
+    """
+    type_col: int
+    scalar_src: np.ndarray
+    scalar_dst: np.ndarray
+    array_src: Tuple[int, ...]
+    array_dst: Tuple[np.ndarray, ...]
+
+
 class BilevelLearningApproach(NSRTLearningApproach):
     """An approach that invents predicates by learn a GNN that maps continous Graph 
     to discrete space. Using Action Effect Theorem. """
@@ -367,6 +535,25 @@ class BilevelLearningApproach(NSRTLearningApproach):
         self._edge_feature_to_index: Dict[Any, int] = {}
         self._edge_is_rot: List[bool] = [] # Track rot feat, they should not be normalized
         self._input_normalizers = None
+        # Precomputed layout for _graphify_single_input(), see
+        # _compile_graphify_plan().
+        self._graphify_type_plans: Dict[Type, _GraphifyTypePlan] = {}
+        self._graphify_qw_cols = np.zeros(0, dtype=np.int64)
+        self._graphify_ent1_cols = np.zeros(0, dtype=np.int64)
+        self._graphify_ent2_cols = np.zeros(0, dtype=np.int64)
+        # (data, packed graphs) last loaded from CFG.neupi_graph_cache_dir,
+        # see _load_or_build_graph_cache().
+        self._graph_cache: Optional[Tuple[List, Dict[str, np.ndarray]]] = None
+        # Per-state cache of graphified inputs and model outputs, shared by
+        # all neural predicate classifiers (see _get_neupi_prediction()).
+        self._neupi_cache_key: Optional[Hashable] = None
+        self._neupi_cache_input: Optional[Tuple[Dict, Dict]] = None
+        self._neupi_cache_outputs: Dict[Tuple[torch.nn.Module, float, float],
+                                        Dict] = {}
+        # Persistent z3 solver of each predicate for AE vector sampling, with
+        # its variables, the constraints list it was built from, and how many
+        # of those constraints are asserted (see _get_ae_sat_session()).
+        self._ae_sat_sessions: Dict[Predicate, Tuple[Solver, List, List, int]] = {}
 
         self._learned_predicates: Set[NeuralPredicate] = set()
 
@@ -713,6 +900,16 @@ class BilevelLearningApproach(NSRTLearningApproach):
         model_weight_paths = []
         train_datasets = []
         val_datasets = []
+        # Successive halving schedules the candidates jointly, so it needs
+        # them to be trained as one ensemble.
+        ensemble_training = (CFG.neupi_ensemble_training or \
+                             bool(pred_config.get("successive_halving"))) \
+                            and len(curr_ae_vectors) > 1
+        if ensemble_training:
+            # Every vector gets the same train / val split and order (both
+            # are shuffled in gen_graph_data), so that the models can be
+            # trained on one shared pass over the data.
+            split_random_state = (random.getstate(), np.random.get_state())
 
         for n, sat_vector in enumerate(curr_ae_vectors):
             logging.info(f"*******Vec {n} ({curr_pred.name})*******")
@@ -724,13 +921,29 @@ class BilevelLearningApproach(NSRTLearningApproach):
             # random_score = torch.randn(len(self.ae_row_names)).clamp(0.1, 0.4)
             # scores.append(random_score)
             # ae_vecs.append(sat_vector.clone())
+            if ensemble_training:
+                random.setstate(split_random_state[0])
+                np.random.set_state(split_random_state[1])
             train_dataset, val_dataset = self.gen_graph_data(data, 
                                                         curr_pred, 
                                                         ent_idx,
                                                         sat_vector)
             train_datasets.append(train_dataset)
             val_datasets.append(val_dataset)
-        if len(curr_ae_vectors) == 1 or (not CFG.neupi_parallel_invention):
+        if ensemble_training:
+            train_datasets = pack_graph_trans_datasets(train_datasets)
+            val_datasets = pack_graph_trans_datasets(val_datasets)
+            model_paths_loss = train_val_models_ensemble(curr_pred, ent_idx, pred_save_path, \
+                                sat_vectors, iteration, pred_config, self.ae_row_names_dict, \
+                                self._node_feature_to_index, self._edge_feature_to_index, \
+                                train_datasets, val_datasets)
+            for i, (model_path, val_loss) in enumerate(model_paths_loss):
+                model_weight_paths.append(model_path)
+                val_losses.append(val_loss)
+                ae_vecs.append(sat_vectors[i])
+                score = torch.load(model_path.replace("model", "guidance"))
+                scores.append(score)
+        elif len(curr_ae_vectors) == 1 or (not CFG.neupi_parallel_invention):
             for i in range(len(sat_vectors)):
                 logging.info(f"Training Neural Model {i}...")
                 model_path, val_loss = train_val_model_single(curr_pred, ent_idx, pred_save_path, \
@@ -746,6 +959,10 @@ class BilevelLearningApproach(NSRTLearningApproach):
             if CFG.neupi_parallel_invention:
                 processes = []
                 queue = Queue()
+                # the inputs are the same for all the vectors, so pack them
+                # into shared memory once instead of copying them per process
+                train_datasets = pack_graph_trans_datasets(train_datasets)
+                val_datasets = pack_graph_trans_datasets(val_datasets)
                 for i in range(len(sat_vectors)):
                     p = Process(target=train_val_model_in_parallel, args=(
                         curr_pred,
@@ -785,53 +1002,45 @@ class BilevelLearningApproach(NSRTLearningApproach):
         """
         Generate the action effect matrix guided by entropy.
         """
-        constraints = self.learned_ae_pred_info[pred]['constraints']
         # it is already clamped, do not normalize with max
         # n_row x (n_channel + 1)
         width = 1
         height = len(self.ae_row_names)
         channels = CFG.neupi_ae_matrix_channel
         max_num = min(max_num, CFG.neupi_max_neural_nets)
+        solver, local_entities = self._get_ae_sat_session(pred, height, channels)
         sat_vectors = []
+        # Clauses blocking the vectors found in this call are only kept
+        # until the end of the call.
+        solver.push()
         for i in range(max_samples):
             if len(sat_vectors) >= max_num:
                 break
             logging.info(f"Sampling {i}/{max_samples} AE Vectors (Tgt {max_num})")
             # check if the sampled matrix is satisfying all constraints
-            solver = Solver()
-            local_entities = [Bool(f'x_{row}_{col}_{channel}') for row in range(height) \
-                          for col in range(width) for channel in range(channels)]
-            
-            solver = self.add_general_col_constraints(solver, local_entities, width, height, channels)
-            constraints = self.learned_ae_pred_info[pred]['constraints']
-            for rule in constraints:
-                c_type = rule[0]
-                if c_type == 'position':
-                    row, col, channel, value = rule[1], rule[2], rule[3], rule[4]
-                    assert col == 0, "Should be 0 for a vector"
-                    solver.add(local_entities[row * width * channels + col * channels + channel] == value)
-                else:
-                    raise ValueError('Unknown constraint type')
-            
+            assumptions = []
+            assumption_rows = {}
             if searcher is not None:
                 symbolic_proposal = searcher.propose()
                 if symbolic_proposal is None:
-                    return sat_vectors
+                    break
                 vector_sampled = one2two(symbolic_proposal, channels)
                 ae_vec_flipped = vector_sampled.clone()
-                    
-                # add all the entry in flipped matrix
+
+                # assume all the entry in flipped matrix
                 for row in range(height):
                     for channel in range(channels):
+                        entity = local_entities[row * width * channels + 0 * channels + channel]
                         if ae_vec_flipped[row, channel] == 1:
-                            solver.add(local_entities[row * width * channels + 0 * channels + channel] == True)
+                            assumptions.append(entity)
                         elif ae_vec_flipped[row, channel] == 0:
-                            solver.add(local_entities[row * width * channels + 0 * channels + channel] == False)
+                            assumptions.append(Not(entity))
                         else:
                             raise ValueError("Should be 0 or 1, got {}".format(ae_vec_flipped[row, channel]))
-            
+                        assumption_rows[assumptions[-1].get_id()] = row
+
             # sat?
-            if solver.check() == sat:
+            if solver.check(*assumptions) == sat:
                 logging.info(f"Found a satisfying AE Vector with Guidance after {i} tries.")
                 model = solver.model()
                 matrix = torch.zeros((height, width, channels), dtype=int)
@@ -841,15 +1050,56 @@ class BilevelLearningApproach(NSRTLearningApproach):
                             if is_true(model.evaluate(local_entities[row * width * channels + col * channels + channel])):
                                 matrix[row, col, channel] = 1
                 sat_vectors.append(matrix[:, 0])
+                # the next model should be a different vector
+                solver.add(Or([entity != model.evaluate(entity, model_completion=True) \
+                               for entity in local_entities]))
             else:
                 assert searcher is not None, "No satisfying vector found."
                 state = symbolic_proposal.copy()
                 guidance = np.array([np.inf for _ in range(len(self.ae_row_names))])
                 # unsatisfiable node, update searcher
                 searcher.update_value(state, guidance)
+                # The rows in the unsat core are already conflicting. If they
+                # all have effects, so do they in every descendant of this
+                # node, which can then all be pruned.
+                core_rows = sorted({assumption_rows[lit.get_id()] for lit in solver.unsat_core()})
+                if core_rows and (state[core_rows] != 0).all():
+                    searcher.prune(core_rows, state[core_rows])
                 logging.info(f"Vector not satisfiable.")
+        solver.pop()
 
         return sat_vectors
+
+    def _get_ae_sat_session(self, pred: DummyPredicate, height: int,
+                            channels: int) -> Tuple[Solver, List]:
+        """Helper for gen_sat_vec(); get the persistent solver of pred and its
+        variables, with the general column constraints and all the position
+        constraints of pred asserted.
+
+        Constraints added to pred since the last call are asserted now.
+        """
+        width = 1
+        constraints = self.learned_ae_pred_info[pred]['constraints']
+        session = self._ae_sat_sessions.get(pred)
+        if session is None or session[2] is not constraints or \
+                len(session[1]) != height * width * channels or \
+                session[3] > len(constraints):
+            solver = Solver()
+            local_entities = [Bool(f'x_{row}_{col}_{channel}') for row in range(height) \
+                          for col in range(width) for channel in range(channels)]
+            solver = self.add_general_col_constraints(solver, local_entities, width, height, channels)
+            session = (solver, local_entities, constraints, 0)
+        solver, local_entities, _, num_asserted = session
+        for rule in constraints[num_asserted:]:
+            c_type = rule[0]
+            if c_type == 'position':
+                row, col, channel, value = rule[1], rule[2], rule[3], rule[4]
+                assert col == 0, "Should be 0 for a vector"
+                solver.add(local_entities[row * width * channels + col * channels + channel] == value)
+            else:
+                raise ValueError('Unknown constraint type')
+        self._ae_sat_sessions[pred] = (solver, local_entities, constraints, len(constraints))
+        return solver, local_entities
             
     def _setup_input_fields(
         self, data: List[Tuple[State, Set[GroundAtom], State, Set[GroundAtom], \
@@ -919,6 +1169,64 @@ class BilevelLearningApproach(NSRTLearningApproach):
                 self._edge_is_rot.append(False)
             index += 1
 
+        self._compile_graphify_plan(
+            sorted({obj.type for state, _, _, _, _, _ in data for obj in state}))
+
+    def _compile_graphify_plan(self, types: Sequence[Type] = ()) -> None:
+        """Precompute the index arrays used by _graphify_single_input().
+
+        Must be called whenever the node/edge feature indices change.
+        Plans for types not given here are compiled on first use.
+        """
+        self._graphify_qw_cols = np.array([
+            feat_index
+            for feat_name, feat_index in self._node_feature_to_index.items()
+            if "_qw" in feat_name
+        ], dtype=np.int64)
+        node_cols = np.array(list(self._node_feature_to_index.values()),
+                             dtype=np.int64)
+        self._graphify_ent1_cols = np.zeros(len(node_cols), dtype=np.int64)
+        self._graphify_ent2_cols = np.zeros(len(node_cols), dtype=np.int64)
+        for feat, feat_index in self._node_feature_to_index.items():
+            self._graphify_ent1_cols[feat_index] = \
+                self._edge_feature_to_index[f"ent1-{feat}"]
+            self._graphify_ent2_cols[feat_index] = \
+                self._edge_feature_to_index[f"ent2-{feat}"]
+        self._graphify_type_plans = {}
+        for obj_type in types:
+            self._get_graphify_type_plan(obj_type)
+
+    def _get_graphify_type_plan(self, obj_type: Type) -> _GraphifyTypePlan:
+        """Helper for _graphify_single_input(); compile the plan of a type
+        on first use."""
+        if obj_type in self._graphify_type_plans:
+            return self._graphify_type_plans[obj_type]
+        excluded: Sequence[str] = []
+        if CFG.exclude_domain_feat is not None:
+            excluded = CFG.exclude_domain_feat.get(obj_type.name, [])
+        scalar_src, scalar_dst = [], []
+        array_src, array_dst = [], []
+        for src, feat in enumerate(obj_type.feature_names):
+            if feat in excluded:
+                continue
+            if ('pcd' in feat) or ('norm' in feat):
+                array_src.append(src)
+                array_dst.append(np.array([
+                    self._node_feature_to_index[f"feat_{feat}_{i}"]
+                    for i in range(CFG.blocks_engrave_num_points * 3)
+                ], dtype=np.int64))
+            else:
+                scalar_src.append(src)
+                scalar_dst.append(self._node_feature_to_index[f"feat_{feat}"])
+        plan = _GraphifyTypePlan(
+            type_col=self._node_feature_to_index[f"type_{obj_type.name}"],
+            scalar_src=np.array(scalar_src, dtype=np.int64),
+            scalar_dst=np.array(scalar_dst, dtype=np.int64),
+            array_src=tuple(array_src),
+            array_dst=tuple(array_dst))
+        self._graphify_type_plans[obj_type] = plan
+        return plan
+
     def _generate_data_from_dataset(
         self, dataset: Dataset
     ) -> Tuple[List[Tuple[State, Set[GroundAtom], State, Set[GroundAtom], _Option, str]], List]:
@@ -954,49 +1262,6 @@ class BilevelLearningApproach(NSRTLearningApproach):
         self.max_action_arity = max_action_arity
         return data, dataset.trajectories[:num_trajs], ground_atom_dataset
 
-    # Optimized vectorized version
-    def add_edge_features_fast(self, 
-                               node_features, 
-                               object_to_node, 
-                               node_feature_to_index, 
-                               edge_feature_to_index):
-        num_objects = len(object_to_node)
-        num_edge_features = max(len(edge_feature_to_index), 1)
-        
-        # Create mapping arrays for node indices
-        node_indices = np.array([object_to_node[obj] for obj in object_to_node])
-        
-        # Create mapping arrays for feature indices
-        ent1_feature_mapping = np.array([
-            (edge_feature_to_index[f"ent1-{feat}"], node_feature_to_index[feat])
-            for feat in node_feature_to_index
-        ])
-        ent2_feature_mapping = np.array([
-            (edge_feature_to_index[f"ent2-{feat}"], node_feature_to_index[feat])
-            for feat in node_feature_to_index
-        ])
-        
-        # Initialize edge features array
-        all_edge_features = np.zeros((num_objects, num_objects, num_edge_features))
-        
-        # Create mask for valid edges (excluding self-loops)
-        mask = ~np.eye(num_objects, dtype=bool)
-        
-        # Compute entity 1 features
-        for edge_feat_idx, node_feat_idx in ent1_feature_mapping:
-            # Broadcasting node features to all edges
-            all_edge_features[..., edge_feat_idx] = node_features[:, node_feat_idx:node_feat_idx+1]
-        
-        # Compute entity 2 features
-        for edge_feat_idx, node_feat_idx in ent2_feature_mapping:
-            # Broadcasting node features to all edges
-            all_edge_features[..., edge_feat_idx] = node_features[:, node_feat_idx:node_feat_idx+1].T
-        
-        # Zero out self-loops
-        all_edge_features[~mask] = 0
-        
-        return all_edge_features
-
     def _graphify_single_input(self, state: State) -> Tuple[Dict, Dict]:
         all_objects = list(state)
         node_to_object = dict(enumerate(all_objects))
@@ -1010,41 +1275,25 @@ class BilevelLearningApproach(NSRTLearningApproach):
         # Add nodes (one per object) and node features.
         graph["n_node"] = np.array(num_objects)
         node_features = np.zeros((num_objects, num_node_features))
-        for feat_name, feat_index in self._node_feature_to_index.items():
-            if "_qw" in feat_name:
-                # rot initialize to qw=1
-                node_features[:, feat_index] = 1
-
-        ## Add node features for obj types.
-        for obj in state:
-            obj_index = object_to_node[obj]
-            type_index = self._node_feature_to_index[f"type_{obj.type.name}"]
-            node_features[obj_index, type_index] = 1
-
-        ## Add node features for state.
-        for obj in state:
-            obj_index = object_to_node[obj]
-            obj_type = obj.type.name
-            for feat in obj.type.feature_names:
-                if CFG.exclude_domain_feat is not None:
-                    if obj_type in CFG.exclude_domain_feat.keys():
-                        if feat in CFG.exclude_domain_feat[obj_type]:
-                            continue
-                if 'pcd' in feat:
-                    # pcd features
-                    pcd = state[obj][obj.type.feature_names.index(feat)]
-                    pcd = np.reshape(pcd, (-1, ))
-                    for i, p in enumerate(pcd):
-                        node_features[obj_index, self._node_feature_to_index[f"feat_{feat}_{i}"]] = p
-                elif 'norm' in feat:
-                    # pcd features
-                    norm = state[obj][obj.type.feature_names.index(feat)]
-                    norm = np.reshape(norm, (-1, ))
-                    for i, n in enumerate(norm):
-                        node_features[obj_index, self._node_feature_to_index[f"feat_{feat}_{i}"]] = n
-                else:
-                    feat_index = self._node_feature_to_index[f"feat_{feat}"]
-                    node_features[obj_index, feat_index] = state[obj][obj.type.feature_names.index(feat)]
+        # rot initialize to qw=1
+        node_features[:, self._graphify_qw_cols] = 1
+
+        ## Add node features for obj types and state, one scatter per type.
+        objs_by_type: Dict[Type, List[int]] = {}
+        for obj_index, obj in enumerate(all_objects):
+            objs_by_type.setdefault(obj.type, []).append(obj_index)
+        for obj_type, obj_indices in objs_by_type.items():
+            plan = self._get_graphify_type_plan(obj_type)
+            rows = np.array(obj_indices, dtype=np.int64)
+            node_features[rows, plan.type_col] = 1
+            if len(plan.scalar_src) > 0:
+                feats = np.stack([state[node_to_object[r]] for r in obj_indices])
+                node_features[rows[:, None], plan.scalar_dst] = \
+                    feats[:, plan.scalar_src]
+            for src, dst in zip(plan.array_src, plan.array_dst):
+                for r in obj_indices:
+                    value = np.reshape(state[node_to_object[r]][src], (-1, ))
+                    node_features[r, dst[:len(value)]] = value
 
         graph["nodes"] = node_features
 
@@ -1052,23 +1301,24 @@ class BilevelLearningApproach(NSRTLearningApproach):
         num_edge_features = max(num_edge_features, 1)
 
         # Add edges (one between each pair of objects) and edge features.
-        all_edge_features = self.add_edge_features_fast(
-            node_features, object_to_node, self._node_feature_to_index, self._edge_feature_to_index)
+        # Edge (s, r) is the concat of the features of s and r, no self-loops.
+        all_edge_features = np.zeros(
+            (num_objects, num_objects, num_edge_features))
+        all_edge_features[:, :, self._graphify_ent1_cols] = \
+            node_features[:, None, :]
+        all_edge_features[:, :, self._graphify_ent2_cols] = \
+            node_features[None, :, :]
+        all_edge_features[np.eye(num_objects, dtype=bool)] = 0
 
         # Organize into expected representation.
         # this should be an all-connected graph
-        adjacency_mat = np.any(all_edge_features, axis=2)
-        receivers, senders, edges = [], [], []
-        for sender, receiver in np.argwhere(adjacency_mat):
-            edge = all_edge_features[sender, receiver]
-            senders.append(sender)
-            receivers.append(receiver)
-            edges.append(edge)
+        senders, receivers = np.nonzero(np.any(all_edge_features, axis=2))
+        edges = all_edge_features[senders, receivers]
 
         n_edge = len(edges)
         graph["edges"] = np.reshape(edges, [n_edge, num_edge_features])
-        graph["receivers"] = np.reshape(receivers, [n_edge]).astype(np.int64)
-        graph["senders"] = np.reshape(senders, [n_edge]).astype(np.int64)
+        graph["receivers"] = receivers.astype(np.int64)
+        graph["senders"] = senders.astype(np.int64)
         graph["n_edge"] = np.reshape(n_edge, [1]).astype(np.int64)
 
         # Add global features.
@@ -1295,6 +1545,39 @@ class BilevelLearningApproach(NSRTLearningApproach):
 
         return graph_target, action_info
     
+    def _get_neupi_prediction(self, state: State,
+                              pred_model: torch.nn.Module,
+                              pred_gumbel_temp: float,
+                              boundary: float) -> Tuple[Dict, Dict]:
+        """Get the binary prediction graph of pred_model on state.
+
+        utils.abstract() evaluates every ground atom of every neural
+        predicate on the same state, and predicates of the same group
+        share one model. So the graphified input is computed once per
+        state and each (model, temperature, boundary) is run once on it;
+        all the other queries are lookups. The cache only holds the most
+        recent state and is keyed on the bytes of its features, so states
+        mutated in place between classifier calls are graphified again.
+        """
+        state_key = tuple((obj, np.asarray(state[obj]).tobytes())
+                          for obj in state)
+        if state_key != self._neupi_cache_key:
+            state_graph, obj2node = self._graphify_single_input(state)
+            if CFG.neupi_do_normalization:
+                assert self._input_normalizers is not None, "Should have normalizers"
+                state_graph = normalize_graph(state_graph, self._input_normalizers)
+            self._neupi_cache_key = state_key
+            self._neupi_cache_input = (state_graph, obj2node)
+            self._neupi_cache_outputs = {}
+        assert self._neupi_cache_input is not None
+        state_graph, obj2node = self._neupi_cache_input
+        key = (pred_model, pred_gumbel_temp, boundary)
+        if key not in self._neupi_cache_outputs:
+            self._neupi_cache_outputs[key] = get_single_neupi_prediction(
+                pred_model, state_graph, pred_gumbel_temp, boundary,
+                CFG.device)
+        return self._neupi_cache_outputs[key], obj2node
+
     def generate_classifier(self, pred: DummyPredicate, 
                             pred_model: torch.nn.Module,
                             pred_gumbel_temp: float,
@@ -1303,24 +1586,12 @@ class BilevelLearningApproach(NSRTLearningApproach):
                             quantified_types: List[str],
                             quantified_types_idx: List[int],
                             negated: bool) -> Callable[[State, Sequence[Object]], bool]:
+        # basic predicates always use 0.5 as threshold, quantified predicates
+        # use higher threshold
+        boundary = 0.5 if quantifier is None else pred_decision_b
         def specific_function(state: State, objects: Sequence[Object]) -> bool:
-            # Implement your function logic here
-            state_graph, obj2node = self._graphify_single_input(state)
-            if CFG.neupi_do_normalization:
-                assert self._input_normalizers is not None, "Should have normalizers"
-                state_graph = normalize_graph(state_graph, self._input_normalizers)
-            if quantifier == None:
-                # basic predicates always use 0.5 as threshold
-                pred_binary_graph = get_single_neupi_prediction(pred_model, state_graph, \
-                                                            pred_gumbel_temp, \
-                                                            0.5, \
-                                                            CFG.device)
-            else:
-                # quantified predicates use higher threshold
-                pred_binary_graph = get_single_neupi_prediction(pred_model, state_graph, \
-                                                            pred_gumbel_temp, \
-                                                            pred_decision_b, \
-                                                            CFG.device)
+            pred_binary_graph, obj2node = self._get_neupi_prediction(
+                state, pred_model, pred_gumbel_temp, boundary)
             if pred.arity == 1:
                 assert len(objects) == 1, "Predicate arity should be 1"
                 assert not quantified_types, "Should not have quantified types"                
@@ -1402,8 +1673,20 @@ class BilevelLearningApproach(NSRTLearningApproach):
         if CFG.neupi_cache_input_graph:
             if not hasattr(self, 'cached_input_graph'):
                 self.cached_input_graph = {}
+        packed_graphs = None
+        if CFG.neupi_graph_cache_dir:
+            packed_graphs = self._load_or_build_graph_cache(data)
         for state, atoms, state_, atoms_, action, action_label in tqdm(data):
-            if CFG.neupi_cache_input_graph:
+            if packed_graphs is not None:
+                # s and s' are stored next to each other
+                object_to_node = {obj: i for i, obj in enumerate(state)}
+                object_to_node_ = object_to_node
+                input_graph = get_packed_graph(packed_graphs, 2 * transition_id)
+                input_graph_ = get_packed_graph(packed_graphs, 2 * transition_id + 1)
+                if CFG.neupi_do_normalization:
+                    input_graph = normalize_graph(input_graph, self._input_normalizers)
+                    input_graph_ = normalize_graph(input_graph_, self._input_normalizers)
+            elif CFG.neupi_cache_input_graph:
                 if transition_id in self.cached_input_graph:
                     input_graph, object_to_node, input_graph_, object_to_node_ = \
                     self.cached_input_graph[transition_id]
@@ -1451,6 +1734,62 @@ class BilevelLearningApproach(NSRTLearningApproach):
 
         return train_dataset, val_dataset
 
+    def _get_graph_cache_key(self, data: List[Tuple[State, Set[GroundAtom], State,
+                                                    Set[GroundAtom], _Option, str]]) -> str:
+        """Hash everything that the graphified inputs of data depend on.
+
+        The cached graphs are not normalized, so the normalizers are not
+        part of the key.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps([self._node_feature_to_index,
+                                  self._edge_feature_to_index,
+                                  CFG.exclude_domain_feat],
+                                 sort_keys=True).encode())
+        for state, _, state_, _, _, _ in data:
+            for s in (state, state_):
+                for obj in s:
+                    hasher.update(f"{obj.name}:{obj.type.name}".encode())
+                    feats = s[obj]
+                    if feats.dtype != object:
+                        hasher.update(np.ascontiguousarray(feats, dtype=np.float64).tobytes())
+                        continue
+                    # pcd / norm features are arrays inside object arrays
+                    for f in feats:
+                        hasher.update(np.ascontiguousarray(f, dtype=np.float64).tobytes())
+        return hasher.hexdigest()
+
+    def _load_or_build_graph_cache(self, data: List[Tuple[State, Set[GroundAtom], State,
+                                                        Set[GroundAtom], _Option, str]]) \
+        -> Dict[str, np.ndarray]:
+        """Memory-map the input graphs of data from CFG.neupi_graph_cache_dir,
+        graphifying and saving them on a miss.
+
+        Graph 2i is the graph of the i-th s and graph 2i + 1 of the i-th s'.
+        The graphs are not normalized, so that the normalizers can be
+        computed from them without graphifying data again.
+        """
+        # gen_graph_data() is called for every candidate with the same data
+        if self._graph_cache is not None and self._graph_cache[0] is data:
+            return self._graph_cache[1]
+        key = self._get_graph_cache_key(data)
+        cache_dir = os.path.join(CFG.neupi_graph_cache_dir, key)
+        if os.path.isdir(cache_dir):
+            logging.info(f"Loading Graph Data from {cache_dir}")
+        else:
+            logging.info(f"Graph Data not cached, saving to {cache_dir}")
+            graphs = []
+            for state, _, state_, _, _, _ in tqdm(data):
+                for s in (state, state_):
+                    graph, _ = self._graphify_single_input(s)
+                    graphs.append(graph)
+            os.makedirs(CFG.neupi_graph_cache_dir, exist_ok=True)
+            save_packed_graphs(pack_graphs(graphs), cache_dir)
+        packed_graphs = load_packed_graphs(cache_dir)
+        assert len(packed_graphs["node_offsets"]) == 2 * len(data) + 1
+        self._graph_cache = (data, packed_graphs)
+        return packed_graphs
+
     def learn_neural_predicates(
         self, dataset: Dataset
     ) -> Tuple[List[GroundAtomTrajectory], Dict[Predicate, float]]:
@@ -1475,11 +1814,22 @@ class BilevelLearningApproach(NSRTLearningApproach):
                 else:
                     logging.info(f"Using {CFG.max_normalizer_data} data for normalizer computation")
                     num_data = CFG.max_normalizer_data
-                for state, atoms, state_, atoms_, action, action_label in tqdm(data[:num_data]):
-                    input_graph, object_to_node = self._graphify_single_input(state)
-                    input_graph_, object_to_node_ = self._graphify_single_input(state_)
-                    graph_inputs.append(input_graph)
-                    graph_inputs.append(input_graph_)
+                if CFG.neupi_graph_cache_dir:
+                    # The graphs of s and s' of the first num_data
+                    # transitions, as one graph, read from the cache.
+                    packed_graphs = self._load_or_build_graph_cache(data)
+                    num_graphs = 2 * min(num_data, len(data))
+                    graph_inputs.append({
+                        "nodes": packed_graphs["nodes"][:packed_graphs["node_offsets"][num_graphs]],
+                        "edges": packed_graphs["edges"][:packed_graphs["edge_offsets"][num_graphs]],
+                        "globals": None
+                    })
+                else:
+                    for state, atoms, state_, atoms_, action, action_label in tqdm(data[:num_data]):
+                        input_graph, object_to_node = self._graphify_single_input(state)
+                        input_graph_, object_to_node_ = self._graphify_single_input(state_)
+                        graph_inputs.append(input_graph)
+                        graph_inputs.append(input_graph_)
                 self._input_normalizers = compute_normalizers(graph_inputs, normalize_nodes=self._node_is_rot, \
                                                             normalize_edges=self._edge_is_rot,
                                                             normalize_globals=False)
@@ -1980,6 +2330,15 @@ class BilevelLearningApproach(NSRTLearningApproach):
                 if CFG.neupi_bug:
                     if i not in gt_idex_groups:
                         continue
+                # same group shares the same model, load it once so that the
+                # classifiers of all variants hit the same prediction cache
+                pred_model = setup_neupi_mlp_net(example_dataset,
+                            pred.arity,
+                            pred_config['architecture'],
+                            self._node_feature_to_index,
+                            self._edge_feature_to_index)
+                weights = torch.load(self.learned_ae_pred_info[pred]['model_weights'][i])
+                pred_model.load_state_dict(weights)
                 for m, ae_vec in enumerate(ae_vec_group):
                     if CFG.neupi_bug and (m not in gt_idex_groups[i]):
                         continue
@@ -2010,14 +2369,6 @@ class BilevelLearningApproach(NSRTLearningApproach):
                     logging.info(f"Constructing Neural Predicate: {name}")
                     logging.info(f"Its Effect Vector: {two2one(ae_vec.clone())}")
                     original_types = pred.types
-                    pred_model = setup_neupi_mlp_net(example_dataset,
-                                pred.arity,
-                                pred_config['architecture'],
-                                self._node_feature_to_index,
-                                self._edge_feature_to_index)
-                    # same group shares the same model
-                    weights = torch.load(self.learned_ae_pred_info[pred]['model_weights'][i])
-                    pred_model.load_state_dict(weights)
                     # note that grounding this predicate do not need the operatr ent idx, just ground all
                     specific_function = self.generate_classifier(pred, pred_model, pred_config['gumbel_temp'], \
                                                                  pred_config['decision_b'], \
@@ -2055,6 +2406,8 @@ class BilevelLearningApproach(NSRTLearningApproach):
         ae_col_names = []
         ae_matrix = []
         ae_ent_idx = []
+        # same group shares the same model, keyed by (template, group id)
+        group_models: Dict[Tuple[Predicate, int], torch.nn.Module] = {}
         for pred_temp in info.keys():
             if pred_temp in self._initial_predicates:
                 ae_col_names.append(pred_temp)
@@ -2101,7 +2454,9 @@ class BilevelLearningApproach(NSRTLearningApproach):
                     ae_vec = self.learned_ae_pred_info[pred_temp]['ae_vecs'][i][m]
                     logging.info(f"Its Effect Vector: {ae_vec}")
                     ae_matrix.append(one2two(torch.tensor(ae_vec), 2))
-                if 'example_dataset' in self.learned_ae_pred_info[pred_temp]:
+                if (pred_temp, i) in group_models:
+                    pred_model = group_models[(pred_temp, i)]
+                elif 'example_dataset' in self.learned_ae_pred_info[pred_temp]:
                     example_dataset = self.learned_ae_pred_info[pred_temp]['example_dataset']
                     pred_model = setup_neupi_mlp_net(example_dataset,
                                 pred_temp.arity,
@@ -2116,9 +2471,10 @@ class BilevelLearningApproach(NSRTLearningApproach):
                                 self._node_feature_to_index,
                                 self._edge_feature_to_index,
                                 dims=self.learned_ae_pred_info[pred_temp]['neural_dim'])
-                # same group shares the same model
-                weights = torch.load(self.learned_ae_pred_info[pred_temp]['model_weights'][i])
-                pred_model.load_state_dict(weights)
+                if (pred_temp, i) not in group_models:
+                    weights = torch.load(self.learned_ae_pred_info[pred_temp]['model_weights'][i])
+                    pred_model.load_state_dict(weights)
+                    group_models[(pred_temp, i)] = pred_model
                 # note that grounding this predicate do not need the operatr ent idx, just ground all
                 specific_function = self.generate_classifier(pred_temp, pred_model, pred_config['gumbel_temp'], \
                                                                 pred_config['decision_b'], \
@@ -2150,6 +2506,54 @@ class BilevelLearningApproach(NSRTLearningApproach):
         else:
             return dummy2real
     
+    def _score_predicate_sets(
+            self, score_function: _OperatorBeliefScoreFunction,
+            candidates: List[Tuple[torch.Tensor, List[Predicate], List[List[int]]]]) \
+            -> List[float]:
+        """Score the (matrix, predicates, ent idx) candidates, in parallel
+        with CFG.neupi_pred_search_num_workers forked processes.
+
+        The workers inherit the score function and its atom dataset
+        copy-on-write instead of receiving pickled copies, so the data is
+        segmented before forking.
+        """
+        num_workers = min(CFG.neupi_pred_search_num_workers, len(candidates))
+        # Daemonic processes (e.g., the test workers of main.py) cannot have
+        # children, so score serially in them.
+        if multiprocessing.current_process().daemon:
+            num_workers = 1
+        if num_workers <= 1:
+            scores = []
+            for try_matrix, try_predicates, try_pred_ent_idx in candidates:
+                s = time.time()
+                score = score_function.evaluate(try_matrix, try_predicates, try_pred_ent_idx, CFG.strips_learner)
+                logging.info(f"Predicate set {try_predicates} has score {score} in {time.time()-s} seconds.")
+                scores.append(score)
+            return scores
+        score_function.precompute_segmentation()
+        global _PREDICATE_SET_SCORING_CONTEXT  # pylint: disable=global-statement
+        _PREDICATE_SET_SCORING_CONTEXT = (score_function, candidates)
+        s = time.time()
+        # Fork explicitly, because main.py sets the default start method to
+        # spawn, and spawned workers would not inherit the context.
+        pool = multiprocessing.get_context("fork").Pool(num_workers)
+        try:
+            results = pool.map(_score_predicate_set_in_worker,
+                               range(len(candidates)), chunksize=1)
+        finally:
+            pool.terminate()
+            _PREDICATE_SET_SCORING_CONTEXT = None
+        scores = []
+        for candidate, (score, partition) in zip(candidates, results):
+            if partition is not None:
+                score_function.set_belief_partition(*candidate, partition)
+            scores.append(score)
+        for (_, try_predicates, _), score in zip(candidates, scores):
+            logging.info(f"Predicate set {try_predicates} has score {score}.")
+        logging.info(f"Scored {len(candidates)} predicate sets with {num_workers} "
+                     f"processes in {time.time()-s} seconds.")
+        return scores
+
     def _select_predicates_by_score_search(
             self, huge_ae_matrixe: np.ndarray,
             all_predicates_info: Dict[int, Tuple[Predicate, List[int], bool]],
@@ -2208,6 +2612,9 @@ class BilevelLearningApproach(NSRTLearningApproach):
         if CFG.neupi_bug:
             # just add one by one
             for idx, p_pred in enumerate(possible_predicates):
+                score_function.retain_belief_partition(
+                    last_matrix, final_predicates + provided_prec_predicates,
+                    last_ent_idx)
                 col_idx = possible_cols[idx]
                 final_predicates.append(p_pred)
                 last_ent_idx.append(possible_pred_entidx[idx])
@@ -2226,7 +2633,13 @@ class BilevelLearningApproach(NSRTLearningApproach):
             return set(final_predicates), last_matrix, final_predicates, last_ent_idx
         while go_on:
             logging.info(f"Search Level {level}...")
+            # The candidates of this level extend the incumbent by one
+            # column, so only its belief partition is still useful.
+            score_function.retain_belief_partition(
+                last_matrix, final_predicates + provided_prec_predicates,
+                last_ent_idx)
             add_idx = -1
+            level_candidates = []
             for idx, p_pred in enumerate(possible_predicates):
                 if p_pred in final_predicates:
                     continue
@@ -2245,11 +2658,14 @@ class BilevelLearningApproach(NSRTLearningApproach):
                     try_predicates.append(pred)
                 try_predicates.append(p_pred)
                 searched_predicate_comp.append(set(try_predicates))
-                s = time.time()
                 # also consider the precondition only predicates
                 try_predicates.extend(provided_prec_predicates)
-                score = score_function.evaluate(try_matrix, try_predicates, try_pred_ent_idx, CFG.strips_learner)
-                logging.info(f"Predicate set {try_predicates} has score {score} in {time.time()-s} seconds.")
+                level_candidates.append((idx, try_matrix, try_predicates, try_pred_ent_idx))
+            level_scores = self._score_predicate_sets(
+                score_function, [c[1:] for c in level_candidates])
+            # go through the scores in candidate order, so that ties are
+            # broken the same way whether or not scoring is parallel
+            for (idx, _, _, _), score in zip(level_candidates, level_scores):
                 if score < best_score:
                     # solve at least one more task
                     logging.info(f"New smallest score: {score}")
@@ -2434,6 +2850,7 @@ class BilevelLearningApproach(NSRTLearningApproach):
         self._edge_feature_to_index = content_info['edge_feature_to_index']
         self._node_is_rot = content_info['node_is_rot']
         self._edge_is_rot = content_info['edge_is_rot']
+        self._compile_graphify_plan()
         input_normalizers_list = content_info['input_normalizers']
         self._input_normalizers = {}
         for k, v in input_normalizers_list.items():
@@ -2515,6 +2932,7 @@ class BilevelLearningApproach(NSRTLearningApproach):
         self._edge_feature_to_index = content_info['edge_feature_to_index']
         self._node_is_rot = content_info['node_is_rot']
         self._edge_is_rot = content_info['edge_is_rot']
+        self._compile_graphify_plan()
         self._input_normalizers = content_info['input_normalizers']
         selected_pred = content_info["selected_pred"]
         selected_pred_names2dummy = {pred.name: selected_pred[pred][0][0] for pred in list(selected_pred.keys())}
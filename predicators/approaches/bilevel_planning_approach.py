@@ -166,6 +166,10 @@ class BilevelPlanningApproach(BaseApproach):
             self._metrics[f"total_{metric}"] += metrics[metric]
         self._metrics["total_num_nsrts"] += len(nsrts)
         self._metrics["total_num_preds"] += len(predicates)
+        # Phase timings, if CFG.sesame_profile is on.
+        for metric, value in metrics.items():
+            if metric.startswith("profile_"):
+                self._metrics[f"total_{metric}"] += value
         for metric in [
                 "num_samples",
                 "num_skeletons_optimized",
@@ -16,9 +16,9 @@ from gym.spaces import Box
 from predicators import utils
 from predicators.pretrained_model_interface import OpenAILLM
 from predicators.settings import CFG
-from predicators.structs import Action, DefaultEnvironmentTask, \
-    EnvironmentTask, GroundAtom, Object, Observation, Predicate, State, Task, \
-    Type, Video
+from predicators.structs import Action, ArrayState, \
+    DefaultEnvironmentTask, EnvironmentTask, GroundAtom, Object, Observation, \
+    Predicate, State, Task, Type, Video
 
 
 class BaseEnv(abc.ABC):
@@ -187,6 +187,8 @@ class BaseEnv(abc.ABC):
                 ]
             else:
                 self._train_tasks = self._generate_train_tasks()
+            if CFG.array_backed_states:
+                self._train_tasks = _to_array_backed_tasks(self._train_tasks)
         return self._train_tasks
 
     def get_test_tasks(self) -> List[EnvironmentTask]:
@@ -202,6 +204,8 @@ class BaseEnv(abc.ABC):
                 ]
             else:
                 self._test_tasks = self._generate_test_tasks()
+            if CFG.array_backed_states:
+                self._test_tasks = _to_array_backed_tasks(self._test_tasks)
         return self._test_tasks
 
     @property
@@ -425,3 +429,17 @@ class BaseEnv(abc.ABC):
             for atom in sorted(all_ground_atoms_set)
         }
         return atom_strs
+
+
+def _to_array_backed_tasks(
+        tasks: List[EnvironmentTask]) -> List[EnvironmentTask]:
+    """Helper for get_train_tasks() and get_test_tasks(); convert the
+    initial observations that are plain States into ArrayStates."""
+    new_tasks = []
+    for task in tasks:
+        if type(task.init_obs) is State:  # pylint: disable=unidiomatic-typecheck
+            task = EnvironmentTask(ArrayState.from_state(task.init_obs),
+                                   task.goal_description,
+                                   alt_goal_desc=task.alt_goal_desc)
+        new_tasks.append(task)
+    return new_tasks
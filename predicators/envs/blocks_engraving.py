@@ -12,13 +12,15 @@ to invent the "Holding" BINARY predicate.
 On and Clear are preconditions of the AchieveGoal option.
 """
 
+import hashlib
+import os
 from matplotlib.legend_handler import HandlerPatch
 import matplotlib.patches as mpatches
 from bosdyn.client import math_helpers
 import matplotlib.pyplot as plt
 from matplotlib import patches
 from pathlib import Path
-from typing import Sequence, Set, List, Dict, Tuple, Optional
+from typing import Callable, Sequence, Set, List, Dict, Tuple, Optional
 
 from predicators.envs.blocks_onclear import BlocksOnClearEnv
 import numpy as np
@@ -134,6 +136,83 @@ def create_multi_bump_cube_components_pytorch3d(n=20, bumps=None, cube_size=1.0)
 
     return cube_minus_top_mesh, top_mesh
 
+
+class _PcdTemplateBank:
+    """Canonical block point clouds on a quantized grid of (irr_x, irr_y,
+    sigma), for each of a few exact values of irr_h.
+
+    Heights are not quantized, since the engraving depth is visible in the
+    cloud; the bank only holds the given heights.
+
+    The clouds are stored in a memory-mapped .npy file, together with a
+    mask of the grid cells that have been generated. A cell is generated
+    with gen_fn at the grid point the first time it is needed, so the
+    bank fills up across runs. The file name is a hash of the grid and of
+    the point cloud parameters, so changing any of them starts a new bank.
+    """
+
+    def __init__(self, gen_fn: Callable[[float, float, float, float],
+                                        np.ndarray],
+                 ranges: Sequence[Tuple[float, float]],
+                 grid_shape: Sequence[int], heights: Sequence[float],
+                 num_points: int, block_size: float, save_dir: str) -> None:
+        # Ranges and grid points are for (irr_x, irr_y, sigma).
+        assert len(ranges) == len(grid_shape) == 3
+        assert all(n >= 1 for n in grid_shape)
+        self._gen_fn = gen_fn
+        self._lows = np.array([lo for lo, _ in ranges])
+        self._highs = np.array([hi for _, hi in ranges])
+        self._steps = np.array(grid_shape) - 1
+        self._heights = np.array(heights)
+        grid = tuple(grid_shape[:2]) + (len(heights), grid_shape[2])
+        key = repr(([tuple(r) for r in ranges], tuple(heights), grid,
+                    num_points, block_size))
+        key_hash = hashlib.md5(key.encode()).hexdigest()[:10]
+        os.makedirs(save_dir, exist_ok=True)
+        prefix = os.path.join(save_dir, f"blocks_engrave_pcd_{key_hash}")
+        self._pcds = self._open_memmap(f"{prefix}_templates.npy",
+                                       np.float32, grid + (num_points, 3))
+        self._generated = self._open_memmap(f"{prefix}_generated.npy",
+                                            np.bool_, grid)
+
+    @staticmethod
+    def _open_memmap(filepath: str, dtype: type,
+                     shape: Tuple[int, ...]) -> np.ndarray:
+        mode = "r+" if os.path.exists(filepath) else "w+"
+        return np.lib.format.open_memmap(filepath,
+                                         mode=mode,
+                                         dtype=dtype,
+                                         shape=shape)
+
+    def get(self, irr_x: float, irr_y: float, irr_h: float,
+            sigma: float) -> Optional[np.ndarray]:
+        """The point cloud at the nearest grid point, or None if irr_h is
+        not one of the bank's heights or the other parameters are outside
+        of the grid."""
+        h_matches = np.flatnonzero(np.isclose(self._heights, irr_h))
+        if len(h_matches) == 0:
+            return None
+        params = np.array([irr_x, irr_y, sigma])
+        if np.any(params < self._lows) or np.any(params > self._highs):
+            return None
+        widths = np.maximum(self._highs - self._lows, 1e-12)
+        idx_arr = np.round((params - self._lows) / widths * self._steps)
+        x_idx, y_idx, sigma_idx = idx_arr.astype(int).tolist()
+        idx = (x_idx, y_idx, int(h_matches[0]), sigma_idx)
+        if not self._generated[idx]:
+            grid_x, grid_y, grid_sigma = (
+                self._lows +
+                widths * idx_arr / np.maximum(self._steps, 1)).tolist()
+            self._pcds[idx] = self._gen_fn(grid_x, grid_y,
+                                           float(self._heights[idx[2]]),
+                                           grid_sigma)
+            self._pcds.flush()
+            # The mask is written after the cloud, so that another process
+            # using the same bank never sees a cell as generated too early.
+            self._generated[idx] = True
+            self._generated.flush()
+        return np.array(self._pcds[idx])
+
 # Custom handler for square patches with markers
 class CustomSquareHandler(HandlerPatch):
     def __init__(self, marker=None, marker_position=(0.5, 0.5), **kwargs):
@@ -910,6 +989,26 @@ class BlocksEngravePcdEnv(BlocksEngraveVecEnv):
         ]
         self._num_blocks_train = CFG.blocks_engrave_num_blocks_train
         self._num_blocks_test = CFG.blocks_engrave_num_blocks_test
+        # Engraving heights are engrave_height for the top block and
+        # negated for the bottom block, except for engrave actions with
+        # other heights, whose point clouds are generated exactly.
+        self._pcd_template_bank: Optional[_PcdTemplateBank] = None
+        grid_shape = CFG.blocks_engrave_pcd_template_grid
+        if grid_shape is not None:
+            if isinstance(grid_shape, int):
+                grid_shape = [grid_shape] * 3
+            if len(grid_shape) != 3:
+                raise ValueError("blocks_engrave_pcd_template_grid must be "
+                                 "an int or a list of 3 ints for (irr_x, "
+                                 f"irr_y, sigma), got {grid_shape}.")
+            self._pcd_template_bank = _PcdTemplateBank(
+                self._gen_exact_pcd_for_block,
+                [(self.blo_x_lb, self.blo_x_ub),
+                 (self.blo_y_lb, self.blo_y_ub),
+                 tuple(CFG.blocks_engrave_sigma)], grid_shape,
+                [-self.engrave_height, self.engrave_height],
+                CFG.blocks_engrave_num_points, self._block_size,
+                CFG.data_dir)
 
     @classmethod
     def get_name(cls) -> str:
@@ -938,6 +1037,16 @@ class BlocksEngravePcdEnv(BlocksEngraveVecEnv):
     
     def _gen_pcd_for_block(self, irr_x: float, irr_y: float, irr_h: float,
                            sigma: float) -> np.ndarray:
+        """Use the template bank if there is one and the parameters are on
+        its grid, and otherwise generate the point cloud exactly."""
+        if self._pcd_template_bank is not None:
+            pcd = self._pcd_template_bank.get(irr_x, irr_y, irr_h, sigma)
+            if pcd is not None:
+                return pcd
+        return self._gen_exact_pcd_for_block(irr_x, irr_y, irr_h, sigma)
+
+    def _gen_exact_pcd_for_block(self, irr_x: float, irr_y: float,
+                                 irr_h: float, sigma: float) -> np.ndarray:
         from pytorch3d.ops import sample_points_from_meshes
         bumps = [
         {"A":  irr_h, "x0": irr_x, "y0": irr_y, "sigma": sigma},
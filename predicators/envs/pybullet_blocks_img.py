@@ -243,11 +243,10 @@ class PyBulletBlocksEnv(PyBulletEnv, BlocksEnv):
         super()._reset_state(state)
 
         # Reset blocks based on the state.
+        self._restore_python_state(state)
         block_objs = state.get_objects(self._block_type)
-        self._block_id_to_block = {}
         for i, block_obj in enumerate(block_objs):
             block_id = self._block_ids[i]
-            self._block_id_to_block[block_id] = block_obj
             bx = state.get(block_obj, "pose_x")
             by = state.get(block_obj, "pose_y")
             bz = state.get(block_obj, "pose_z")
@@ -255,15 +254,6 @@ class PyBulletBlocksEnv(PyBulletEnv, BlocksEnv):
                 block_id, [bx, by, bz],
                 self._default_orn,
                 physicsClientId=self._physics_client_id)
-            # Update the block color. RGB values are between 0 and 1.
-            r = state.get(block_obj, "color_r")
-            g = state.get(block_obj, "color_g")
-            b = state.get(block_obj, "color_b")
-            color = (r, g, b, 1.0)  # alpha = 1.0
-            p.changeVisualShape(block_id,
-                                linkIndex=-1,
-                                rgbaColor=color,
-                                physicsClientId=self._physics_client_id)
 
         # Check if we're holding some block.
         held_block = self._get_held_block(state)
@@ -290,6 +280,23 @@ class PyBulletBlocksEnv(PyBulletEnv, BlocksEnv):
         #     logging.debug(reconstructed_state.pretty_str())
         #     raise ValueError("Could not reconstruct state.")
 
+    def _restore_python_state(self, state: State) -> None:
+        """Assign the blocks of the state to block IDs and color them."""
+        block_objs = state.get_objects(self._block_type)
+        self._block_id_to_block = {}
+        for i, block_obj in enumerate(block_objs):
+            block_id = self._block_ids[i]
+            self._block_id_to_block[block_id] = block_obj
+            # Update the block color. RGB values are between 0 and 1.
+            r = state.get(block_obj, "color_r")
+            g = state.get(block_obj, "color_g")
+            b = state.get(block_obj, "color_b")
+            color = (r, g, b, 1.0)  # alpha = 1.0
+            p.changeVisualShape(block_id,
+                                linkIndex=-1,
+                                rgbaColor=color,
+                                physicsClientId=self._physics_client_id)
+
     def _get_state(self) -> State:
         """Create a State based on the current PyBullet state.
 
@@ -4,7 +4,9 @@ Contains useful common code.
 """
 
 import abc
-from typing import Any, ClassVar, Dict, List, Optional, Sequence, Tuple, cast
+from collections import OrderedDict
+from typing import Any, ClassVar, Dict, FrozenSet, Hashable, List, \
+    Optional, Sequence, Tuple, cast
 
 import matplotlib
 import numpy as np
@@ -18,8 +20,8 @@ from predicators.pybullet_helpers.geometry import Pose3D, Quaternion
 from predicators.pybullet_helpers.link import get_link_state
 from predicators.pybullet_helpers.robots import SingleArmPyBulletRobot
 from predicators.settings import CFG
-from predicators.structs import Action, Array, EnvironmentTask, Observation, \
-    State, Video
+from predicators.structs import Action, Array, EnvironmentTask, Object, \
+    Observation, State, Video
 
 
 class PyBulletEnv(BaseEnv):
@@ -63,6 +65,16 @@ class PyBulletEnv(BaseEnv):
         self._held_obj_to_base_link: Optional[Any] = None
         self._held_obj_id: Optional[int] = None
 
+        # Snapshots of states produced by the simulator, saved with
+        # p.saveState(), so that simulate() can rewind to them cheaply.
+        # Maps the fingerprint of each state to the snapshot ID, the held
+        # object ID, and the held object's transform to the end effector.
+        self._state_snapshots: OrderedDict[Hashable, Tuple[
+            int, Optional[int], Optional[Any]]] = OrderedDict()
+        # The objects of the state last given to _reset_state(). The
+        # snapshots are removed when they change.
+        self._state_snapshot_objects: Optional[FrozenSet[Object]] = None
+
         # Set up all the static PyBullet content.
         self._physics_client_id, self._pybullet_robot, pybullet_bodies = \
             self.initialize_pybullet(self.using_gui)
@@ -165,8 +177,12 @@ class PyBulletEnv(BaseEnv):
         if self._current_observation is None or \
             not state.allclose(self._current_state):
             self._current_observation = state
-            self._reset_state(state)
-        return self.step(action)
+            if not self._restore_state_snapshot(state):
+                self._reset_state(state)
+                self._save_state_snapshot(state)
+        next_state = self.step(action)
+        self._save_state_snapshot(next_state)
+        return next_state
 
     def render_state_plt(
             self,
@@ -193,6 +209,13 @@ class PyBulletEnv(BaseEnv):
 
     def _reset_state(self, state: State) -> None:
         """Helper for reset and testing."""
+        # Snapshots of states with other objects may not match the bodies
+        # that subclasses set up for these objects.
+        objects = frozenset(state)
+        if objects != self._state_snapshot_objects:
+            self._invalidate_state_snapshots()
+            self._state_snapshot_objects = objects
+
         # Tear down the old PyBullet scene.
         if self._held_constraint_id is not None:
             p.removeConstraint(self._held_constraint_id,
@@ -203,6 +226,76 @@ class PyBulletEnv(BaseEnv):
         # Reset robot.
         self._pybullet_robot.reset_state(self._extract_robot_state(state))
 
+    @staticmethod
+    def _get_state_fingerprint(state: State) -> Hashable:
+        """The exact features of the state, including the simulator state
+        of a PyBulletState."""
+        features = tuple((obj, state.data[obj].tobytes())
+                         for obj in sorted(state.data))
+        if isinstance(state, utils.PyBulletState):
+            return features, tuple(state.joint_positions)
+        return features
+
+    def _save_state_snapshot(self, state: State) -> None:
+        """Save a snapshot of the current PyBullet state, which produced the
+        given state, evicting the least recently used one if there are more
+        than CFG.pybullet_state_snapshot_cache_size."""
+        if CFG.pybullet_state_snapshot_cache_size <= 0:
+            return
+        fingerprint = self._get_state_fingerprint(state)
+        if fingerprint in self._state_snapshots:
+            self._state_snapshots.move_to_end(fingerprint)
+            return
+        snapshot_id = p.saveState(physicsClientId=self._physics_client_id)
+        self._state_snapshots[fingerprint] = (snapshot_id, self._held_obj_id,
+                                              self._held_obj_to_base_link)
+        if len(self._state_snapshots) > \
+            CFG.pybullet_state_snapshot_cache_size:
+            evicted_id, _, _ = self._state_snapshots.popitem(last=False)[1]
+            p.removeState(evicted_id, physicsClientId=self._physics_client_id)
+
+    def _restore_state_snapshot(self, state: State) -> bool:
+        """Restore the snapshot of the given state, if there is one, and
+        return whether there was."""
+        fingerprint = self._get_state_fingerprint(state)
+        if fingerprint not in self._state_snapshots:
+            return False
+        self._state_snapshots.move_to_end(fingerprint)
+        snapshot_id, held_obj_id, held_obj_to_base_link = \
+            self._state_snapshots[fingerprint]
+        # Constraints are not part of the snapshots.
+        if self._held_constraint_id is not None:
+            p.removeConstraint(self._held_constraint_id,
+                               physicsClientId=self._physics_client_id)
+            self._held_constraint_id = None
+        p.restoreState(snapshot_id, physicsClientId=self._physics_client_id)
+        self._held_obj_id = held_obj_id
+        if held_obj_id is not None:
+            self._held_obj_to_base_link = held_obj_to_base_link
+            self._add_grasp_constraint()
+        self._restore_python_state(state)
+        return True
+
+    def _restore_python_state(self, state: State) -> None:
+        """Re-apply what _reset_state() sets outside of PyBullet's dynamics
+        for the given state (e.g., Python-side bookkeeping and colors),
+        which snapshots don't include.
+
+        Called after a snapshot of the state is restored. Subclasses
+        that set such things in _reset_state() must override this.
+        """
+
+    def _invalidate_state_snapshots(self) -> None:
+        """Remove all the state snapshots.
+
+        Must be called whenever PyBullet is changed in a way that the
+        snapshots don't capture, e.g., bodies are added or removed.
+        """
+        for snapshot_id, _, _ in self._state_snapshots.values():
+            p.removeState(snapshot_id,
+                          physicsClientId=self._physics_client_id)
+        self._state_snapshots.clear()
+
     def render(self,
                action: Optional[Action] = None,
                caption: Optional[str] = None) -> Video:  # pragma: no cover
@@ -350,6 +443,12 @@ class PyBulletEnv(BaseEnv):
         self._held_obj_to_base_link = p.invertTransform(*p.multiplyTransforms(
             base_link_to_world[:3], base_link_to_world[3:], world_to_obj[:3],
             world_to_obj[3:]))
+        self._add_grasp_constraint()
+
+    def _add_grasp_constraint(self) -> None:
+        """Create the grasp constraint for self._held_obj_id from
+        self._held_obj_to_base_link."""
+        assert self._held_obj_id is not None
         self._held_constraint_id = p.createConstraint(
             parentBodyUniqueId=self._pybullet_robot.robot_id,
             parentLinkIndex=self._pybullet_robot.end_effector_id,
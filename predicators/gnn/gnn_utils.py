@@ -3,14 +3,17 @@
 from __future__ import division
 
 import collections
+import hashlib
 import logging
+import os
+import shutil
 import time
 import wandb
 from typing import Any, Callable, Dict, List, Optional, OrderedDict, Tuple
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
 
 from predicators.structs import Array
 from itertools import product
@@ -411,6 +414,71 @@ def concat_graphs(input_graphs: List[Dict], dim: int) -> Dict:
     return output
 
 
+def pack_graphs(graphs: List[Dict]) -> Dict[str, Array]:
+    """Concatenate the arrays of many graphs into a few large buffers.
+
+    Graph i is in rows node_offsets[i]:node_offsets[i + 1] of "nodes" and
+    rows edge_offsets[i]:edge_offsets[i + 1] of "edges", "senders" and
+    "receivers". Senders and receivers keep their per-graph node indices.
+    Graphs with globals are not supported.
+    """
+    assert graphs, "Cannot pack an empty list of graphs"
+    assert all(g["globals"] is None for g in graphs)
+    n_nodes = np.array([len(g["nodes"]) for g in graphs], dtype=np.int64)
+    n_edges = np.array([len(g["edges"]) for g in graphs], dtype=np.int64)
+    return {
+        "nodes": np.concatenate([g["nodes"] for g in graphs]),
+        "edges": np.concatenate([g["edges"] for g in graphs]),
+        "senders": np.concatenate([g["senders"] for g in graphs]),
+        "receivers": np.concatenate([g["receivers"] for g in graphs]),
+        "node_offsets": np.concatenate([[0], np.cumsum(n_nodes)]),
+        "edge_offsets": np.concatenate([[0], np.cumsum(n_edges)]),
+    }
+
+
+def get_packed_graph(packed: Dict[str, Array], idx: int) -> Dict:
+    """Get graph idx from the output of pack_graphs(), without copying."""
+    n_start, n_end = packed["node_offsets"][idx:idx + 2]
+    e_start, e_end = packed["edge_offsets"][idx:idx + 2]
+    return {
+        "n_node": np.array(n_end - n_start),
+        "nodes": packed["nodes"][n_start:n_end],
+        "n_edge": np.array([e_end - e_start], dtype=np.int64),
+        "edges": packed["edges"][e_start:e_end],
+        "senders": packed["senders"][e_start:e_end],
+        "receivers": packed["receivers"][e_start:e_end],
+        "globals": None,
+    }
+
+
+def save_packed_graphs(packed: Dict[str, Array], save_dir: str) -> None:
+    """Save the output of pack_graphs() as one .npy file per buffer.
+
+    The files are written to a temporary directory that is then renamed,
+    so that a crash never leaves a partial cache behind.
+    """
+    tmp_dir = f"{save_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for k, v in packed.items():
+        np.save(os.path.join(tmp_dir, f"{k}.npy"), v)
+    try:
+        os.replace(tmp_dir, save_dir)
+    except OSError:
+        # Another process saved the same cache first.
+        if not os.path.isdir(save_dir):
+            raise
+        shutil.rmtree(tmp_dir)
+
+
+def load_packed_graphs(save_dir: str) -> Dict[str, Array]:
+    """Memory-map graphs saved by save_packed_graphs()."""
+    return {
+        os.path.splitext(f)[0]: np.load(os.path.join(save_dir, f),
+                                        mmap_mode="r")
+        for f in os.listdir(save_dir) if f.endswith(".npy")
+    }
+
+
 class GraphDictDataset(Dataset):
     """A Dataset that stores input and output graphs."""
 
@@ -445,6 +513,202 @@ class GraphTransC2DDataset(Dataset):
         return self.data_list[idx]
 
 
+class PackedGraphTransDataset(Dataset):
+    """A GraphTransC2DDataset whose graphs are stored in shared memory.
+
+    Created with pack_graph_trans_datasets(). The graphs live in a few
+    large tensors with offset tables (see pack_graphs()) that can be
+    shared by many datasets, and passing the dataset to another process
+    with torch.multiprocessing does not copy them. Batch with
+    get_dataloader(), which collates by slicing the packed tensors.
+    """
+
+    _GRAPH_KEYS = ("input", "target", "input_", "target_")
+
+    def __init__(self, stores: Dict[str, Dict[str, torch.Tensor]],
+                 graph_idxs: Dict[str, torch.Tensor],
+                 action_info: Dict[str, torch.Tensor]):
+        # stores maps each graph key to its packed graphs, graph_idxs maps
+        # each graph key to the index of the graph of each item.
+        self.stores = stores
+        self.graph_idxs = graph_idxs
+        self.action_info = action_info
+
+    def __len__(self) -> int:
+        return len(self.action_info["action_id"])
+
+    def __getitem__(self, idx: int) -> Dict:
+        """Get one item in the format of GraphTransC2DDataset."""
+        item: Dict[str, Any] = {
+            key: get_packed_graph(
+                {k: v.numpy() for k, v in self.stores[key].items()},
+                int(self.graph_idxs[key][idx]))
+            for key in self._GRAPH_KEYS
+        }
+        item["action_info"] = {
+            "action_id": int(self.action_info["action_id"][idx]),
+            "action_arity": int(self.action_info["action_arity"][idx]),
+            "action_node_ids":
+            self.action_info["action_node_ids"][idx].numpy(),
+        }
+        return item
+
+    def get_dataloader(self, batch_size: int, shuffle: bool) -> DataLoader:
+        """A DataLoader with the same batches as action_graph_batch_collate
+        would give on this dataset."""
+        return DataLoader(range(len(self)),
+                          batch_size=batch_size,
+                          shuffle=shuffle,
+                          num_workers=0,
+                          collate_fn=self.collate)
+
+    def collate(self, batch: List[int]) -> Dict:
+        """Collate the items with indices batch."""
+        idxs = torch.as_tensor(batch, dtype=torch.int64)
+        new_batch = {}
+        node_starts = None
+        for key in self._GRAPH_KEYS:
+            new_batch[key], batch_starts = self.collate_graphs(key, idxs)
+            if node_starts is None:
+                node_starts = batch_starts
+            assert torch.equal(node_starts, batch_starts)
+        assert node_starts is not None
+        new_batch['action_info'] = {
+            'action_node_ids':
+            self.action_info["action_node_ids"][idxs] + node_starts[:, None],
+            'action_id': self.action_info["action_id"][idxs],
+            'action_arity': self.action_info["action_arity"][idxs],
+        }
+        return new_batch
+
+    def collate_graphs(self, key: str,
+                       idxs: torch.Tensor) -> Tuple[Dict, torch.Tensor]:
+        """Collate the graphs under key of the items with indices idxs into a
+        super graph, and get the offset of each graph's nodes in it."""
+        store = self.stores[key]
+        graph_idxs = self.graph_idxs[key][idxs]
+        n_starts = store["node_offsets"][graph_idxs]
+        n_nodes = store["node_offsets"][graph_idxs + 1] - n_starts
+        e_starts = store["edge_offsets"][graph_idxs]
+        n_edges = store["edge_offsets"][graph_idxs + 1] - e_starts
+        # Offsets of the nodes / edges of each graph in the super graph.
+        batch_starts = torch.cumsum(n_nodes, 0) - n_nodes
+        batch_e_starts = torch.cumsum(n_edges, 0) - n_edges
+        node_rows = torch.arange(int(n_nodes.sum())) + \
+            torch.repeat_interleave(n_starts - batch_starts, n_nodes)
+        edge_rows = torch.arange(int(n_edges.sum())) + \
+            torch.repeat_interleave(e_starts - batch_e_starts, n_edges)
+        edge_shift = torch.repeat_interleave(batch_starts, n_edges)
+        graph = {
+            'n_node': n_nodes[:, None],
+            'n_edge': n_edges[:, None],
+            'nodes': store["nodes"][node_rows].float().requires_grad_(),
+            'edges': store["edges"][edge_rows].float().requires_grad_(),
+            'receivers': store["receivers"][edge_rows] + edge_shift,
+            'senders': store["senders"][edge_rows] + edge_shift,
+            'globals': None,
+        }
+        return graph, batch_starts
+
+
+def get_ensemble_dataloader(datasets: List[PackedGraphTransDataset],
+                            batch_size: int, shuffle: bool) -> DataLoader:
+    """A DataLoader over datasets that differ only in their targets.
+
+    Each batch is collated like PackedGraphTransDataset.collate() on the
+    first dataset, except that the inputs and action info are collated
+    once and 'targets' holds the (target, target_) of every dataset.
+    """
+    first = datasets[0]
+    for dataset in datasets[1:]:
+        assert dataset.stores["input"] is first.stores["input"]
+        for key in ("input", "input_"):
+            assert torch.equal(dataset.graph_idxs[key], first.graph_idxs[key])
+        for key, value in first.action_info.items():
+            assert torch.equal(dataset.action_info[key], value)
+
+    def _collate(batch: List[int]) -> Dict:
+        new_batch = first.collate(batch)
+        idxs = torch.as_tensor(batch, dtype=torch.int64)
+        new_batch['targets'] = [(new_batch['target'], new_batch['target_'])]
+        for dataset in datasets[1:]:
+            target, _ = dataset.collate_graphs("target", idxs)
+            target_, _ = dataset.collate_graphs("target_", idxs)
+            new_batch['targets'].append((target, target_))
+        return new_batch
+
+    return DataLoader(range(len(first)),
+                      batch_size=batch_size,
+                      shuffle=shuffle,
+                      num_workers=0,
+                      collate_fn=_collate)
+
+
+def pack_graph_trans_datasets(
+        datasets: List[GraphTransC2DDataset]) -> List[PackedGraphTransDataset]:
+    """Pack datasets into PackedGraphTransDatasets in shared memory.
+
+    Identical graphs are only stored once across all the datasets. The
+    datasets usually differ only in their targets, so the inputs are then
+    shared by all of them.
+    """
+    # Inputs and targets have different feature dimensions.
+    store_names = {"input": "input", "input_": "input",
+                   "target": "target", "target_": "target"}
+    graphs: Dict[str, List[Dict]] = {"input": [], "target": []}
+    graph_to_idx: Dict[str, Dict[bytes, int]] = {"input": {}, "target": {}}
+    all_graph_idxs = []
+    all_action_infos = []
+    for dataset in datasets:
+        graph_idxs: Dict[str, List[int]] = {k: [] for k in store_names}
+        for item in dataset.data_list:
+            for key, name in store_names.items():
+                graph = item[key]
+                hasher = hashlib.sha1()
+                for k in ("nodes", "edges", "senders", "receivers"):
+                    hasher.update(str(graph[k].shape).encode())
+                    hasher.update(np.ascontiguousarray(graph[k]).tobytes())
+                content = hasher.digest()
+                if content not in graph_to_idx[name]:
+                    graph_to_idx[name][content] = len(graphs[name])
+                    graphs[name].append(graph)
+                graph_idxs[key].append(graph_to_idx[name][content])
+        all_graph_idxs.append(graph_idxs)
+        all_action_infos.append([item["action_info"]
+                                 for item in dataset.data_list])
+    stores = {}
+    for name, name_graphs in graphs.items():
+        packed = pack_graphs(name_graphs)
+        # Collation casts to float anyway, so store float32.
+        packed["nodes"] = packed["nodes"].astype(np.float32)
+        packed["edges"] = packed["edges"].astype(np.float32)
+        stores[name] = {
+            k: torch.from_numpy(np.ascontiguousarray(v)).share_memory_()
+            for k, v in packed.items()
+        }
+    packed_datasets = []
+    for graph_idxs, action_infos in zip(all_graph_idxs, all_action_infos):
+        action_info = {
+            "action_id":
+            torch.tensor([a["action_id"] for a in action_infos],
+                         dtype=torch.int64),
+            "action_arity":
+            torch.tensor([a["action_arity"] for a in action_infos],
+                         dtype=torch.int64),
+            "action_node_ids":
+            torch.from_numpy(
+                np.array([a["action_node_ids"] for a in action_infos],
+                         dtype=np.int64)),
+        }
+        packed_datasets.append(
+            PackedGraphTransDataset(
+                {key: stores[name] for key, name in store_names.items()}, {
+                    k: torch.tensor(v, dtype=torch.int64).share_memory_()
+                    for k, v in graph_idxs.items()
+                }, {k: v.share_memory_() for k, v in action_info.items()}))
+    return packed_datasets
+
+
 def _create_super_graph(batches: List[Dict],
                         device: Optional[torch.device] = None) -> Dict:
     nodes = batches[0]['nodes']
@@ -1561,6 +1561,8 @@ class HierachicalMCTSearcher(abc.ABC):
         root.update_value(self.global_zero_loss, self.guidance_th)
         self.frontier = [root]
         self.evaluated_values = {tuple(root.state)}
+        # (indexes, values) of partial states known to be unsatisfiable
+        self.infeasible_patterns = []
 
     def uct_selection(self, nodes, bs):
         # Use NumPy for efficient computation of UCT values
@@ -1602,6 +1604,25 @@ class HierachicalMCTSearcher(abc.ABC):
         
         self.update_front()
 
+    def prune(self, idxs, values):
+        """Mark every state with the given values at idxs as unsatisfiable.
+
+        The values should all be non-zero. Children only change zero
+        entries, so this prunes the whole subtree of each matching node.
+        """
+        idxs = np.asarray(idxs)
+        values = np.asarray(values)
+        assert (values != 0).all()
+        self.infeasible_patterns.append((idxs, values))
+        for node in self.frontier:
+            if (node.state[idxs] == values).all():
+                node.value = -np.inf
+        self.update_front()
+
+    def is_infeasible(self, state):
+        return any((state[idxs] == values).all()
+                   for idxs, values in self.infeasible_patterns)
+
     def update_front(self):
         new_frontier = []
         for node in self.frontier:
@@ -1635,6 +1656,9 @@ class HierachicalMCTSearcher(abc.ABC):
                     child = node.expand(self.global_zero_loss)
                     if tuple(child.state) not in self.evaluated_values:
                         self.evaluated_values.add(tuple(child.state))
+                        if self.is_infeasible(child.state):
+                            # known to be unsatisfiable, do not propose it
+                            continue
                         # logging.info(f"Propose Child node: {child.state}")
                         # logging.info(f"From Parent: {node.state}")
                         if child.level <= self.frontier_max_level:
@@ -671,6 +671,137 @@ def train_predicate_model(
     assert best_seen_model_weights
     return best_seen_model_weights, best_seen_running_validation_loss
 
+def train_predicate_models_ensemble(
+    iteration: int,
+    models: List[Any],
+    train_dataloader: torch.utils.data.DataLoader,
+    val_dataloader: torch.utils.data.DataLoader,
+    optimizers: List[torch.optim.Optimizer],
+    super_label: Dict,
+    num_epochs: int,
+    val_freq: int = 1,
+    device: Optional[torch.device] = None,
+    schedulers: Optional[List[Any]] = None,
+    quick_skip: Optional[Dict] = None,
+    select_models: Optional[Callable[
+        [int, List[int], List[OrderedDict[str, torch.Tensor]], List[float]],
+        List[int]]] = None,
+) -> List[Tuple[OrderedDict[str, torch.Tensor], float]]:
+    """Optimize several models that share inputs but not targets together.
+
+    The dataloaders are from get_ensemble_dataloader(), so each batch is
+    loaded, collated and moved to the device once for all the models.
+    Each model has its own optimizer (and scheduler), loss and best
+    checkpoint, as in train_predicate_model(). A model that fails its
+    quick_skip check stops being trained while the others continue.
+    If given, select_models is called after every epoch with the number
+    of epochs done, the models still being trained, and the best weights
+    and validation losses so far, and returns the models to keep
+    training. Returns the best weights and validation loss of every
+    model.
+    """
+    since = time.perf_counter()
+    num_models = len(models)
+    if schedulers is None:
+        schedulers = [None] * num_models
+    best_weights: List[OrderedDict[str, torch.Tensor]] = \
+        [collections.OrderedDict({}) for _ in models]
+    best_val_losses = [np.inf] * num_models
+    active = list(range(num_models))
+    for model in models:
+        model.to(device)
+
+    def _to_device(graph: Dict) -> Dict:
+        if device is None:
+            return graph
+        return {k: v.to(device) if v is not None else v
+                for k, v in graph.items()}
+
+    for epoch in range(num_epochs):
+        if epoch % 10 == 0:
+            logging.info(f'Iteration {iteration} Epoch {epoch}/{num_epochs - 1}'
+                         f' ({len(active)}/{num_models} models active)')
+            logging.info('-' * 10)
+        train_losses: Dict[int, List[float]] = {m: [] for m in active}
+        val_losses: Dict[int, List[float]] = {m: [] for m in active}
+        for m in active:
+            models[m].train(True)
+        for data in train_dataloader:
+            input = _to_device(data['input'])
+            input_ = _to_device(data['input_'])
+            action_info = data['action_info']
+            loss = torch.tensor(0.0).to(device)
+            for m in active:
+                optimizers[m].zero_grad()
+                target, target_ = data['targets'][m]
+                outputs_logits = (models[m](input.copy())[-1],
+                                  models[m](input_.copy())[-1])
+                targets = (_to_device(target), _to_device(target_))
+                non_change_loss, change_loss = neupi_supervise_criterion(
+                    outputs_logits, targets, action_info, super_label,
+                    device=device)
+                model_loss = non_change_loss + change_loss
+                train_losses[m].append(model_loss.item())
+                # The models share no parameters, so backpropagating the sum
+                # gives each model the gradients of its own loss.
+                loss = loss + model_loss
+            loss.backward()
+            for m in active:
+                optimizers[m].step()
+        for m in active:
+            if schedulers[m] is not None:
+                schedulers[m].step()
+        if (epoch + 1) % val_freq == 0:
+            for m in active:
+                models[m].train(False)
+            with torch.no_grad():
+                for data in val_dataloader:
+                    input = _to_device(data['input'])
+                    input_ = _to_device(data['input_'])
+                    action_info = data['action_info']
+                    for m in active:
+                        target, target_ = data['targets'][m]
+                        outputs_logits = (models[m](input.copy())[-1],
+                                          models[m](input_.copy())[-1])
+                        targets = (_to_device(target), _to_device(target_))
+                        non_change_loss, change_loss = \
+                            neupi_supervise_criterion(
+                                outputs_logits, targets, action_info,
+                                super_label, device=device)
+                        val_losses[m].append(
+                            (non_change_loss + change_loss).item())
+        still_active = []
+        for m in active:
+            train_loss = np.mean(train_losses[m]) if train_losses[m] else 100.0
+            val_loss = np.mean(val_losses[m]) if val_losses[m] else 100.0
+            logging.info(f"Epoch {epoch}, model {m}, average training loss: "
+                         f"{train_loss}, validation loss: {val_loss}")
+            if val_loss < best_val_losses[m]:
+                best_val_losses[m] = val_loss
+                best_weights[m] = collections.OrderedDict(
+                    (k, v.detach().clone())
+                    for k, v in models[m].state_dict().items())
+                logging.info(f"Found new best model {m} with val loss "
+                             f"{val_loss} at epoch {epoch}")
+            if (quick_skip is not None) and ((epoch + 1) in quick_skip) and \
+                    best_val_losses[m] > quick_skip[(epoch + 1)]:
+                logging.info(f"Skip the rest of the training of model {m} "
+                             f"at epoch {epoch}")
+                continue
+            still_active.append(m)
+        active = still_active
+        if select_models is not None and active:
+            active = select_models(epoch + 1, active, best_weights,
+                                   best_val_losses)
+        if not active:
+            break
+
+    time_elapsed = time.perf_counter() - since
+    logging.info(f"Training {num_models} models complete in "
+                 f"{time_elapsed // 60:.0f}m {time_elapsed % 60:.0f}s")
+    assert all(best_weights)
+    return list(zip(best_weights, best_val_losses))
+
 def train_init_dummy_model(
     model: Any,
     train_dataloader: torch.utils.data.DataLoader,
@@ -0,0 +1,275 @@
+"""Delete-relaxation task planning heuristics over integer fact ids.
+
+The ground operators of a task are compiled once into a RelaxedTask,
+where facts are integer ids and operators are tuples of fact ids. The
+heuristics then only index into flat lists. Static atoms (true in the
+initial state and never changed by any operator) are dropped from the
+task, as in the pyperplan glue in utils.py.
+"""
+
+from __future__ import annotations
+
+import heapq
+from typing import Callable, Collection, Dict, List, Sequence, Tuple
+
+from predicators.structs import GroundAtom, GroundNSRTOrSTRIPSOperator
+
+_INF = float("inf")
+
+
+class RelaxedTask:
+    """A task compiled for the delete-relaxation heuristics.
+
+    Operators without preconditions are given the precondition
+    always_true, a fact that holds in every state, and an extra goal
+    operator (with cost 0) achieves the fact goal_fact from all the goal
+    facts. The heuristics other than lmcut ignore the goal operator.
+    """
+
+    def __init__(self, init_atoms: Collection[GroundAtom],
+                 goal: Collection[GroundAtom],
+                 ground_ops: Collection[GroundNSRTOrSTRIPSOperator]) -> None:
+        changed_atoms = set()
+        for op in ground_ops:
+            changed_atoms.update(op.add_effects)
+            changed_atoms.update(op.delete_effects)
+        self.static_atoms = {a for a in init_atoms if a not in changed_atoms}
+        self.fact_ids: Dict[GroundAtom, int] = {}
+        self.always_true = 0
+        self.goal_fact = 1
+        self.num_facts = 2
+        self.op_pre: List[Tuple[int, ...]] = []
+        self.op_add: List[Tuple[int, ...]] = []
+        for op in ground_ops:
+            pre = self._get_fact_ids(op.preconditions)
+            self.op_pre.append(pre if pre else (self.always_true, ))
+            self.op_add.append(self._get_fact_ids(op.add_effects))
+        self.goal = self._get_fact_ids(goal)
+        self.goal_set = frozenset(self.goal)
+        self.num_ops = len(self.op_pre)
+        self.goal_op = self.num_ops
+        self.op_pre.append(self.goal if self.goal else (self.always_true, ))
+        self.op_add.append((self.goal_fact, ))
+        # Facts are also ids into these lists.
+        self.precondition_of: List[List[int]] = [
+            [] for _ in range(self.num_facts)
+        ]
+        self.effect_of: List[List[int]] = [[] for _ in range(self.num_facts)]
+        for op_id, (pre, add) in enumerate(zip(self.op_pre, self.op_add)):
+            for fact in pre:
+                self.precondition_of[fact].append(op_id)
+            for fact in add:
+                self.effect_of[fact].append(op_id)
+
+    def _get_fact_ids(self, atoms: Collection[GroundAtom]) -> Tuple[int, ...]:
+        ids = []
+        for atom in atoms:
+            if atom in self.static_atoms:
+                continue
+            if atom not in self.fact_ids:
+                self.fact_ids[atom] = self.num_facts
+                self.num_facts += 1
+            ids.append(self.fact_ids[atom])
+        return tuple(sorted(set(ids)))
+
+    def encode(self, atoms: Collection[GroundAtom]) -> Tuple[int, ...]:
+        """Get the sorted ids of the atoms that matter to the heuristics.
+
+        Atoms that are static or that no operator or goal mentions are
+        dropped. The always_true fact is included.
+        """
+        fact_ids = self.fact_ids
+        return tuple(
+            sorted({fact_ids[a]
+                    for a in atoms if a in fact_ids} | {self.always_true}))
+
+
+def _relaxed_exploration(
+    task: RelaxedTask, state: Sequence[int],
+    combine: Callable[[List[float]], float]
+) -> Tuple[List[float], List[int]]:
+    """Generalized Dijkstra over the relaxed task, as in pyperplan.
+
+    The cost of an operator is 1 plus the combination (sum for hadd,
+    max for hmax) of the costs of its preconditions. Returns the cost of
+    each fact and, for each fact, its cheapest achiever (or -1). Stops
+    once all goal facts are reached.
+    """
+    dist = [_INF] * task.num_facts
+    achiever = [-1] * task.num_facts
+    unsat = [len(pre) for pre in task.op_pre]
+    expanded = [False] * task.num_facts
+    op_pre, op_add, precondition_of = \
+        task.op_pre, task.op_add, task.precondition_of
+    goal_op = task.goal_op
+    heap = []
+    for tie, fact in enumerate(state):
+        dist[fact] = 0
+        heap.append((0, tie, fact))
+    tie = len(heap)
+    num_goals_left = sum(1 for g in task.goal if dist[g] != 0)
+    if num_goals_left == 0:
+        return dist, achiever
+    while heap:
+        fact_dist, _, fact = heapq.heappop(heap)
+        if expanded[fact]:
+            continue
+        expanded[fact] = True
+        if fact_dist > 0 and fact in task.goal_set:
+            num_goals_left -= 1
+            if num_goals_left == 0:
+                break
+        for op in precondition_of[fact]:
+            unsat[op] -= 1
+            if unsat[op] > 0 or op == goal_op:
+                continue
+            cost = combine([dist[p] for p in op_pre[op]]) + 1
+            for eff in op_add[op]:
+                if cost < dist[eff]:
+                    dist[eff] = cost
+                    achiever[eff] = op
+                    heapq.heappush(heap, (cost, tie, eff))
+                    tie += 1
+    return dist, achiever
+
+
+def _combine_max(values: List[float]) -> float:
+    return max(values)
+
+
+def hadd(task: RelaxedTask, state: Sequence[int]) -> float:
+    """The additive heuristic."""
+    dist, _ = _relaxed_exploration(task, state, sum)
+    return float(sum(dist[g] for g in task.goal))
+
+
+def hmax(task: RelaxedTask, state: Sequence[int]) -> float:
+    """The max heuristic."""
+    dist, _ = _relaxed_exploration(task, state, _combine_max)
+    return float(max((dist[g] for g in task.goal), default=0))
+
+
+def hff(task: RelaxedTask, state: Sequence[int]) -> float:
+    """The FF heuristic: the size of a relaxed plan extracted backwards
+    from the goal through the cheapest (hadd) achievers.
+
+    Among equally cheap achievers of a fact, the first one found wins,
+    where facts of equal cost are explored in the order of their ids.
+    Pyperplan explores them in the iteration order of its sets of fact
+    names, which depends on string hashing, so the relaxed plan and its
+    size can differ from pyperplan's (on about 2% of the states of small
+    blocks problems). Set CFG.sesame_use_pyperplan_hff to use pyperplan.
+    """
+    dist, achiever = _relaxed_exploration(task, state, sum)
+    if any(dist[g] == _INF for g in task.goal):
+        return _INF
+    relaxed_plan = set()
+    closed = set(task.goal)
+    queue = list(task.goal)
+    while queue:
+        op = achiever[queue.pop()]
+        if op == -1 or op in relaxed_plan:
+            continue
+        for pre in task.op_pre[op]:
+            if pre not in closed:
+                closed.add(pre)
+                queue.append(pre)
+        relaxed_plan.add(op)
+    return float(len(relaxed_plan))
+
+
+def lmcut(task: RelaxedTask, state: Sequence[int]) -> float:
+    """The landmark-cut heuristic, following pyperplan's LmCutHeuristic.
+
+    Operator costs start at 1 (0 for the goal operator). Each round
+    computes hmax, finds the cut between the goal plateau (facts that
+    reach the goal through zero-cost hmax supporters) and the rest, and
+    moves the smallest cost in the cut into the heuristic value.
+    """
+    cost = [1.0] * task.num_ops + [0.0]
+    value = 0.0
+    while True:
+        fact_hmax, supporter = _compute_hmax_with_supporters(task, state, cost)
+        goal_hmax = fact_hmax[task.goal_fact]
+        if goal_hmax == _INF:
+            return _INF
+        if goal_hmax == 0:
+            return value
+        # The goal plateau.
+        plateau = set()
+        stack = [task.goal_fact]
+        while stack:
+            fact = stack.pop()
+            if fact in plateau or fact_hmax[fact] == _INF:
+                continue
+            plateau.add(fact)
+            for op in task.effect_of[fact]:
+                if cost[op] == 0 and supporter[op] != -1:
+                    stack.append(supporter[op])
+        # The cut: operators reachable in the justification graph without
+        # entering the plateau whose effects enter it.
+        cut = set()
+        seen = set(state)
+        queue = list(state)
+        while queue:
+            fact = queue.pop()
+            for op in task.precondition_of[fact]:
+                if supporter[op] != fact:
+                    continue
+                for eff in task.op_add[op]:
+                    if eff in seen:
+                        continue
+                    if eff in plateau:
+                        cut.add(op)
+                    else:
+                        seen.add(eff)
+                        queue.append(eff)
+        min_cost = min(cost[op] for op in cut)
+        value += min_cost
+        for op in cut:
+            cost[op] -= min_cost
+
+
+def _compute_hmax_with_supporters(
+        task: RelaxedTask, state: Sequence[int],
+        cost: List[float]) -> Tuple[List[float], List[int]]:
+    """Helper for lmcut(); hmax of every fact under the given operator
+    costs, and the hmax supporter (a precondition with the largest hmax)
+    of every reached operator."""
+    fact_hmax = [_INF] * task.num_facts
+    supporter = [-1] * (task.num_ops + 1)
+    unsat = [len(pre) for pre in task.op_pre]
+    expanded = [False] * task.num_facts
+    heap = []
+    for tie, fact in enumerate(state):
+        fact_hmax[fact] = 0.0
+        heap.append((0.0, tie, fact))
+    tie = len(heap)
+    while heap:
+        fact_value, _, fact = heapq.heappop(heap)
+        if expanded[fact]:
+            continue
+        expanded[fact] = True
+        for op in task.precondition_of[fact]:
+            unsat[op] -= 1
+            if unsat[op] > 0:
+                continue
+            # Facts are expanded in order of hmax, so the precondition
+            # expanded last has the largest hmax.
+            supporter[op] = fact
+            op_value = fact_value + cost[op]
+            for eff in task.op_add[op]:
+                if op_value < fact_hmax[eff]:
+                    fact_hmax[eff] = op_value
+                    heapq.heappush(heap, (op_value, tie, eff))
+                    tie += 1
+    return fact_hmax, supporter
+
+
+RELAXATION_HEURISTICS: Dict[str, Callable[[RelaxedTask, Sequence[int]],
+                                          float]] = {
+                                              "hadd": hadd,
+                                              "hmax": hmax,
+                                              "hff": hff,
+                                              "lmcut": lmcut,
+                                          }
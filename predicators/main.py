@@ -39,10 +39,12 @@ import os
 import sys
 import time
 from collections import defaultdict
+from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Optional, Sequence, Tuple
 
 import dill as pkl
+import torch
 
 from predicators import utils
 import torch.multiprocessing as mp
@@ -56,8 +58,8 @@ from predicators.ground_truth_models import get_gt_options, \
     parse_config_included_options
 from predicators.perception import create_perceiver
 from predicators.settings import CFG, get_allowed_query_type_names
-from predicators.structs import Dataset, InteractionRequest, \
-    InteractionResult, Metrics, Response, Task, Video, \
+from predicators.structs import Dataset, EnvironmentTask, \
+    InteractionRequest, InteractionResult, Metrics, Response, Task, Video, \
     LowLevelTask
 from predicators.teacher import Teacher, TeacherInteractionMonitorWithVideo
 
@@ -362,145 +364,73 @@ def _run_testing(env: BaseEnv, cogman: CogMan, train_tasks=None) -> Metrics:
     test_tasks = [
         task.replace_goal_with_alt_goal() for task in env_test_tasks
     ]
-    num_found_policy = 0
-    num_solved = 0
-    cogman.reset_metrics()
-    total_suc_time = 0.0
-    total_low_level_action_cost = 0.0
-    total_num_solve_timeouts = 0
-    total_num_solve_failures = 0
-    total_num_execution_timeouts = 0
-    total_num_execution_failures = 0
-
-    save_prefix = utils.get_config_path_str()
-    metrics: Metrics = defaultdict(float)
-    curr_num_nodes_created = 0.0
-    curr_num_nodes_expanded = 0.0
-    for test_task_idx, env_task in enumerate(test_tasks):
-        # if test_task_idx != 2:
-        #     continue
-        solve_start = time.perf_counter()
-        try:
-            # We call reset here, outside of run_episode_and_get_observations,
-            # so that we can log planning failures, timeouts, etc. This is
-            # mostly for legacy reasons (before cogman existed separately
-            # from approaches).
-            cogman.reset(env_task)
-        except (ApproachTimeout, ApproachFailure) as e:
-            logging.info(f"Task {test_task_idx+1} / {len(test_tasks)}: "
-                         f"Approach failed to solve with error: {e}")
-            if isinstance(e, ApproachTimeout):
-                total_num_solve_timeouts += 1
-            elif isinstance(e, ApproachFailure):
-                total_num_solve_failures += 1
-            # logging.info(e.info)
-            if CFG.make_failure_videos and e.info.get("partial_refinements"):
-                video = utils.create_video_from_partial_refinements(
-                    e.info["partial_refinements"], env, "test", test_task_idx,
-                    CFG.horizon)
-                outfile = f"{save_prefix}__task{test_task_idx+1}_failure.mp4"
-                utils.save_video(outfile, video)
-            if CFG.crash_on_failure:
-                raise e
-            continue
-        solve_time = time.perf_counter() - solve_start
-        metrics[f"PER_TASK_task{test_task_idx}_solve_time"] = solve_time
-        metrics[
-            f"PER_TASK_task{test_task_idx}_nodes_created"] = cogman.metrics[
-                "total_num_nodes_created"] - curr_num_nodes_created
-        metrics[
-            f"PER_TASK_task{test_task_idx}_nodes_expanded"] = cogman.metrics[
-                "total_num_nodes_expanded"] - curr_num_nodes_expanded
-        curr_num_nodes_created = cogman.metrics["total_num_nodes_created"]
-        curr_num_nodes_expanded = cogman.metrics["total_num_nodes_expanded"]
-
-        num_found_policy += 1
-        make_video = False
-        solved = False
-        caught_exception = False
-        if CFG.make_test_videos or CFG.make_failure_videos:
-            monitor = utils.VideoMonitor(env.render)
-        else:
-            monitor = None
+    num_workers = min(CFG.num_test_workers, len(test_tasks))
+    if num_workers > 1 and torch.cuda.is_initialized():
+        # CUDA cannot be used in forked processes once it is initialized.
+        logging.warning("CUDA is initialized, so the test tasks are run "
+                        "serially instead of in forked workers.")
+        num_workers = 1
+    if num_workers <= 1:
+        task_results = [
+            _run_test_task(env, cogman, test_tasks, idx)
+            for idx in range(len(test_tasks))
+        ]
+    else:
+        global _TEST_CONTEXT  # pylint: disable=global-statement
+        _TEST_CONTEXT = (env, cogman, test_tasks)
+        # Fork explicitly, because main.py sets the default start method to
+        # spawn, and spawned workers would not inherit the context. Each
+        # worker gets its own copy of the env and the approach.
+        pool = mp.get_context("fork").Pool(num_workers)
         try:
-            # Now, measure success by running the policy in the environment.
-            traj, solved, execution_metrics = run_episode_and_get_observations(
-                cogman,
-                env,
-                "test",
-                test_task_idx,
-                max_num_steps=CFG.horizon,
-                monitor=monitor)
-            num_opt = execution_metrics["num_options_executed"]
-            metrics[f"PER_TASK_task{test_task_idx}_options_executed"] = num_opt
-            exec_time = execution_metrics["policy_call_time"]
-            metrics[f"PER_TASK_task{test_task_idx}_exec_time"] = exec_time
-            if CFG.refinement_data_include_execution_cost:
-                total_low_level_action_cost += (
-                    len(traj[1]) *
-                    CFG.refinement_data_low_level_execution_cost)
-            # Save the successful trajectory, e.g., for playback on a robot.
-            traj_file = f"{save_prefix}__task{test_task_idx+1}.traj"
-            traj_file_path = Path(CFG.eval_trajectories_dir) / traj_file
-            # Include the original task too so we know the goal.
-            traj_data = {
-                "task": env_task,
-                "trajectory": traj,
-                "pybullet_robot": CFG.pybullet_robot
-            }
-            with open(traj_file_path, "wb") as f:
-                pkl.dump(traj_data, f)
-        except utils.EnvironmentFailure as e:
-            log_message = f"Environment failed with error: {e}"
-            caught_exception = True
-        except (ApproachTimeout, ApproachFailure) as e:
-            log_message = ("Approach failed at policy execution time with "
-                           f"error: {e}")
-            if isinstance(e, ApproachTimeout):
-                total_num_execution_timeouts += 1
-            elif isinstance(e, ApproachFailure):
-                total_num_execution_failures += 1
-            caught_exception = True
-        if solved:
-            log_message = "SOLVED"
-            num_solved += 1
-            total_suc_time += (solve_time + exec_time)
-            make_video = CFG.make_test_videos
-            video_file = f"{save_prefix}__task{test_task_idx+1}.mp4"
-        else:
-            if not caught_exception:
-                log_message = "Policy failed to reach goal"
-            if CFG.crash_on_failure:
-                raise RuntimeError(log_message)
-            make_video = CFG.make_failure_videos
-            video_file = f"{save_prefix}__task{test_task_idx+1}_failure.mp4"
-        logging.info(f"Make video: {make_video}")
-        logging.info(f"Task {test_task_idx+1} / {len(test_tasks)}: "
-                     f"{log_message}")
-        if make_video:
-            assert monitor is not None
-            video = monitor.get_video()
-            utils.save_video(video_file, video)
+            task_results = pool.map(_run_test_task_in_worker,
+                                    range(len(test_tasks)),
+                                    chunksize=1)
+        finally:
+            pool.terminate()
+            _TEST_CONTEXT = None
+    # Merge the results in task order, so that they do not depend on the
+    # number of workers.
+    approach_metrics: Metrics = defaultdict(float)
+    approach_metrics["min_num_samples"] = float("inf")
+    approach_metrics["min_num_skeletons_optimized"] = float("inf")
+    metrics: Metrics = defaultdict(float)
+    for result in task_results:
+        metrics.update(result.metrics)
+        for k, v in result.approach_metrics.items():
+            if k.startswith("min_"):
+                approach_metrics[k] = min(approach_metrics[k], v)
+            elif k.startswith("max_"):
+                approach_metrics[k] = max(approach_metrics[k], v)
+            else:
+                approach_metrics[k] += v
+    num_found_policy = sum(r.found_policy for r in task_results)
+    num_solved = sum(r.solved for r in task_results)
+    total_suc_time = sum(r.suc_time for r in task_results)
+    total_low_level_action_cost = sum(r.low_level_action_cost
+                                      for r in task_results)
     metrics["num_solved"] = num_solved
     metrics["num_total"] = len(test_tasks)
     metrics["avg_suc_time"] = (total_suc_time /
                                num_solved if num_solved > 0 else float("inf"))
     metrics["avg_ref_cost"] = ((total_low_level_action_cost +
-                                cogman.metrics["total_refinement_time"]) /
+                                approach_metrics["total_refinement_time"]) /
                                num_solved if num_solved > 0 else float("inf"))
-    metrics["min_num_samples"] = cogman.metrics[
-        "min_num_samples"] if cogman.metrics["min_num_samples"] < float(
+    metrics["min_num_samples"] = approach_metrics[
+        "min_num_samples"] if approach_metrics["min_num_samples"] < float(
             "inf") else 0
-    metrics["max_num_samples"] = cogman.metrics["max_num_samples"]
-    metrics["min_skeletons_optimized"] = cogman.metrics[
-        "min_num_skeletons_optimized"] if cogman.metrics[
+    metrics["max_num_samples"] = approach_metrics["max_num_samples"]
+    metrics["min_skeletons_optimized"] = approach_metrics[
+        "min_num_skeletons_optimized"] if approach_metrics[
             "min_num_skeletons_optimized"] < float("inf") else 0
-    metrics["max_skeletons_optimized"] = cogman.metrics[
+    metrics["max_skeletons_optimized"] = approach_metrics[
         "max_num_skeletons_optimized"]
-    metrics["num_solve_timeouts"] = total_num_solve_timeouts
-    metrics["num_solve_failures"] = total_num_solve_failures
-    metrics["num_execution_timeouts"] = total_num_execution_timeouts
-    metrics["num_execution_failures"] = total_num_execution_failures
+    metrics["num_solve_timeouts"] = sum(r.solve_timeout for r in task_results)
+    metrics["num_solve_failures"] = sum(r.solve_failure for r in task_results)
+    metrics["num_execution_timeouts"] = sum(r.execution_timeout
+                                            for r in task_results)
+    metrics["num_execution_failures"] = sum(r.execution_failure
+                                            for r in task_results)
     # Handle computing averages of total cogman metrics wrt the
     # number of found policies. Note: this is different from computing
     # an average wrt the number of solved tasks, which might be more
@@ -510,12 +440,158 @@ def _run_testing(env: BaseEnv, cogman: CogMan, train_tasks=None) -> Metrics:
             "num_nodes_created", "num_nsrts", "num_preds", "plan_length",
             "num_failures_discovered"
     ]:
-        total = cogman.metrics[f"total_{metric_name}"]
+        total = approach_metrics[f"total_{metric_name}"]
         metrics[f"avg_{metric_name}"] = (
             total / num_found_policy if num_found_policy > 0 else float("inf"))
+    # Report the planning phase timings (see CFG.sesame_profile) summed over
+    # all the test tasks.
+    for metric_name, total in approach_metrics.items():
+        if metric_name.startswith("total_profile_"):
+            metrics[metric_name] = total
     return metrics
 
 
+@dataclass
+class _TestTaskResult:
+    """The outcome of solving and executing one test task."""
+    metrics: Metrics
+    # The metrics of the approach for this task only.
+    approach_metrics: Metrics
+    found_policy: bool = False
+    solved: bool = False
+    suc_time: float = 0.0
+    low_level_action_cost: float = 0.0
+    solve_timeout: bool = False
+    solve_failure: bool = False
+    execution_timeout: bool = False
+    execution_failure: bool = False
+
+
+# Set by _run_testing() before forking the test workers.
+_TEST_CONTEXT: Optional[Tuple[BaseEnv, CogMan, List[EnvironmentTask]]] = None
+
+
+def _run_test_task_in_worker(test_task_idx: int) -> _TestTaskResult:
+    """Helper for _run_testing(); runs in a forked worker process."""
+    assert _TEST_CONTEXT is not None
+    env, cogman, test_tasks = _TEST_CONTEXT
+    return _run_test_task(env, cogman, test_tasks, test_task_idx)
+
+
+def _run_test_task(env: BaseEnv, cogman: CogMan,
+                   test_tasks: List[EnvironmentTask],
+                   test_task_idx: int) -> _TestTaskResult:
+    """Helper for _run_testing(); solve and execute one test task, saving
+    its trajectory and videos."""
+    env_task = test_tasks[test_task_idx]
+    save_prefix = utils.get_config_path_str()
+    metrics: Metrics = defaultdict(float)
+    cogman.reset_metrics()
+    result = _TestTaskResult(metrics, cogman.metrics)
+    solve_start = time.perf_counter()
+    try:
+        # We call reset here, outside of run_episode_and_get_observations,
+        # so that we can log planning failures, timeouts, etc. This is
+        # mostly for legacy reasons (before cogman existed separately
+        # from approaches).
+        cogman.reset(env_task)
+    except (ApproachTimeout, ApproachFailure) as e:
+        logging.info(f"Task {test_task_idx+1} / {len(test_tasks)}: "
+                     f"Approach failed to solve with error: {e}")
+        if isinstance(e, ApproachTimeout):
+            result.solve_timeout = True
+        elif isinstance(e, ApproachFailure):
+            result.solve_failure = True
+        # logging.info(e.info)
+        if CFG.make_failure_videos and e.info.get("partial_refinements"):
+            video = utils.create_video_from_partial_refinements(
+                e.info["partial_refinements"], env, "test", test_task_idx,
+                CFG.horizon)
+            outfile = f"{save_prefix}__task{test_task_idx+1}_failure.mp4"
+            utils.save_video(outfile, video)
+        if CFG.crash_on_failure:
+            raise e
+        result.approach_metrics = cogman.metrics
+        return result
+    solve_time = time.perf_counter() - solve_start
+    result.approach_metrics = cogman.metrics
+    metrics[f"PER_TASK_task{test_task_idx}_solve_time"] = solve_time
+    metrics[f"PER_TASK_task{test_task_idx}_nodes_created"] = \
+        result.approach_metrics["total_num_nodes_created"]
+    metrics[f"PER_TASK_task{test_task_idx}_nodes_expanded"] = \
+        result.approach_metrics["total_num_nodes_expanded"]
+
+    result.found_policy = True
+    make_video = False
+    solved = False
+    caught_exception = False
+    if CFG.make_test_videos or CFG.make_failure_videos:
+        monitor = utils.VideoMonitor(env.render)
+    else:
+        monitor = None
+    try:
+        # Now, measure success by running the policy in the environment.
+        traj, solved, execution_metrics = run_episode_and_get_observations(
+            cogman,
+            env,
+            "test",
+            test_task_idx,
+            max_num_steps=CFG.horizon,
+            monitor=monitor)
+        num_opt = execution_metrics["num_options_executed"]
+        metrics[f"PER_TASK_task{test_task_idx}_options_executed"] = num_opt
+        exec_time = execution_metrics["policy_call_time"]
+        metrics[f"PER_TASK_task{test_task_idx}_exec_time"] = exec_time
+        if CFG.refinement_data_include_execution_cost:
+            result.low_level_action_cost = (
+                len(traj[1]) * CFG.refinement_data_low_level_execution_cost)
+        # Save the successful trajectory, e.g., for playback on a robot.
+        traj_file = f"{save_prefix}__task{test_task_idx+1}.traj"
+        traj_file_path = Path(CFG.eval_trajectories_dir) / traj_file
+        # Include the original task too so we know the goal.
+        traj_data = {
+            "task": env_task,
+            "trajectory": traj,
+            "pybullet_robot": CFG.pybullet_robot
+        }
+        with open(traj_file_path, "wb") as f:
+            pkl.dump(traj_data, f)
+    except utils.EnvironmentFailure as e:
+        log_message = f"Environment failed with error: {e}"
+        caught_exception = True
+    except (ApproachTimeout, ApproachFailure) as e:
+        log_message = ("Approach failed at policy execution time with "
+                       f"error: {e}")
+        if isinstance(e, ApproachTimeout):
+            result.execution_timeout = True
+        elif isinstance(e, ApproachFailure):
+            result.execution_failure = True
+        caught_exception = True
+    # Metrics saved by the approach during execution count too.
+    result.approach_metrics = cogman.metrics
+    if solved:
+        log_message = "SOLVED"
+        result.solved = True
+        result.suc_time = solve_time + exec_time
+        make_video = CFG.make_test_videos
+        video_file = f"{save_prefix}__task{test_task_idx+1}.mp4"
+    else:
+        if not caught_exception:
+            log_message = "Policy failed to reach goal"
+        if CFG.crash_on_failure:
+            raise RuntimeError(log_message)
+        make_video = CFG.make_failure_videos
+        video_file = f"{save_prefix}__task{test_task_idx+1}_failure.mp4"
+    logging.info(f"Make video: {make_video}")
+    logging.info(f"Task {test_task_idx+1} / {len(test_tasks)}: "
+                 f"{log_message}")
+    if make_video:
+        assert monitor is not None
+        video = monitor.get_video()
+        utils.save_video(video_file, video)
+    return result
+
+
 def _save_test_results(results: Metrics,
                        online_learning_cycle: Optional[int]) -> None:
     num_solved = results["num_solved"]
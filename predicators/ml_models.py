@@ -60,6 +60,13 @@ class Regressor(abc.ABC):
         """
         raise NotImplementedError("Override me!")
 
+    def predict_batch(self, X: Array) -> Array:
+        """Return a prediction for each row of the two-dimensional X.
+
+        Subclasses may override to predict all the rows at once.
+        """
+        return np.array([self.predict(x) for x in X])
+
 
 class _ScikitLearnRegressor(Regressor):
     """A regressor that lightly wraps a scikit-learn regression model."""
@@ -122,6 +129,20 @@ class _NormalizingRegressor(Regressor):
             y = (y * self._output_scale) + self._output_shift
         return y
 
+    def predict_batch(self, X: Array) -> Array:
+        assert len(self._x_dims), "Fit must be called before predict."
+        assert X.shape[1:] == self._x_dims
+        # Normalize.
+        if not self._disable_normalization:
+            X = (X - self._input_shift) / self._input_scale
+        # Make predictions.
+        Y = self._predict_batch(X)
+        assert Y.shape == (X.shape[0], self._y_dim)
+        # Denormalize.
+        if not self._disable_normalization:
+            Y = (Y * self._output_scale) + self._output_shift
+        return Y
+
     @abc.abstractmethod
     def _fit(self, X: Array, Y: Array) -> None:
         """Train the regressor on normalized data."""
@@ -132,6 +153,12 @@ class _NormalizingRegressor(Regressor):
         """Return a normalized prediction for the normalized input."""
         raise NotImplementedError("Override me!")
 
+    def _predict_batch(self, X: Array) -> Array:
+        """Return normalized predictions for the rows of the normalized
+        input."""
+        return np.array([self._predict(x) for x in X]).reshape(
+            (X.shape[0], self._y_dim))
+
 
 class PyTorchRegressor(_NormalizingRegressor, nn.Module):
     """ABC for PyTorch regression models."""
@@ -269,6 +296,14 @@ class BinaryClassifier(abc.ABC):
         """
         raise NotImplementedError("Override me!")
 
+    def predict_proba_batch(self, X: Array) -> Array:
+        """Get the predicted probability that each row of the two-
+        dimensional X classifies to 1.
+
+        Subclasses may override to predict all the rows at once.
+        """
+        return np.array([self.predict_proba(x) for x in X], dtype=float)
+
 
 class _ScikitLearnBinaryClassifier(BinaryClassifier):
     """A regressor that lightly wraps a scikit-learn classification model."""
@@ -411,6 +446,23 @@ class PyTorchBinaryClassifier(_NormalizingBinaryClassifier, nn.Module):
         norm_x = (x - self._input_shift) / self._input_scale
         return self._forward_single_input_np(norm_x)
 
+    def predict_proba_batch(self, X: Array) -> Array:
+        """Get the predicted probabilities for all the rows of X with one
+        forward pass.
+
+        The input is NOT normalized.
+        """
+        assert X.shape[1:] == self._x_dims
+        if self._do_single_class_prediction:
+            return np.full(X.shape[0], float(self._predicted_single_class))
+        norm_X = (X - self._input_shift) / self._input_scale
+        tensor_X = torch.from_numpy(np.array(norm_X, dtype=np.float32)).to(
+            self._device)
+        tensor_Y = self(tensor_X)
+        probas = tensor_Y.detach().cpu().numpy().reshape(X.shape[0])
+        assert np.all((0 <= probas) & (probas <= 1))
+        return probas.astype(float)
+
     @abc.abstractmethod
     def _initialize_net(self) -> None:
         """Initialize the network once the data dimensions are known."""
@@ -533,6 +585,12 @@ class MLPRegressor(PyTorchRegressor):
         tensor_X = self._linears[-1](tensor_X)
         return tensor_X
 
+    def _predict_batch(self, X: Array) -> Array:
+        tensor_X = torch.from_numpy(np.array(X, dtype=np.float32)).to(
+            self._device)
+        tensor_Y = self(tensor_X)
+        return tensor_Y.detach().cpu().numpy()
+
     def _initialize_net(self) -> None:
         assert len(self._x_dims) == 1, "X should be two-dimensional"
         self._linears = nn.ModuleList()
@@ -1210,10 +1268,20 @@ class BinaryClassifierEnsemble(BinaryClassifier):
         raise Exception("Can't call predict_proba() on an ensemble. Use "
                         "predict_member_probas() instead.")
 
+    def predict_proba_batch(self, X: Array) -> Array:
+        raise Exception("Can't call predict_proba_batch() on an ensemble. "
+                        "Use predict_member_probas_batch() instead.")
+
     def predict_member_probas(self, x: Array) -> Array:
         """Return class probabilities predicted by each member."""
         return np.array([m.predict_proba(x) for m in self._members])
 
+    def predict_member_probas_batch(self, X: Array) -> Array:
+        """Return the class probabilities predicted by each member (columns)
+        for each row of X (rows)."""
+        return np.stack([m.predict_proba_batch(X) for m in self._members],
+                        axis=1)
+
 
 ################################## Utilities ##################################
 
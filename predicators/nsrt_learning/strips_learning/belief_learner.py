@@ -4,7 +4,11 @@ import abc
 import functools
 import logging
 from collections import defaultdict
-from typing import Dict, FrozenSet, Iterator, List, Set, Tuple, cast
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterator, List, Optional, Set, Tuple, \
+    cast
+
+import numpy as np
 
 from predicators import utils
 from predicators.gnn.neupi_utils import parse_basic_pred_name
@@ -14,15 +18,50 @@ from predicators.structs import PNAD, Datastore, DummyOption, LiftedAtom, \
     ParameterizedOption, Predicate, STRIPSOperator, VarToObjSub, Variable
 
 
+@dataclass(frozen=True)
+class BeliefPartition:
+    """Where a belief STRIPS learner put the segments.
+
+    Learning again with one more column in the belief AE matrix (and
+    one more predicate in the segments) only adds effects, so a segment
+    that did not match or unify with the operator of a row before does
+    not now either. The searches can start from where they succeeded.
+    """
+    num_segments: int
+    # The first segment that can be the representative of each row.
+    rep_hints: List[int]
+    # The names of the option variables of each row.
+    option_var_names: List[Tuple[str, ...]]
+    # The first row whose PNAD can take each segment, or -1 if none. None
+    # if learning stopped before the segments were clustered.
+    segment_rows: Optional[np.ndarray]
+
+
 class BeliefSTRIPSLearner(BaseSTRIPSLearner):
-    """Base class for a clustering-based STRIPS learner."""
+    """Base class for a clustering-based STRIPS learner.
+
+    If the belief has a "partition_hint", the BeliefPartition of a
+    previous call with the same segments and the same belief without its
+    last column, the searches start from there. The BeliefPartition of
+    this call is stored in the belief as "partition".
+    """
 
     def _learn(self) -> List[PNAD]:
         num_sample_in = 0
         num_sample_out = 0
         segments = [seg for segs in self._segmented_trajs for seg in segs]
+        hint: Optional[BeliefPartition] = self._belief.get("partition_hint")
+        if hint is not None and hint.num_segments != len(segments):
+            hint = None
         # Cluster the segments according to common option and effects.
-        pnads, added_segment_idxs = self._belief2pnads_init(segments)
+        pnads, added_segment_idxs, rep_hints = self._belief2pnads_init(
+            segments, None if hint is None else hint.rep_hints)
+        option_var_names = [
+            tuple(v.name for v in pnad.option_spec[1]) if pnad.option_spec
+            else () for pnad in pnads
+        ]
+        self._belief["partition"] = BeliefPartition(len(segments), rep_hints,
+                                                    option_var_names, None)
         filtered_pnads = []
         for pnad in pnads:
             # Try to unify this transition with existing effects.
@@ -35,10 +74,24 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
                 logging.info(f"PNAD {pnad.op.name} has no samples. Learning Op failed.")
                 return []
 
+        # The rows before these did not unify with the segments before, so
+        # they do not now either, as long as the option specs are the same.
+        first_rows = None
+        if hint is not None and hint.segment_rows is not None and \
+            hint.option_var_names == option_var_names:
+            first_rows = hint.segment_rows
+        # The representatives stay 0, since their rows were not searched.
+        segment_rows = np.zeros(len(segments), dtype=np.int64)
         for ids, segment in enumerate(segments):
             if ids in added_segment_idxs:
                 # this segment has been added to a PNAD
                 continue
+            first_row = 0 if first_rows is None else first_rows[ids]
+            if first_row == -1:
+                # the sample did not fit any PNAD before
+                segment_rows[ids] = -1
+                num_sample_out += 1
+                continue
             if segment.has_option():
                 segment_option = segment.get_option()
                 segment_param_option = segment_option.parent
@@ -46,7 +99,9 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
             else:
                 segment_param_option = DummyOption.parent
                 segment_option_objs = tuple()
-            for pnad in filtered_pnads:
+            suc = False
+            for row in range(first_row, len(filtered_pnads)):
+                pnad = filtered_pnads[row]
                 # Try to unify this transition with existing effects.
                 # Note that both add and delete effects must unify,
                 # and also the objects that are arguments to the options.
@@ -69,11 +124,16 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
                     # Add to this PNAD.
                     assert set(sub.keys()) == set(pnad.op.parameters)
                     pnad.add_to_datastore((segment, sub))
+                    segment_rows[ids] = row
                     num_sample_in += 1
                     break
             if not suc:
                 # the sample does not fit any existing PNAD
+                segment_rows[ids] = -1
                 num_sample_out += 1
+        self._belief["partition"] = BeliefPartition(len(segments), rep_hints,
+                                                    option_var_names,
+                                                    segment_rows)
         logging.info(f"Number of samples in: {num_sample_in}, Specifically:")
         for pnad in filtered_pnads:
             logging.info(f"Number of samples in for {pnad.op.name}: {len(pnad.datastore)}")
@@ -234,9 +294,17 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
         # No valid mapping found after exhausting all possibilities.
         return False, {}, {}
 
-    def _belief2pnads_init(self, segments: List) -> List[PNAD]:
+    def _belief2pnads_init(
+        self,
+        segments: List,
+        rep_hints: Optional[List[int]] = None
+    ) -> Tuple[List[PNAD], List[int], List[int]]:
         """Initialize the PNADs with the belief that each segment is a new
-        operator."""
+        operator.
+
+        The search for the representative segment of row i starts at
+        rep_hints[i], if given. Also return the hints for the next call.
+        """
         pnads: List[PNAD] = []
         assert self._belief, "Belief must be set before calling this method."
         row_names = self._belief["row_names"]
@@ -245,6 +313,7 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
         ae_matrix = self._belief["ae_matrix"]
         logging.info(f"Constructing PNADs from belief AE matrix Tgt.")
         added_segment_idxs = []
+        new_rep_hints = []
         for i, option in enumerate(row_names):
             logging.info(f"Constructing PNAD for Row {i}, option {option}.")
             params = utils.create_new_variables(
@@ -276,7 +345,12 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
             # Find a segment that has the same option and effect
             datastore: List = []
             option_spec: Tuple = ()
-            for ids, segment in enumerate(segments):
+            # The segments skipped only because their effects have too few
+            # objects may match once there are more effect predicates.
+            rep_hint = len(segments)
+            start = 0 if rep_hints is None else rep_hints[i]
+            for ids in range(start, len(segments)):
+                segment = segments[ids]
                 if segment.has_option():
                     segment_option = segment.get_option()
                     segment_param_option = segment_option.parent
@@ -296,12 +370,14 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
                     if len(effect_objects) != len(params):
                         # this can't be the right segment
                         # as the effects involves more objects not operated
+                        rep_hint = min(rep_hint, ids)
                         continue
                     succ, obj_to_var, var_to_obj = \
                             self._match_objs2vars(objects_lst, params, \
                                         add_effects, delete_effects, \
                                         segment)
                     if succ:
+                        rep_hint = min(rep_hint, ids)
                         datastore.append((segment, var_to_obj))
                         option_vars = [obj_to_var[o] for o in segment_option_objs]
                         option_spec = (segment_param_option, option_vars)
@@ -309,7 +385,8 @@ class BeliefSTRIPSLearner(BaseSTRIPSLearner):
                         added_segment_idxs.append(ids)
                         break
             pnads.append(PNAD(op, datastore, option_spec))
-        return pnads, added_segment_idxs
+            new_rep_hints.append(rep_hint)
+        return pnads, added_segment_idxs, new_rep_hints
 
 
 
@@ -7,7 +7,8 @@ option in the environment.
 from __future__ import annotations
 
 import abc
-from typing import Callable, Set, Tuple
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Set, Tuple
 
 import numpy as np
 
@@ -15,12 +16,15 @@ from predicators import utils
 from predicators.envs import create_new_env
 from predicators.ground_truth_models import get_gt_options
 from predicators.settings import CFG
-from predicators.structs import Action, DefaultState, ParameterizedOption, \
-    State, _Option
+from predicators.structs import Action, DefaultState, Metrics, \
+    ParameterizedOption, State, _Option
 
 
 def create_option_model(name: str) -> _OptionModelBase:
     """Create an option model given its name."""
+    if name.startswith("cached_"):
+        # E.g., "cached_oracle" memoizes the "oracle" option model.
+        return _CachedOptionModel(create_option_model(name[len("cached_"):]))
     if name == "oracle":
         env = create_new_env(CFG.env,
                              do_cache=False,
@@ -51,6 +55,10 @@ class _OptionModelBase(abc.ABC):
         """
         raise NotImplementedError("Override me!")
 
+    def record_cache_stats(self, metrics: Metrics) -> None:
+        """Count the hits and misses of this option model's cache (if any)
+        in the given metrics from now on."""
+
 
 class _OracleOptionModel(_OptionModelBase):
     """An oracle option model that uses the ground truth simulator.
@@ -129,3 +137,82 @@ class _OracleOptionModel(_OptionModelBase):
         # since we are not actually rolling out the option in the full
         # simulator, but that's okay; it leads to optimistic planning.
         return traj.states[-1], len(traj.actions)
+
+
+class _CachedOptionModel(_OptionModelBase):
+    """Memoizes another option model's predictions.
+
+    Predictions are keyed on the option's name, objects and parameters and
+    on a fingerprint of the state (its features and, if it is array-like,
+    its simulator state, e.g. the joint positions of a PyBulletState), with
+    all values rounded to CFG.option_model_cache_decimals decimals. States
+    with any other simulator state are never cached. A prediction is only
+    reused for the same ParameterizedOption object, since learned options
+    keep their names when they are learned again. At most
+    CFG.option_model_cache_size predictions are kept, evicting the least
+    recently used; this bounds the number of states held, not their size
+    in bytes.
+    """
+
+    def __init__(self, option_model: _OptionModelBase) -> None:
+        super().__init__()
+        self._option_model = option_model
+        # Maps keys to (parameterized option, next state, number of
+        # actions). The next state is None if the option was a noop, in
+        # which case the next state is the given state.
+        self._cache: OrderedDict[Hashable,
+                                 Tuple[ParameterizedOption, Optional[State],
+                                       int]] = OrderedDict()
+        self._metrics: Optional[Metrics] = None
+
+    def record_cache_stats(self, metrics: Metrics) -> None:
+        self._metrics = metrics
+        self._option_model.record_cache_stats(metrics)
+
+    def get_next_state_and_num_actions(self, state: State,
+                                       option: _Option) -> Tuple[State, int]:
+        key = self._get_key(state, option)
+        # Options are equal by name, so check that the prediction is not from
+        # an older option with the same name.
+        if key is not None and key in self._cache and \
+                self._cache[key][0] is option.parent:
+            self._cache.move_to_end(key)
+            if self._metrics is not None:
+                self._metrics["num_option_model_cache_hits"] += 1
+            _, next_state, num_actions = self._cache[key]
+            if next_state is None:
+                return state, num_actions
+            return next_state.copy(), num_actions
+        if self._metrics is not None:
+            self._metrics["num_option_model_cache_misses"] += 1
+        next_state, num_actions = \
+            self._option_model.get_next_state_and_num_actions(state, option)
+        if key is not None and CFG.option_model_cache_size > 0:
+            self._cache[key] = (option.parent, None if next_state is state
+                                else next_state.copy(), num_actions)
+            self._cache.move_to_end(key)
+            if len(self._cache) > CFG.option_model_cache_size:
+                self._cache.popitem(last=False)
+        return next_state, num_actions
+
+    @staticmethod
+    def _get_key(state: State, option: _Option) -> Optional[Hashable]:
+        decimals = CFG.option_model_cache_decimals
+        try:
+            features = tuple(
+                (obj, np.round(np.asarray(state[obj], dtype=np.float64),
+                               decimals).tobytes()) for obj in state)
+            simulator_state = None
+            if state.simulator_state is not None:
+                simulator_array = np.round(
+                    np.asarray(state.simulator_state, dtype=np.float64),
+                    decimals)
+                simulator_state = (simulator_array.shape,
+                                   simulator_array.tobytes())
+        except (TypeError, ValueError):
+            # Some feature or the simulator state is not numeric.
+            return None
+        params = np.round(np.asarray(option.params, dtype=np.float64),
+                          decimals).tobytes()
+        return (option.name, tuple(option.objects), params, features,
+                simulator_state)
@@ -5,8 +5,11 @@ Mainly, "SeSamE": SEarch-and-SAMple planning, then Execution.
 
 from __future__ import annotations
 
+import functools
 import heapq as hq
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import re
 import subprocess
@@ -16,8 +19,9 @@ import time
 from collections import defaultdict
 from dataclasses import dataclass
 from itertools import islice
-from typing import Any, Collection, Dict, FrozenSet, Iterator, List, \
-    Optional, Sequence, Set, Tuple
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Collection, Dict, FrozenSet, Hashable, \
+    Iterator, List, Optional, Sequence, Set, Tuple, Union, cast
 
 import numpy as np
 
@@ -28,7 +32,7 @@ from predicators.envs.pick_place import PickPlaceEnv
 from predicators.option_model import _OptionModelBase
 from predicators.refinement_estimators import BaseRefinementEstimator
 from predicators.settings import CFG
-from predicators.structs import NSRT, AbstractPolicy, DefaultState, \
+from predicators.structs import NSRT, AbstractPolicy, Array, DefaultState, \
     DummyOption, GroundAtom, Metrics, Object, OptionSpec, \
     ParameterizedOption, Predicate, State, STRIPSOperator, Task, Type, \
     _GroundNSRT, _GroundSTRIPSOperator, _Option
@@ -37,14 +41,57 @@ from predicators.utils import EnvironmentFailure, _TaskPlanningHeuristic
 _NOT_CAUSES_FAILURE = "NotCausesFailure"
 
 
-@dataclass(repr=False, eq=False)
 class _Node:
-    """A node for the search over skeletons."""
-    atoms: Set[GroundAtom]
-    skeleton: List[_GroundNSRT]
-    atoms_sequence: List[Set[GroundAtom]]  # expected state sequence
-    parent: Optional[_Node]
-    cumulative_cost: float
+    """A node for the search over skeletons.
+
+    To keep node creation constant-size in the plan depth, a node stores
+    only its parent and the last ground NSRT. The skeleton and expected
+    atoms sequence are rebuilt from the parent pointers on demand, which
+    only happens for goal nodes. The skeleton id uniquely identifies the
+    skeleton, so (parent skeleton id, last ground NSRT) can be used to
+    check for repeated skeletons without hashing the whole skeleton.
+    """
+    __slots__ = ("atoms", "skeleton_id", "parent", "last_nsrt",
+                 "cumulative_cost", "atoms_bits")
+
+    def __init__(self,
+                 atoms: Set[GroundAtom],
+                 skeleton_id: int,
+                 parent: Optional[_Node] = None,
+                 last_nsrt: Optional[_GroundNSRT] = None,
+                 cumulative_cost: float = 0.0,
+                 atoms_bits: Optional[int] = None) -> None:
+        self.atoms = atoms
+        self.skeleton_id = skeleton_id
+        self.parent = parent
+        self.last_nsrt = last_nsrt
+        self.cumulative_cost = cumulative_cost
+        # The atoms encoded as a bitset when CFG.sesame_use_bitset_states is
+        # True and they are all in the universe of the encoder, else None.
+        self.atoms_bits = atoms_bits
+
+    def _path_from_root(self) -> List[_Node]:
+        path = []
+        node: Optional[_Node] = self
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        return path[::-1]
+
+    @property
+    def skeleton(self) -> List[_GroundNSRT]:
+        """The sequence of ground NSRTs from the root to this node."""
+        skeleton = []
+        for node in self._path_from_root()[1:]:
+            assert node.last_nsrt is not None
+            skeleton.append(node.last_nsrt)
+        return skeleton
+
+    @property
+    def atoms_sequence(self) -> List[Set[GroundAtom]]:
+        """The expected state sequence from the root to this node."""
+        return [node.atoms for node in self._path_from_root()]
+
 
 @dataclass(repr=False, eq=False)
 class _NodeMDP:
@@ -85,6 +132,28 @@ def sesame_plan(
     only consider at most one skeleton, and DiscoveredFailures cannot be
     handled.
     """
+    try:
+        return _sesame_plan(task, option_model, nsrts, predicates, types,
+                            timeout, seed, task_planning_heuristic,
+                            max_skeletons_optimized, max_horizon,
+                            abstract_policy, max_policy_guided_rollout,
+                            refinement_estimator, check_dr_reachable,
+                            allow_noops, use_visited_state_set)
+    finally:
+        if CFG.sesame_profile and CFG.sesame_profile_trace_file is not None:
+            utils.PlanningProfiler.dump_trace(CFG.sesame_profile_trace_file)
+
+
+def _sesame_plan(
+    task: Task, option_model: _OptionModelBase, nsrts: Set[NSRT],
+    predicates: Set[Predicate], types: Set[Type], timeout: float, seed: int,
+    task_planning_heuristic: str, max_skeletons_optimized: int,
+    max_horizon: int, abstract_policy: Optional[AbstractPolicy],
+    max_policy_guided_rollout: int,
+    refinement_estimator: Optional[BaseRefinementEstimator],
+    check_dr_reachable: bool, allow_noops: bool, use_visited_state_set: bool
+) -> Tuple[List[_Option], List[_GroundNSRT], Metrics]:
+    """Helper for sesame_plan(); dispatch on CFG.sesame_task_planner."""
     if CFG.sesame_task_planner == "astar":
         return _sesame_plan_with_astar(
             task, option_model, nsrts, predicates, types, timeout, seed,
@@ -136,13 +205,17 @@ def _sesame_plan_with_astar(
     use_visited_state_set: bool = False
 ) -> Tuple[List[_Option], List[_GroundNSRT], Metrics]:
     """The default version of SeSamE, which runs A* to produce skeletons."""
-    init_atoms = utils.abstract(task.init, predicates)
+    metrics: Metrics = defaultdict(float)
+    profiler = utils.PlanningProfiler(metrics)
+    with profiler.phase("abstraction"):
+        init_atoms = utils.abstract(task.init, predicates)
     objects = list(task.init)
     start_time = time.perf_counter()
-    ground_nsrts = sesame_ground_nsrts(task, init_atoms, nsrts, objects,
-                                       predicates, types, start_time, timeout)
+    with profiler.phase("grounding"):
+        ground_nsrts = sesame_ground_nsrts(task, init_atoms, nsrts, objects,
+                                           predicates, types, start_time,
+                                           timeout)
     # Keep restarting the A* search while we get new discovered failures.
-    metrics: Metrics = defaultdict(float)
     # Make a copy of the predicates set to avoid modifying the input set,
     # since we may be adding NotCausesFailure predicates to the set.
     predicates = predicates.copy()
@@ -154,11 +227,13 @@ def _sesame_plan_with_astar(
         # the search significantly, so we may want to exclude them. Note however
         # that we need to do this inside the while True here, because an NSRT
         # that initially has empty effects may later have a _NOT_CAUSES_FAILURE.
-        reachable_nsrts = filter_nsrts(task, init_atoms, ground_nsrts,
-                                       check_dr_reachable, allow_noops)
-        heuristic = utils.create_task_planning_heuristic(
-            task_planning_heuristic, init_atoms, task.goal, reachable_nsrts,
-            predicates, objects)
+        with profiler.phase("reachability"):
+            reachable_nsrts = filter_nsrts(task, init_atoms, ground_nsrts,
+                                           check_dr_reachable, allow_noops)
+        with profiler.phase("heuristic_construction"):
+            heuristic = utils.create_task_planning_heuristic(
+                task_planning_heuristic, init_atoms, task.goal,
+                reachable_nsrts, predicates, objects)
         try:
             new_seed = seed + int(metrics["num_failures_discovered"])
             gen = _skeleton_generator(
@@ -182,21 +257,19 @@ def _sesame_plan_with_astar(
                     sorted(proposed_skeletons,
                            key=lambda s: estimator.get_cost(task, *s)))
             refinement_start_time = time.perf_counter()
-            for skeleton, atoms_sequence in gen:
-                if CFG.env == "spot_pickplace_stair" and \
-                    (not CFG.in_domain_test):
-                    # a hack to make real spot test safe (always pick the cloese stair)
-                    if skeleton[0].objects[1].name != 'stair0':
-                        continue
-                if CFG.sesame_use_necessary_atoms:
-                    atoms_seq = utils.compute_necessary_atoms_seq(
-                        skeleton, atoms_sequence, task.goal)
-                else:
-                    atoms_seq = atoms_sequence
-                plan, suc = run_low_level_search(
-                    task, option_model, skeleton, atoms_seq, new_seed,
-                    timeout - (time.perf_counter() - start_time), metrics,
+            # Daemonic processes (e.g., the test workers of main.py) cannot
+            # have children, so refine serially in them.
+            if CFG.sesame_num_parallel_refinements > 1 and \
+                    not multiprocessing.current_process().daemon:
+                refinements = _refine_skeletons_in_parallel(
+                    task, option_model, gen, init_atoms, nsrts,
+                    reachable_nsrts, new_seed, start_time, timeout, metrics,
                     max_horizon)
+            else:
+                refinements = _refine_skeletons_serially(
+                    task, option_model, gen, new_seed, start_time, timeout,
+                    metrics, max_horizon)
+            for skeleton, plan, suc in refinements:
                 if suc:
                     # Success! It's a complete plan.
                     logging.info(
@@ -212,20 +285,313 @@ def _sesame_plan_with_astar(
                     return plan, skeleton, metrics
                 partial_refinements.append((skeleton, plan))
                 if time.perf_counter() - start_time > timeout:
-                    raise PlanningTimeout(
-                        "Planning timed out in refinement!",
-                        info={"partial_refinements": partial_refinements})
+                    raise PlanningTimeout("Planning timed out in refinement!")
+        except PlanningTimeout as e:
+            # Parallel refinement reports the partial refinements that were
+            # still in flight when it timed out.
+            e.info["partial_refinements"] = partial_refinements + \
+                e.info.get("partial_refinements", [])
+            raise e
         except _DiscoveredFailureException as e:
             metrics["num_failures_discovered"] += 1
             new_predicates, ground_nsrts = _update_nsrts_with_failure(
                 e.discovered_failure, ground_nsrts)
             predicates |= new_predicates
             partial_refinements.append(
-                (skeleton, e.info["longest_failed_refinement"]))
+                (e.info["skeleton"], e.info["longest_failed_refinement"]))
         except (_MaxSkeletonsFailure, _SkeletonSearchTimeout) as e:
             e.info["partial_refinements"] = partial_refinements
             raise e
-        
+
+
+def _skip_skeleton(skeleton: List[_GroundNSRT]) -> bool:
+    """Helper for refining skeletons; whether to skip the given skeleton."""
+    # A hack to make the real spot test safe (always pick the closest stair).
+    return CFG.env == "spot_pickplace_stair" and not CFG.in_domain_test \
+        and skeleton[0].objects[1].name != 'stair0'
+
+
+def _refine_skeletons_serially(
+    task: Task, option_model: _OptionModelBase,
+    skeleton_generator: Iterator[Tuple[List[_GroundNSRT],
+                                       List[Set[GroundAtom]]]], seed: int,
+    start_time: float, timeout: float, metrics: Metrics, max_horizon: int
+) -> Iterator[Tuple[List[_GroundNSRT], List[_Option], bool]]:
+    """Helper for _sesame_plan_with_astar(); run low-level search on each
+    generated skeleton in turn, yielding (skeleton, plan, success).
+
+    A discovered failure is raised with the failing skeleton in its info.
+    """
+    for skeleton, atoms_sequence in skeleton_generator:
+        if _skip_skeleton(skeleton):
+            continue
+        if CFG.sesame_use_necessary_atoms:
+            atoms_seq = utils.compute_necessary_atoms_seq(
+                skeleton, atoms_sequence, task.goal)
+        else:
+            atoms_seq = atoms_sequence
+        try:
+            with utils.PlanningProfiler(metrics).phase("refinement"):
+                plan, suc = run_low_level_search(
+                    task, option_model, skeleton, atoms_seq, seed,
+                    timeout - (time.perf_counter() - start_time), metrics,
+                    max_horizon)
+        except _DiscoveredFailureException as e:
+            e.info["skeleton"] = skeleton
+            raise e
+        yield skeleton, plan, suc
+
+
+# A ground NSRT in a skeleton sent to a refinement worker, as the name of
+# its parent NSRT and its objects.
+_GroundNSRTKey = Tuple[str, Tuple[Object, ...]]
+
+
+def _get_ground_nsrt_key(ground_nsrt: _GroundNSRT) -> _GroundNSRTKey:
+    return ground_nsrt.parent.name, tuple(ground_nsrt.objects)
+
+
+@dataclass(frozen=True)
+class _ParallelRefinementContext:
+    """Everything that forked refinement workers inherit from the parent
+    process, so that it never needs to be pickled."""
+    task: Task
+    option_model: _OptionModelBase
+    init_atoms: Set[GroundAtom]
+    nsrts: Dict[str, NSRT]
+    ground_nsrts: Dict[_GroundNSRTKey, _GroundNSRT]
+    max_horizon: int
+
+    def get_ground_nsrt(self, key: _GroundNSRTKey) -> _GroundNSRT:
+        """Get the ground NSRT with the given key.
+
+        The abstract policy may yield ground NSRTs that are not in the
+        ground NSRTs given to the search, so those are ground again.
+        """
+        if key in self.ground_nsrts:
+            return self.ground_nsrts[key]
+        name, objects = key
+        return self.nsrts[name].ground(objects)
+
+
+# Set by _refine_skeletons_in_parallel() right before forking the workers.
+_PARALLEL_REFINEMENT_CONTEXT: Optional[_ParallelRefinementContext] = None
+
+# How long to wait for the partial plans of the refinements in flight after
+# parallel refinement times out, in seconds.
+_PARALLEL_REFINEMENT_TIMEOUT_GRACE = 1.0
+
+# The result of refining one skeleton in a worker: whether the refinement
+# succeeded, the sampled parameters of the (partial) plan, the position of
+# the failing ground NSRT in the skeleton and the environment failure if a
+# failure was discovered, the metrics of the low-level search, and the self
+# times of its stacks of profiled phases.
+_ParallelRefinementResult = Tuple[bool, List[Array], Optional[Tuple[
+    int, EnvironmentFailure]], Dict[str, float], Dict[str, float]]
+
+
+def _refine_skeleton_in_worker(skeleton_keys: List[_GroundNSRTKey],
+                               seed: int,
+                               timeout: float) -> _ParallelRefinementResult:
+    """Run low-level search on a skeleton of ground NSRT keys, using the
+    forked _PARALLEL_REFINEMENT_CONTEXT."""
+    context = _PARALLEL_REFINEMENT_CONTEXT
+    assert context is not None
+    skeleton = [context.get_ground_nsrt(key) for key in skeleton_keys]
+    # Recompute the expected atoms sequence rather than sending it, since
+    # atoms hold predicate classifiers that may not be picklable.
+    atoms_sequence = [context.init_atoms]
+    for nsrt in skeleton:
+        atoms_sequence.append(utils.apply_operator(nsrt, atoms_sequence[-1]))
+    if CFG.sesame_use_necessary_atoms:
+        atoms_sequence = utils.compute_necessary_atoms_seq(
+            skeleton, atoms_sequence, context.task.goal)
+    metrics: Metrics = defaultdict(float)
+    failure: Optional[Tuple[int, EnvironmentFailure]] = None
+    try:
+        with utils.PlanningProfiler(metrics).phase("refinement"):
+            plan, suc = run_low_level_search(context.task,
+                                             context.option_model, skeleton,
+                                             atoms_sequence, seed, timeout,
+                                             metrics, context.max_horizon)
+    except _DiscoveredFailureException as e:
+        plan, suc = e.info["longest_failed_refinement"], False
+        failing_nsrt = e.discovered_failure.failing_nsrt
+        failure = (skeleton.index(failing_nsrt),
+                   e.discovered_failure.env_failure)
+    # Options hold closures, so send back only their parameters. The parent
+    # dumps the trace of the profiled phases, including the worker's.
+    return suc, [option.params for option in plan], failure, dict(
+        metrics), utils.PlanningProfiler.pop_folded_self_times()
+
+
+def _run_refinement_worker(conn: Connection) -> None:
+    """Helper for _refine_skeletons_in_parallel(); in a forked worker,
+    refine the skeletons received on the given connection until killed,
+    sending back the result of each or the exception that it raised."""
+    # Forget the profiled phases recorded by the parent before forking,
+    # which the parent reports itself.
+    utils.PlanningProfiler.pop_folded_self_times()
+    while True:
+        args = conn.recv()
+        result: Union[_ParallelRefinementResult, Exception]
+        try:
+            result = _refine_skeleton_in_worker(*args)
+        except Exception as e:  # pylint: disable=broad-except
+            result = e
+        conn.send(result)
+
+
+def _refine_skeletons_in_parallel(
+    task: Task, option_model: _OptionModelBase,
+    skeleton_generator: Iterator[Tuple[List[_GroundNSRT],
+                                       List[Set[GroundAtom]]]],
+    init_atoms: Set[GroundAtom], nsrts: Set[NSRT],
+    ground_nsrts: List[_GroundNSRT], seed: int, start_time: float,
+    timeout: float, metrics: Metrics, max_horizon: int
+) -> Iterator[Tuple[List[_GroundNSRT], List[_Option], bool]]:
+    """Helper for _sesame_plan_with_astar(); keep the next
+    CFG.sesame_num_parallel_refinements generated skeletons in flight in
+    forked workers, yielding (skeleton, plan, success) in order of
+    completion.
+
+    The i-th generated skeleton is refined with seed + i. A discovered
+    failure is raised with the failing skeleton in its info, like in the
+    serial case. Closing this generator (e.g., after the first success)
+    kills the workers, which cancels the refinements still in flight.
+    On a timeout, the partial plans of the refinements in flight are
+    reported in the info of the PlanningTimeout.
+    """
+    global _PARALLEL_REFINEMENT_CONTEXT  # pylint: disable=global-statement
+    _PARALLEL_REFINEMENT_CONTEXT = _ParallelRefinementContext(
+        task, option_model, init_atoms, {nsrt.name: nsrt
+                                         for nsrt in nsrts},
+        {_get_ground_nsrt_key(n): n
+         for n in ground_nsrts}, max_horizon)
+    # Fork explicitly, because main.py sets the default start method to
+    # spawn, and spawned workers would not inherit the context. Each worker
+    # has its own pipe rather than sharing a pool's queues, so that killing
+    # a worker in the middle of a refinement never leaves a lock held.
+    ctx = multiprocessing.get_context("fork")
+    workers: List[multiprocessing.process.BaseProcess] = []
+    idle_conns: List[Connection] = []
+    # Maps the connection of each busy worker to its skeleton number.
+    busy_conns: Dict[Connection, int] = {}
+    skeletons: List[List[_GroundNSRT]] = []
+    generator_failure: Optional[PlanningFailure] = None
+    try:
+        while True:
+            # Keep the workers busy while the skeleton generator lasts.
+            while generator_failure is None and \
+                    len(busy_conns) < CFG.sesame_num_parallel_refinements:
+                try:
+                    skeleton, _ = next(skeleton_generator)
+                except (_MaxSkeletonsFailure, _SkeletonSearchTimeout) as e:
+                    generator_failure = e
+                    break
+                if _skip_skeleton(skeleton):
+                    continue
+                if not idle_conns:
+                    conn, worker_conn = ctx.Pipe()
+                    worker = ctx.Process(target=_run_refinement_worker,
+                                         args=(worker_conn, ),
+                                         daemon=True)
+                    worker.start()
+                    worker_conn.close()
+                    workers.append(worker)
+                    idle_conns.append(conn)
+                conn = idle_conns.pop()
+                skeleton_num = len(skeletons)
+                skeletons.append(skeleton)
+                conn.send(([_get_ground_nsrt_key(n) for n in skeleton],
+                           seed + skeleton_num,
+                           timeout - (time.perf_counter() - start_time)))
+                busy_conns[conn] = skeleton_num
+            if not busy_conns:
+                assert generator_failure is not None
+                raise generator_failure
+            remaining_time = timeout - (time.perf_counter() - start_time)
+            ready = multiprocessing.connection.wait(
+                list(busy_conns), timeout=max(remaining_time, 0.0))
+            if not ready:
+                # The refinements in flight time out on their own at about
+                # the same time, so wait briefly for their partial plans.
+                raise PlanningTimeout(
+                    "Planning timed out in refinement!",
+                    info={
+                        "partial_refinements":
+                        _get_in_flight_partial_refinements(
+                            busy_conns, skeletons)
+                    })
+            conn = ready[0]
+            assert isinstance(conn, Connection)
+            skeleton_num = busy_conns.pop(conn)
+            result = conn.recv()
+            idle_conns.append(conn)
+            if isinstance(result, BaseException):
+                raise result
+            skeleton = skeletons[skeleton_num]
+            suc, plan_params, failure, worker_metrics, folded_self_times = \
+                result
+            for key, value in worker_metrics.items():
+                metrics[key] += value
+            utils.PlanningProfiler.add_folded_self_times(folded_self_times)
+            plan = _ground_plan_params(skeleton, plan_params)
+            if failure is not None:
+                failing_nsrt_pos, env_failure = failure
+                raise _DiscoveredFailureException(
+                    "Discovered a failure",
+                    _DiscoveredFailure(env_failure,
+                                       skeleton[failing_nsrt_pos]), {
+                                           "longest_failed_refinement": plan,
+                                           "skeleton": skeleton
+                                       })
+            yield skeleton, plan, suc
+    finally:
+        for worker in workers:
+            worker.kill()
+            worker.join()
+        for conn in idle_conns + list(busy_conns):
+            conn.close()
+        _PARALLEL_REFINEMENT_CONTEXT = None
+
+
+def _ground_plan_params(skeleton: List[_GroundNSRT],
+                        plan_params: List[Array]) -> List[_Option]:
+    """Helper for _refine_skeletons_in_parallel(); ground the options of a
+    plan from the parameters sent back by a worker."""
+    return [
+        nsrt.option.ground(nsrt.option_objs, params)
+        for nsrt, params in zip(skeleton, plan_params)
+    ]
+
+
+def _get_in_flight_partial_refinements(
+    busy_conns: Dict[Connection, int], skeletons: List[List[_GroundNSRT]]
+) -> List[Tuple[List[_GroundNSRT], List[_Option]]]:
+    """Helper for _refine_skeletons_in_parallel(); collect the (skeleton,
+    partial plan) of the refinements in flight that finish within
+    _PARALLEL_REFINEMENT_TIMEOUT_GRACE seconds."""
+    partial_refinements = []
+    pending = dict(busy_conns)
+    end_time = time.perf_counter() + _PARALLEL_REFINEMENT_TIMEOUT_GRACE
+    while pending:
+        ready = multiprocessing.connection.wait(
+            list(pending), timeout=max(end_time - time.perf_counter(), 0.0))
+        if not ready:
+            break
+        for conn in ready:
+            assert isinstance(conn, Connection)
+            skeleton = skeletons[pending.pop(conn)]
+            result = conn.recv()
+            if isinstance(result, BaseException):
+                continue
+            utils.PlanningProfiler.add_folded_self_times(result[4])
+            partial_refinements.append(
+                (skeleton, _ground_plan_params(skeleton, result[1])))
+    return partial_refinements
+
+
 def _sesame_plan_for_mdp(
     task: Task,
     option_model: _OptionModelBase,
@@ -550,20 +916,37 @@ def _skeleton_generator(
     start_time = time.perf_counter()
     current_objects = set(task.init)
     queue: List[Tuple[float, float, _Node]] = []
+    heuristic.record_cache_stats(metrics)
+    profiler = utils.PlanningProfiler(metrics)
+    # Optionally compile the abstract states into bitsets, so that goal
+    # checks, applicability checks, and successor generation avoid hashing
+    # GroundAtoms. The atoms themselves are decoded only for the heuristic.
+    bitset_task: Optional[utils.BitsetAbstractTask] = None
+    if CFG.sesame_use_bitset_states:
+        bitset_task = utils.BitsetAbstractTask(init_atoms, task.goal,
+                                               ground_nsrts)
+    # Index the preconditions once so that each expansion only considers
+    # operators that watch atoms that are true. In bitset mode, this is only
+    # needed for the nodes whose atoms can't be encoded, so it is built on
+    # first use.
+    @functools.lru_cache(maxsize=None)
+    def _get_successor_generator() -> utils.SuccessorGenerator:
+        return utils.SuccessorGenerator(ground_nsrts)
+
     root_node = _Node(atoms=init_atoms,
-                      skeleton=[],
-                      atoms_sequence=[init_atoms],
-                      parent=None,
-                      cumulative_cost=0)
+                      skeleton_id=0,
+                      atoms_bits=(bitset_task.init
+                                  if bitset_task is not None else None))
     metrics["num_nodes_created"] += 1
     rng_prio = np.random.default_rng(seed)
-    hq.heappush(queue,
-                (heuristic(root_node.atoms), rng_prio.uniform(), root_node))
-    # Initialize with empty skeleton for root.
+    with profiler.phase("heuristic_evaluation"):
+        root_h = heuristic(root_node.atoms)
+    hq.heappush(queue, (root_h, rng_prio.uniform(), root_node))
     # We want to keep track of the visited skeletons so that we avoid
-    # repeatedly outputting the same faulty skeletons.
-    visited_skeletons: Set[Tuple[_GroundNSRT, ...]] = set()
-    visited_skeletons.add(tuple(root_node.skeleton))
+    # repeatedly outputting the same faulty skeletons. Each non-empty
+    # skeleton is stored as (id of its prefix, its last ground NSRT), and
+    # skeleton ids are assigned in order of insertion into this set.
+    visited_skeletons: Set[Tuple[int, _GroundNSRT]] = set()
     if use_visited_state_set:
         # This set will maintain (frozen) atom sets that have been fully
         # expanded already, and ensure that we never expand redundantly.
@@ -575,14 +958,14 @@ def _skeleton_generator(
                 "Planning reached max_skeletons_optimized!")
         _, _, node = hq.heappop(queue)
         if use_visited_state_set:
-            frozen_atoms = frozenset(node.atoms)
-            visited_atom_sets.add(frozen_atoms)
+            visited_atom_sets.add(
+                _get_visited_state_key(node.atoms, node.atoms_bits))
         # Good debug point #1: print out the skeleton here to see what
         # the high-level search is doing. You can accomplish this via:
         # for act in node.skeleton:
         #     logging.info(f"{act.name} {act.objects}")
         # logging.info("")
-        if task.goal.issubset(node.atoms):
+        if _goal_holds(task, node, bitset_task):
             # If this skeleton satisfies the goal, yield it.
             metrics["num_skeletons_optimized"] += 1
             yield node.skeleton, node.atoms_sequence
@@ -607,11 +990,11 @@ def _skeleton_generator(
                         break
                     child_atoms = utils.apply_operator(ground_nsrt,
                                                        set(current_node.atoms))
-                    child_skeleton = current_node.skeleton + [ground_nsrt]
-                    child_skeleton_tup = tuple(child_skeleton)
-                    if child_skeleton_tup in visited_skeletons:
+                    child_skeleton_key = (current_node.skeleton_id,
+                                          ground_nsrt)
+                    if child_skeleton_key in visited_skeletons:
                         continue
-                    visited_skeletons.add(child_skeleton_tup)
+                    visited_skeletons.add(child_skeleton_key)
                     # Note: the cost of taking a policy-generated action is 1,
                     # but the policy-generated skeleton is immediately yielded
                     # once it reaches a goal. This allows the planner to always
@@ -622,45 +1005,53 @@ def _skeleton_generator(
                     child_cost = 1 + current_node.cumulative_cost
                     child_node = _Node(
                         atoms=child_atoms,
-                        skeleton=child_skeleton,
-                        atoms_sequence=current_node.atoms_sequence +
-                        [child_atoms],
+                        skeleton_id=len(visited_skeletons),
                         parent=current_node,
-                        cumulative_cost=child_cost)
+                        last_nsrt=ground_nsrt,
+                        cumulative_cost=child_cost,
+                        # The policy may apply ground NSRTs that are not in
+                        # ground_nsrts, so the child may not be encodable.
+                        atoms_bits=(bitset_task.encoder.try_encode(child_atoms)
+                                    if bitset_task is not None else None))
                     metrics["num_nodes_created"] += 1
                     # priority is g [cost] plus h [heuristic]
-                    priority = (child_node.cumulative_cost +
-                                heuristic(child_node.atoms))
+                    with profiler.phase("heuristic_evaluation"):
+                        child_h = heuristic(child_node.atoms)
+                    priority = child_node.cumulative_cost + child_h
                     hq.heappush(queue,
                                 (priority, rng_prio.uniform(), child_node))
                     current_node = child_node
                     if time.perf_counter() - start_time >= timeout:
                         break
             # Generate primitive successors.
-            for nsrt in utils.get_applicable_operators(ground_nsrts,
-                                                       node.atoms):
-                child_atoms = utils.apply_operator(nsrt, set(node.atoms))
-                if use_visited_state_set:
-                    frozen_atoms = frozenset(child_atoms)
-                    if frozen_atoms in visited_atom_sets:
-                        continue
-                child_skeleton = node.skeleton + [nsrt]
-                child_skeleton_tup = tuple(child_skeleton)
-                if child_skeleton_tup in visited_skeletons:  # pragma: no cover
+            successors = _get_primitive_successors(node,
+                                                   _get_successor_generator,
+                                                   bitset_task)
+            for nsrt, child_atoms, child_bits in profiler.iterate(
+                    "successor_generation", successors):
+                if use_visited_state_set and _get_visited_state_key(
+                        child_atoms, child_bits) in visited_atom_sets:
+                    continue
+                if child_atoms is None:
+                    assert bitset_task is not None and child_bits is not None
+                    child_atoms = bitset_task.encoder.decode(child_bits)
+                child_skeleton_key = (node.skeleton_id, nsrt)
+                if child_skeleton_key in visited_skeletons:  # pragma: no cover
                     continue
-                visited_skeletons.add(child_skeleton_tup)
+                visited_skeletons.add(child_skeleton_key)
                 # Action costs are unitary.
                 child_cost = node.cumulative_cost + 1.0
                 child_node = _Node(atoms=child_atoms,
-                                   skeleton=child_skeleton,
-                                   atoms_sequence=node.atoms_sequence +
-                                   [child_atoms],
+                                   skeleton_id=len(visited_skeletons),
                                    parent=node,
-                                   cumulative_cost=child_cost)
+                                   last_nsrt=nsrt,
+                                   cumulative_cost=child_cost,
+                                   atoms_bits=child_bits)
                 metrics["num_nodes_created"] += 1
                 # priority is g [cost] plus h [heuristic]
-                priority = (child_node.cumulative_cost +
-                            heuristic(child_node.atoms))
+                with profiler.phase("heuristic_evaluation"):
+                    child_h = heuristic(child_node.atoms)
+                priority = child_node.cumulative_cost + child_h
                 hq.heappush(queue, (priority, rng_prio.uniform(), child_node))
                 if time.perf_counter() - start_time >= timeout:
                     break
@@ -669,6 +1060,58 @@ def _skeleton_generator(
     assert time.perf_counter() - start_time >= timeout
     raise _SkeletonSearchTimeout
 
+
+def _goal_holds(task: Task, node: _Node,
+                bitset_task: Optional[utils.BitsetAbstractTask]) -> bool:
+    """Helper for _skeleton_generator(); check whether the goal holds in the
+    atoms of the node."""
+    if node.atoms_bits is not None:
+        assert bitset_task is not None
+        return bitset_task.goal_holds(node.atoms_bits)
+    return task.goal.issubset(node.atoms)
+
+
+def _get_primitive_successors(
+    node: _Node, get_successor_generator: Callable[[],
+                                                   utils.SuccessorGenerator],
+    bitset_task: Optional[utils.BitsetAbstractTask]
+) -> Iterator[Tuple[_GroundNSRT, Optional[Set[GroundAtom]], Optional[int]]]:
+    """Helper for _skeleton_generator(); iterate over (ground NSRT, child
+    atoms, child atoms bitset) for each applicable ground NSRT.
+
+    If the atoms of the node are encoded, so are those of the children,
+    which are left as None so that the caller can decode them only if
+    the child is not pruned. Otherwise, the children are generated from
+    the atoms, and encoded if possible in bitset mode.
+    """
+    if node.atoms_bits is not None:
+        assert bitset_task is not None
+        for op, child_bits in bitset_task.get_successors(node.atoms_bits):
+            yield cast(_GroundNSRT, op), None, child_bits
+        return
+    for op in get_successor_generator().get_applicable_operators(node.atoms):
+        nsrt = cast(_GroundNSRT, op)
+        child_atoms = utils.apply_operator(nsrt, set(node.atoms))
+        child_bits = (bitset_task.encoder.try_encode(child_atoms)
+                      if bitset_task is not None else None)
+        yield nsrt, child_atoms, child_bits
+
+
+def _get_visited_state_key(atoms: Optional[Set[GroundAtom]],
+                           atoms_bits: Optional[int]) -> Hashable:
+    """Helper for _skeleton_generator(); get the key under which abstract
+    states are stored in the visited state set.
+
+    Atoms are only left unencoded in bitset mode if some of them are
+    outside the universe of the encoder, so the two kinds of keys never
+    describe the same atoms.
+    """
+    if atoms_bits is not None:
+        return atoms_bits
+    assert atoms is not None
+    return frozenset(atoms)
+
+
 def _skeleton_generator_with_graph(
     task: Task,
     ground_nsrts: List[_GroundNSRT],
@@ -698,6 +1141,7 @@ def _skeleton_generator_with_graph(
     start_time = time.perf_counter()
     current_objects = set(task.init)
     queue: List[Tuple[float, float, _NodeMDP]] = []
+    heuristic.record_cache_stats(metrics)
     root_node = _NodeMDP(atoms=init_atoms,
                       skeleton_op=[],
                       skeleton_nd=[],
@@ -712,6 +1156,7 @@ def _skeleton_generator_with_graph(
     visited_skeletons.add(tuple(root_node.skeleton_op))
     if use_visited_state_set:
         visited_atom_sets = set()
+    successor_generator = utils.SuccessorGenerator(ground_nsrts)
 
     # All nodes will now include parent node ID and transition reward for each child
     all_par_nodes = {id(root_node): {}}
@@ -738,7 +1183,8 @@ def _skeleton_generator_with_graph(
         else:
             metrics["num_nodes_expanded"] += 1
 
-            for nsrt in utils.get_applicable_operators(ground_nsrts, node.atoms):
+            for nsrt in utils.get_applicable_operators(successor_generator,
+                                                       node.atoms):
                 child_atoms = utils.apply_operator(nsrt, set(node.atoms))
                 if use_visited_state_set:
                     frozen_atoms = frozenset(child_atoms)
@@ -812,6 +1258,7 @@ def run_low_level_search_reward(
     """
     start_time = time.perf_counter()
     rng_sampler = np.random.default_rng(ll_seed)
+    option_model.record_cache_stats(metrics)
     assert CFG.sesame_propagate_failures in \
         {"after_exhaust", "immediately", "never"}
     # santity checks
@@ -1041,6 +1488,8 @@ def run_low_level_search(
     # timeout=1000 # debug
     start_time = time.perf_counter()
     rng_sampler = np.random.default_rng(seed)
+    option_model.record_cache_stats(metrics)
+    profiler = utils.PlanningProfiler(metrics)
     assert CFG.sesame_propagate_failures in \
         {"after_exhaust", "immediately", "never"}
     cur_idx = 0
@@ -1087,7 +1536,8 @@ def run_low_level_search(
         # Ground the NSRT's ParameterizedOption into an _Option.
         # This invokes the NSRT's sampler.
         # logging.info(f"{cur_idx}-th NSRT: {nsrt.name}, {num_tries[cur_idx]} times")
-        option = nsrt.sample_option(state, task.goal, rng_sampler)
+        with profiler.phase("sampler"):
+            option = nsrt.sample_option(state, task.goal, rng_sampler)
         plan[cur_idx] = option
         # Increment num_samples metric by 1
         metrics["num_samples"] += 1
@@ -1095,8 +1545,10 @@ def run_low_level_search(
         cur_idx += 1
         if option.initiable(state):
             try:
-                next_state, num_actions = \
-                    option_model.get_next_state_and_num_actions(state, option)
+                with profiler.phase("option_model"):
+                    next_state, num_actions = \
+                        option_model.get_next_state_and_num_actions(
+                            state, option)
             except EnvironmentFailure as e:
                 can_continue_on = False
                 # Remember only the most recent failure.
@@ -1143,7 +1595,10 @@ def run_low_level_search(
                     # This "if all" statement is equivalent to, but faster
                     # than, checking whether expected_atoms is a subset of
                     # utils.abstract(traj[cur_idx], predicates).
-                    if all(a.holds(traj[cur_idx]) for a in expected_atoms):
+                    with profiler.phase("expected_atoms_check"):
+                        expected_atoms_hold = all(
+                            a.holds(traj[cur_idx]) for a in expected_atoms)
+                    if expected_atoms_hold:
                         can_continue_on = True
                         if cur_idx == len(skeleton):
                             plan_found = True
@@ -1185,6 +1640,7 @@ def run_low_level_search(
             cur_idx -= 1
             assert cur_idx >= 0
             while num_tries[cur_idx] == max_tries[cur_idx]:
+                profiler.count("backtracking")
                 num_tries[cur_idx] = 0
                 plan[cur_idx] = DummyOption
                 num_actions_per_option[cur_idx] = 0
@@ -1641,6 +2097,7 @@ def task_plan_with_option_plan_constraint(
     heuristic = utils.create_task_planning_heuristic(
         CFG.sesame_task_planning_heuristic, init_atoms, goal, ground_nsrts,
         predicates, objects)
+    successor_generator = utils.SuccessorGenerator(ground_nsrts)
 
     def _check_goal(
             searchnode_state: Tuple[FrozenSet[GroundAtom], int]) -> bool:
@@ -1659,7 +2116,7 @@ def task_plan_with_option_plan_constraint(
         gt_param_option = option_plan[idx_into_traj][0]
         gt_objects = option_plan[idx_into_traj][1]
         for applicable_nsrt in utils.get_applicable_operators(
-                ground_nsrts, atoms):
+                successor_generator, atoms):
             # NOTE: we check that the ParameterizedOptions are equal before
             # attempting to ground because otherwise, we might
             # get a parameter mismatch and trigger an AssertionError
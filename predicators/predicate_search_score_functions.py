@@ -7,19 +7,21 @@ import logging
 import re
 import time
 from dataclasses import dataclass, field
-from typing import Callable, Collection, Dict, FrozenSet, List, Sequence, \
-    Set, Tuple, Optional
+from typing import Any, Callable, Collection, Dict, FrozenSet, Hashable, \
+    List, Sequence, Set, Tuple, Optional
 
 import numpy as np
 
 from predicators import utils
 from predicators.nsrt_learning.segmentation import segment_trajectory
 from predicators.nsrt_learning.strips_learning import learn_strips_operators
+from predicators.nsrt_learning.strips_learning.belief_learner import \
+    BeliefPartition
 from predicators.planning import PlanningFailure, PlanningTimeout, task_plan, \
     task_plan_grounding
 from predicators.settings import CFG
 from predicators.structs import GroundAtom, GroundAtomTrajectory, \
-    LowLevelTrajectory, Object, OptionSpec, Predicate, Segment, \
+    LowLevelTrajectory, Object, OptionSpec, PNAD, Predicate, Segment, \
     STRIPSOperator, Task, _GroundSTRIPSOperator, ParameterizedOption
 
 
@@ -125,26 +127,48 @@ class _OperatorBeliefScoreFunction(abc.ABC):
     _train_tasks: List[Task]  # all of the train tasks
     _row_names: List[ParameterizedOption] # all of the option names
     metric_name: str # num_nodes_created or num_nodes_expanded
+    # The data segmented once with all the predicates, see
+    # _get_segmented_trajs().
+    _segmentation_cache: List[Tuple[List[Segment], List[Dict[
+        Predicate, Set[GroundAtom]]]]] = field(init=False,
+                                               default_factory=list)
+    # The BeliefPartition of each candidate evaluated since the last call
+    # to retain_belief_partition(), see get_belief_partition().
+    _partition_cache: Dict[Hashable, BeliefPartition] = field(
+        init=False, default_factory=dict)
 
     def evaluate(self, candidate_ae_matrix: np.ndarray, \
                 candidate_predicates: List[Predicate], \
                 predicates_ent_idx: List[List[int]], \
                 strips_learner: str) -> float:
+        """Score a candidate AE matrix with its column predicates (followed
+        by the precondition-only predicates) and their entity indices.
+
+        Search adds one column at a time, so the belief STRIPS learners
+        start from the partition of the candidate without the last
+        column, if it was evaluated (or set with set_belief_partition())
+        and the segmentation does not depend on the predicates.
+        """
         total_cost = len(candidate_predicates)
         logging.info(f"Evaluating predicates: {candidate_predicates}, with "
                         f"total cost {total_cost}")
         assert candidate_ae_matrix.shape[0] == len(self._row_names)
         # assert candidate_ae_matrix.shape[1] == len(candidate_predicates)
         start_time = time.perf_counter()
-        pruned_atom_data = utils.prune_ground_atom_dataset(
-            self._atom_dataset,
+        low_level_trajs, segmented_trajs = self._get_segmented_trajs(
             set(candidate_predicates))
-        segmented_trajs = [
-            segment_trajectory(ll_traj, set(candidate_predicates), atom_seq)
-            for (ll_traj, atom_seq) in pruned_atom_data
-        ]
-        low_level_trajs = [ll_traj for ll_traj, _ in pruned_atom_data]
-        del pruned_atom_data
+        partition_key = self._get_belief_key(candidate_ae_matrix,
+                                             candidate_predicates,
+                                             predicates_ent_idx)
+        partition_hint = None
+        num_cols = len(predicates_ent_idx)
+        if CFG.segmenter in ("option_changes", "every_step") and num_cols:
+            partition_hint = self._partition_cache.get(
+                self._get_belief_key(
+                    candidate_ae_matrix[:, :num_cols - 1],
+                    candidate_predicates[:num_cols - 1] +
+                    candidate_predicates[num_cols:],
+                    predicates_ent_idx[:num_cols - 1]))
         try:
             # delete the pre-condition only predicates now
             candidate_predicates = candidate_predicates[:len(predicates_ent_idx)]
@@ -152,7 +176,8 @@ class _OperatorBeliefScoreFunction(abc.ABC):
                 'row_names': self._row_names,
                 'col_names': candidate_predicates,
                 'col_ent_idx': predicates_ent_idx,
-                'ae_matrix': candidate_ae_matrix
+                'ae_matrix': candidate_ae_matrix,
+                'partition_hint': partition_hint
             }
             if 'belief' in strips_learner:
                 pnads = learn_strips_operators(low_level_trajs,
@@ -163,6 +188,14 @@ class _OperatorBeliefScoreFunction(abc.ABC):
                                             verbose=True,
                                             annotations=None,
                                             operator_belief=operator_belief)
+                if "partition" in operator_belief:
+                    self._partition_cache[partition_key] = \
+                        operator_belief["partition"]
+                if partition_hint is not None and \
+                        CFG.neupi_check_belief_partition_hint:
+                    self._check_belief_partition_hint(
+                        low_level_trajs, segmented_trajs,
+                        candidate_predicates, operator_belief, pnads)
             else:
                 pnads = learn_strips_operators(low_level_trajs,
                                             self._train_tasks,
@@ -195,6 +228,143 @@ class _OperatorBeliefScoreFunction(abc.ABC):
         
         return op_score
 
+    def get_belief_partition(
+            self, candidate_ae_matrix: np.ndarray,
+            candidate_predicates: List[Predicate],
+            predicates_ent_idx: List[List[int]]) -> Optional[BeliefPartition]:
+        """Get the BeliefPartition of an evaluated candidate, if any."""
+        return self._partition_cache.get(
+            self._get_belief_key(candidate_ae_matrix, candidate_predicates,
+                                 predicates_ent_idx))
+
+    def set_belief_partition(self, candidate_ae_matrix: np.ndarray,
+                             candidate_predicates: List[Predicate],
+                             predicates_ent_idx: List[List[int]],
+                             partition: BeliefPartition) -> None:
+        """Set the BeliefPartition of a candidate evaluated elsewhere (e.g.,
+        in a forked process)."""
+        self._partition_cache[self._get_belief_key(
+            candidate_ae_matrix, candidate_predicates,
+            predicates_ent_idx)] = partition
+
+    def retain_belief_partition(self, candidate_ae_matrix: np.ndarray,
+                                candidate_predicates: List[Predicate],
+                                predicates_ent_idx: List[List[int]]) -> None:
+        """Forget the BeliefPartitions of all candidates but the given one
+        (e.g., the incumbent of the search, which the next candidates
+        extend by one column)."""
+        key = self._get_belief_key(candidate_ae_matrix, candidate_predicates,
+                                   predicates_ent_idx)
+        partition = self._partition_cache.get(key)
+        self._partition_cache.clear()
+        if partition is not None:
+            self._partition_cache[key] = partition
+
+    def _check_belief_partition_hint(
+            self, low_level_trajs: List[LowLevelTrajectory],
+            segmented_trajs: List[List[Segment]],
+            candidate_predicates: List[Predicate],
+            operator_belief: Dict[str, Any], pnads: List[PNAD]) -> None:
+        """Helper for evaluate(); check that learning without the partition
+        hint of the operator belief gives the same PNADs."""
+        unhinted_pnads = learn_strips_operators(
+            low_level_trajs,
+            self._train_tasks,
+            set(candidate_predicates),
+            segmented_trajs,
+            verify_harmlessness=False,
+            verbose=False,
+            annotations=None,
+            operator_belief=dict(operator_belief, partition_hint=None))
+        assert self._summarize_pnads(pnads, segmented_trajs) == \
+            self._summarize_pnads(unhinted_pnads, segmented_trajs), \
+            "Learning from the belief partition hint changed the PNADs."
+
+    @staticmethod
+    def _summarize_pnads(
+        pnads: List[PNAD], segmented_trajs: List[List[Segment]]
+    ) -> List[Tuple[str, List[Tuple[int, List[str]]]]]:
+        """Helper for _check_belief_partition_hint(); the operator of each
+        PNAD, with the positions and substitutions of its segments."""
+        positions = {
+            id(segment): i
+            for i, segment in enumerate(
+                segment for segments in segmented_trajs
+                for segment in segments)
+        }
+        return [(str(pnad.op),
+                 sorted((positions[id(segment)],
+                         sorted(f"{var}:{obj}" for var, obj in sub.items()))
+                        for segment, sub in pnad.datastore))
+                for pnad in pnads]
+
+    @staticmethod
+    def _get_belief_key(candidate_ae_matrix: np.ndarray,
+                        candidate_predicates: List[Predicate],
+                        predicates_ent_idx: List[List[int]]) -> Hashable:
+        return (tuple(candidate_predicates),
+                repr(candidate_ae_matrix.tolist()), repr(predicates_ent_idx))
+
+    def precompute_segmentation(self) -> None:
+        """Segment the data now rather than in the first evaluate(), so that
+        forked processes inherit the segmentation."""
+        if CFG.segmenter in ("option_changes", "every_step"):
+            self._get_segmented_trajs(set())
+
+    def _get_segmented_trajs(
+        self, candidate_predicates: Set[Predicate]
+    ) -> Tuple[List[LowLevelTrajectory], List[List[Segment]]]:
+        """Segment the data using only candidate_predicates.
+
+        The predicate sets evaluated during search mostly differ by one
+        predicate. With the option_changes and every_step segmenters,
+        the segment boundaries do not depend on the predicates, so the
+        data is segmented only once and the segments of any predicate
+        set are assembled from the atoms of each predicate at the
+        boundaries. Other segmenters re-segment the data every time.
+        """
+        low_level_trajs = [ll_traj for ll_traj, _ in self._atom_dataset]
+        if CFG.segmenter not in ("option_changes", "every_step"):
+            pruned_atom_data = utils.prune_ground_atom_dataset(
+                self._atom_dataset, candidate_predicates)
+            segmented_trajs = [
+                segment_trajectory(ll_traj, candidate_predicates, atom_seq)
+                for (ll_traj, atom_seq) in pruned_atom_data
+            ]
+            return low_level_trajs, segmented_trajs
+        if not self._segmentation_cache:
+            for ll_traj, atom_seq in self._atom_dataset:
+                all_predicates = {a.predicate for atoms in atom_seq
+                                  for a in atoms}
+                segments = segment_trajectory(ll_traj, all_predicates,
+                                              atom_seq)
+                boundary_atoms = [seg.init_atoms for seg in segments[:1]] + \
+                    [seg.final_atoms for seg in segments]
+                atoms_by_predicate = []
+                for atoms in boundary_atoms:
+                    pred_to_atoms: Dict[Predicate, Set[GroundAtom]] = {}
+                    for atom in atoms:
+                        pred_to_atoms.setdefault(atom.predicate,
+                                                 set()).add(atom)
+                    atoms_by_predicate.append(pred_to_atoms)
+                self._segmentation_cache.append((segments,
+                                                 atoms_by_predicate))
+        segmented_trajs = []
+        for segments, atoms_by_predicate in self._segmentation_cache:
+            boundary_atoms = [{
+                atom
+                for pred, pred_atoms in pred_to_atoms.items()
+                if pred in candidate_predicates for atom in pred_atoms
+            } for pred_to_atoms in atoms_by_predicate]
+            # Consecutive segments share their boundary atoms, as in
+            # segment_trajectory().
+            segmented_trajs.append([
+                Segment(seg.trajectory, boundary_atoms[i],
+                        boundary_atoms[i + 1], seg._option)  # pylint: disable=protected-access
+                for i, seg in enumerate(segments)
+            ])
+        return low_level_trajs, segmented_trajs
+
     def evaluate_with_operators(self,
                                 candidate_predicates: FrozenSet[Predicate],
                                 low_level_trajs: List[LowLevelTrajectory],
@@ -432,13 +602,16 @@ class _BiSimBeliefScoreFunction(abc.ABC):
                 for strips_op in strips_ops
                 for op in utils.all_ground_operators(strips_op, objects)
             }
+            # Index the preconditions once for all the successor
+            # computations in this trajectory.
+            successor_generator = utils.SuccessorGenerator(ground_ops)
             for heuristic_name in self.heuristic_names:
                 heuristic_fn = self._generate_heuristic(
                     heuristic_name, init_atoms, objects, goal, strips_ops,
                     option_specs, ground_ops, candidate_predicates)
                 scores[heuristic_name] += self._evaluate_atom_trajectory(
-                    atoms_sequence, heuristic_fn, ground_ops, demo_atom_sets,
-                    ll_traj.is_demo)
+                    atoms_sequence, heuristic_fn, successor_generator,
+                    demo_atom_sets, ll_traj.is_demo)
         score = min(scores.values())
         return CFG.grammar_search_heuristic_based_weight * score
 
@@ -495,7 +668,7 @@ class _BiSimBeliefScoreFunction(abc.ABC):
     def _evaluate_atom_trajectory(self, atoms_sequence: List[Set[GroundAtom]],
                                   heuristic_fn: Callable[[Set[GroundAtom]],
                                                          float],
-                                  ground_ops: Set[_GroundSTRIPSOperator],
+                                  ground_ops: utils.SuccessorGenerator,
                                   demo_atom_sets: Set[FrozenSet[GroundAtom]],
                                   is_demo: bool) -> float:
         assert is_demo
@@ -873,13 +1046,16 @@ class _HeuristicBasedScoreFunction(_OperatorLearningBasedScoreFunction):
                 for strips_op in strips_ops
                 for op in utils.all_ground_operators(strips_op, objects)
             }
+            # Index the preconditions once for all the successor
+            # computations in this trajectory.
+            successor_generator = utils.SuccessorGenerator(ground_ops)
             for heuristic_name in self.heuristic_names:
                 heuristic_fn = self._generate_heuristic(
                     heuristic_name, init_atoms, objects, goal, strips_ops,
                     option_specs, ground_ops, candidate_predicates)
                 scores[heuristic_name] += self._evaluate_atom_trajectory(
-                    atoms_sequence, heuristic_fn, ground_ops, demo_atom_sets,
-                    ll_traj.is_demo)
+                    atoms_sequence, heuristic_fn, successor_generator,
+                    demo_atom_sets, ll_traj.is_demo)
         score = min(scores.values())
         return CFG.grammar_search_heuristic_based_weight * score
 
@@ -896,7 +1072,7 @@ class _HeuristicBasedScoreFunction(_OperatorLearningBasedScoreFunction):
     def _evaluate_atom_trajectory(self, atoms_sequence: List[Set[GroundAtom]],
                                   heuristic_fn: Callable[[Set[GroundAtom]],
                                                          float],
-                                  ground_ops: Set[_GroundSTRIPSOperator],
+                                  ground_ops: utils.SuccessorGenerator,
                                   demo_atom_sets: Set[FrozenSet[GroundAtom]],
                                   is_demo: bool) -> float:
         raise NotImplementedError("Override me!")
@@ -910,7 +1086,7 @@ class _HeuristicMatchBasedScoreFunction(_HeuristicBasedScoreFunction):
     def _evaluate_atom_trajectory(self, atoms_sequence: List[Set[GroundAtom]],
                                   heuristic_fn: Callable[[Set[GroundAtom]],
                                                          float],
-                                  ground_ops: Set[_GroundSTRIPSOperator],
+                                  ground_ops: utils.SuccessorGenerator,
                                   demo_atom_sets: Set[FrozenSet[GroundAtom]],
                                   is_demo: bool) -> float:
         score = 0.0
@@ -939,7 +1115,7 @@ class _HeuristicEnergyBasedScoreFunction(_HeuristicBasedScoreFunction):
     def _evaluate_atom_trajectory(self, atoms_sequence: List[Set[GroundAtom]],
                                   heuristic_fn: Callable[[Set[GroundAtom]],
                                                          float],
-                                  ground_ops: Set[_GroundSTRIPSOperator],
+                                  ground_ops: utils.SuccessorGenerator,
                                   demo_atom_sets: Set[FrozenSet[GroundAtom]],
                                   is_demo: bool) -> float:
         assert is_demo
@@ -997,7 +1173,7 @@ class _HeuristicCountBasedScoreFunction(_HeuristicBasedScoreFunction):
         self,
         atoms_sequence: List[Set[GroundAtom]],
         heuristic_fn: Callable[[Set[GroundAtom]], float],
-        ground_ops: Set[_GroundSTRIPSOperator],
+        ground_ops: utils.SuccessorGenerator,
         demo_atom_sets: Set[FrozenSet[GroundAtom]],
         is_demo: bool,
     ) -> float:
@@ -1066,6 +1242,7 @@ class _RelaxationHeuristicBasedScoreFunction(_HeuristicBasedScoreFunction):
             op for op in ground_ops
             if op.preconditions.issubset(all_reachable_atoms)
         ]
+        successor_generator = utils.SuccessorGenerator(ground_ops)
         h_fn = utils.create_task_planning_heuristic(
             heuristic_name, init_atoms, goal, reachable_ops,
             set(candidate_predicates) | self._initial_predicates, objects)
@@ -1084,7 +1261,7 @@ class _RelaxationHeuristicBasedScoreFunction(_HeuristicBasedScoreFunction):
                 successor_hs = [
                     _relaxation_h(next_atoms, depth + 1)
                     for next_atoms in utils.get_successors_from_ground_ops(
-                        atoms, ground_ops)
+                        atoms, successor_generator)
                 ]
                 if not successor_hs:
                     return float("inf")
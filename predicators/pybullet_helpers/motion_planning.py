@@ -68,10 +68,41 @@ def run_motion_planning(
         for i in range(1, num + 1):
             yield list(pt1_arr * (1 - i / num) + pt2_arr * i / num)
 
+    def _get_aabb(body: int) -> NDArray:
+        # The union of the AABBs of all the links of the body.
+        num_links = p.getNumJoints(body, physicsClientId=physics_client_id)
+        link_aabbs = np.array([
+            p.getAABB(body, link, physicsClientId=physics_client_id)
+            for link in range(-1, num_links)
+        ])
+        return np.array(
+            [link_aabbs[:, 0].min(axis=0), link_aabbs[:, 1].max(axis=0)])
+
+    # The collision bodies don't move during planning, so their AABBs are
+    # computed once. Bullet's AABBs include the contact margin, so bodies
+    # whose AABBs don't overlap those of the robot and the held object
+    # can't have contact points with them.
+    if CFG.pybullet_birrt_aabb_prefilter:
+        collision_bodies = list(collision_bodies)
+        p.performCollisionDetection(physicsClientId=physics_client_id)
+        collision_body_aabbs = np.array(
+            [_get_aabb(body) for body in collision_bodies]).reshape(-1, 2, 3)
+
+    def _get_nearby_collision_bodies() -> Collection[int]:
+        if not CFG.pybullet_birrt_aabb_prefilter:
+            return collision_bodies
+        lo, hi = _get_aabb(robot.robot_id)
+        if held_object is not None:
+            held_lo, held_hi = _get_aabb(held_object)
+            lo, hi = np.minimum(lo, held_lo), np.maximum(hi, held_hi)
+        overlaps = np.all(collision_body_aabbs[:, 0] <= hi, axis=1) & \
+            np.all(lo <= collision_body_aabbs[:, 1], axis=1)
+        return [b for b, o in zip(collision_bodies, overlaps) if o]
+
     def _collision_fn(pt: JointPositions) -> bool:
         _set_state(pt)
         p.performCollisionDetection(physicsClientId=physics_client_id)
-        for body in collision_bodies:
+        for body in _get_nearby_collision_bodies():
             if p.getContactPoints(robot.robot_id,
                                   body,
                                   physicsClientId=physics_client_id):
@@ -81,20 +112,28 @@ def run_motion_planning(
                 return True
         return False
 
-    def _distance_fn(from_pt: JointPositions, to_pt: JointPositions) -> float:
+    def _embed_fn(pt: JointPositions) -> NDArray:
         # NOTE: only using positions to calculate distance. Should use
         # orientations as well in the near future.
-        from_ee = robot.forward_kinematics(from_pt).position
-        to_ee = robot.forward_kinematics(to_pt).position
-        return sum(np.subtract(from_ee, to_ee)**2)
-
-    birrt = utils.BiRRT(_sample_fn,
-                        _extend_fn,
-                        _collision_fn,
-                        _distance_fn,
-                        rng,
-                        num_attempts=CFG.pybullet_birrt_num_attempts,
-                        num_iters=CFG.pybullet_birrt_num_iters,
-                        smooth_amt=CFG.pybullet_birrt_smooth_amt)
+        return np.array(robot.forward_kinematics(pt).position)
+
+    def _distance_fn(from_pt: JointPositions, to_pt: JointPositions) -> float:
+        return sum(np.subtract(_embed_fn(from_pt), _embed_fn(to_pt))**2)
+
+    # The BiRRT embeds each node with forward kinematics once and finds
+    # nearest nodes with a spatial index over the end effector positions.
+    if CFG.pybullet_birrt_lazy_collision_checks:
+        birrt_cls = utils.LazyBiRRT
+    else:
+        birrt_cls = utils.BiRRT
+    birrt = birrt_cls(_sample_fn,
+                      _extend_fn,
+                      _collision_fn,
+                      _distance_fn,
+                      rng,
+                      num_attempts=CFG.pybullet_birrt_num_attempts,
+                      num_iters=CFG.pybullet_birrt_num_iters,
+                      smooth_amt=CFG.pybullet_birrt_smooth_amt,
+                      embed_fn=_embed_fn)
 
     return birrt.query(initial_positions, target_positions)
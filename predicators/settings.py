@@ -18,6 +18,16 @@ class GlobalSettings:
     debug = False
     num_train_tasks = 50
     num_test_tasks = 50
+    # Number of forked processes that solve and execute the test tasks in
+    # main._run_testing() (1 means serial). Each worker has its own copy of
+    # the env and the approach, so the random draws of the approach (e.g.,
+    # planning seeds) differ from a serial run. Per-task results are merged
+    # in task order. Ignored (the tasks are run serially) if CUDA has been
+    # initialized, e.g. by a model on CFG.device, since CUDA does not
+    # survive forking. The test workers are daemonic, so settings that fork
+    # processes of their own (sesame_num_parallel_refinements) are ignored
+    # in them.
+    num_test_workers = 1
     # Perform online learning for this many cycles or until this many
     # transitions have been collected, whichever happens first.
     num_online_learning_cycles = 10
@@ -86,6 +96,10 @@ class GlobalSettings:
     # Normally, State.allclose() raises an error if the simulator state of
     # either of its arguments is not None.
     allow_state_allclose_comparison_despite_simulator_state = False
+    # If True, the initial states of the environment tasks are converted to
+    # ArrayStates, which keep all features in one contiguous buffer. States
+    # derived from them with copy() stay array-backed.
+    array_backed_states = False
 
     # mdp offline dataset settings
     all_skeleton_found = 1
@@ -134,6 +148,12 @@ class GlobalSettings:
     blocks_engrave_sigma = [0.004, 0.007]
     blocks_engrave_surface_res = 40
     blocks_engrave_num_points = 1024
+    # If not None, the number of grid points for (irr_x, irr_y, sigma), as
+    # one int for all of them or a list of 3, in a bank of block point cloud
+    # templates, saved in data_dir, which blocks_engrave_pcd uses instead of
+    # generating every point cloud. The bank holds irr_h = +/- the engrave
+    # height; clouds with other heights are still generated exactly.
+    blocks_engrave_pcd_template_grid = None
     blocks_engrave_render_mode = '2d'
 
     # blocks img env parameters
@@ -210,7 +230,17 @@ class GlobalSettings:
     pybullet_birrt_num_iters = 100
     pybullet_birrt_smooth_amt = 50
     pybullet_birrt_extend_num_interp = 10
+    # If True, the BiRRT grows its trees without checking collisions and
+    # only validates the candidate paths (see utils.LazyBiRRT).
+    pybullet_birrt_lazy_collision_checks = False
+    # If True, collision checks skip the bodies whose AABBs don't overlap
+    # the AABB of the robot and the held object.
+    pybullet_birrt_aabb_prefilter = False
     pybullet_control_mode = "reset"
+    # The maximum number of PyBullet snapshots of simulated states to keep,
+    # so that simulate() can restore previously visited states instead of
+    # resetting the scene. If 0, snapshots are not used.
+    pybullet_state_snapshot_cache_size = 0
     pybullet_max_vel_norm = 0.05
     pybullet_block_crop_size = 64
     # env -> robot -> quaternion
@@ -424,6 +454,12 @@ class GlobalSettings:
     # option model parameters
     option_model_terminate_on_repeat = True
     option_model_use_gui = False
+    # For the "cached_*" option models: the maximum number of predictions
+    # memoized (least recently used ones are evicted; a count of entries,
+    # not a memory size in bytes), and the number of decimals states and
+    # parameters are rounded to in the cache keys.
+    option_model_cache_size = 10000
+    option_model_cache_decimals = 6
 
     # parameters for abstract GNN approach
     # keep fair with neupi, nn size, bs, epochs
@@ -492,6 +528,32 @@ class GlobalSettings:
     sesame_check_expected_atoms = True
     sesame_use_necessary_atoms = False # Note, all high-level atoms must be satisfied at every step
     sesame_use_visited_state_set = False
+    # If True, the A* skeleton search interns ground atoms to integer ids
+    # once per task and represents abstract states, preconditions, and
+    # effects as bitsets, so that successor generation is bit operations.
+    sesame_use_bitset_states = False
+    # If greater than 1, the A* planner keeps this many skeletons in flight
+    # at once in forked processes, each running low-level search with its
+    # own derived seed. The first success cancels the rest. Ignored (the
+    # skeletons are refined serially) in the test workers of main.py, since
+    # they are daemonic processes, which cannot have children.
+    sesame_num_parallel_refinements = 1
+    # Maximum number of abstract states whose task planning heuristic value
+    # is memoized per heuristic (i.e., per planning problem). The least
+    # recently used values are evicted beyond this. If 0, nothing is cached.
+    sesame_heuristic_cache_size = 100000
+    # If True, hff is computed by pyperplan rather than natively (see
+    # heuristics.py). The two break ties between equally cheap achievers
+    # differently, so their values can differ.
+    sesame_use_pyperplan_hff = False
+    # If True, SeSamE records the wall time and the number of calls of its
+    # phases (grounding, heuristic evaluation, sampling, etc.) in its metrics
+    # as profile_<phase>_time and profile_<phase>_calls.
+    sesame_profile = False
+    # If not None (and sesame_profile is True), the self time of each stack
+    # of phases is appended to this file after every call to the planner, in
+    # the folded format of flamegraph.pl.
+    sesame_profile_trace_file = None
     # The algorithm used for grounding the planning problem. Choices are
     # "naive" or "fd_translator". The former does a type-aware cross product
     # of operators and objects to obtain ground operators, while the latter
@@ -794,9 +856,24 @@ class GlobalSettings:
     neupi_quantify_dataset = 1.0
     neupi_max_neural_nets = 50
     neupi_parallel_invention = True
+    # if True, the candidate networks of an iteration are trained together
+    # in this process on one shared pass over the data (this takes
+    # precedence over neupi_parallel_invention)
+    neupi_ensemble_training = False
+    # number of processes scoring the candidate predicate sets of a level
+    # of the predicate selection search in parallel (1 means serial); serial
+    # in daemonic processes, like the test workers of main.py
+    neupi_pred_search_num_workers = 1
+    # if True, the operators that the belief STRIPS learners learn from the
+    # partition of the incumbent in the predicate selection search are
+    # checked against those learned from scratch (slow, for debugging)
+    neupi_check_belief_partition_hint = False
     neupi_save_init_atom_dataset = True
     neupi_gt_sampler = False
     neupi_cache_input_graph = False
+    # if not empty, graphified transitions are also cached on disk here,
+    # keyed by the data, the feature layout and the normalizers
+    neupi_graph_cache_dir = ""
     precond_thresh = 0.999
     max_normalizer_data = -1
 
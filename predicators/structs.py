@@ -207,6 +207,150 @@ class State:
         return prefix + "\n\n".join(table_strs) + suffix
 
 
+class _StateLayout:
+    """Where the features of each object live in the buffer of an
+    ArrayState.
+
+    Objects are laid out in sorted order. Layouts are shared by all
+    ArrayStates over the same objects, so copies do not rebuild them.
+    """
+
+    def __init__(self, objects: Sequence[Object]) -> None:
+        self.objects = tuple(objects)
+        self.slices: Dict[Object, slice] = {}
+        self.offsets: Dict[Object, int] = {}
+        start = 0
+        for obj in self.objects:
+            self.slices[obj] = slice(start, start + obj.type.dim)
+            self.offsets[obj] = start
+            start += obj.type.dim
+        self.size = start
+        self.feature_indices: Dict[Type, Dict[str, int]] = {}
+        for obj in self.objects:
+            if obj.type not in self.feature_indices:
+                self.feature_indices[obj.type] = {
+                    f: i
+                    for i, f in enumerate(obj.type.feature_names)
+                }
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def get(objects: Tuple[Object, ...]) -> _StateLayout:
+        """Get the (shared) layout for the given sorted objects."""
+        return _StateLayout(objects)
+
+
+class ArrayState(State):
+    """A State whose features are stored in one contiguous buffer.
+
+    The State API is preserved: data is a dict of views into the buffer,
+    so writes through data, __getitem__() or set() all update the
+    buffer. copy() copies the buffer in one go, __iter__() does not
+    re-sort, and get() and set() use precomputed feature indices. vec()
+    returns a copy, like State.vec(), made with a single slice of the
+    buffer when the objects are adjacent in the layout.
+    """
+
+    def __init__(self,
+                 data: Dict[Object, Array],
+                 simulator_state: Optional[Any] = None) -> None:
+        layout = _StateLayout.get(tuple(sorted(data)))
+        if layout.objects:
+            dtype = np.result_type(*(data[o] for o in layout.objects))
+        else:
+            dtype = np.dtype(np.float32)
+        buffer = np.empty(layout.size, dtype=dtype)
+        for obj in layout.objects:
+            assert len(data[obj]) == obj.type.dim
+            buffer[layout.slices[obj]] = data[obj]
+        self._init_from_buffer(buffer, layout, simulator_state)
+
+    def _init_from_buffer(self, buffer: Array, layout: _StateLayout,
+                          simulator_state: Optional[Any]) -> None:
+        self._buffer = buffer
+        self._layout = layout
+        self._data: Optional[Dict[Object, Array]] = None
+        self.simulator_state = simulator_state
+
+    @classmethod
+    def from_state(cls, state: State) -> ArrayState:
+        """Convert a state into an ArrayState, copying the features."""
+        return cls(state.data, simulator_state=state.simulator_state)
+
+    @property
+    def data(self) -> Dict[Object, Array]:  # type: ignore[override]
+        """The features of each object, as views into the buffer."""
+        if self._data is None:
+            buffer = self._buffer
+            self._data = {
+                o: buffer[s]
+                for o, s in self._layout.slices.items()
+            }
+        return self._data
+
+    def __iter__(self) -> Iterator[Object]:
+        return iter(self._layout.objects)
+
+    def __getitem__(self, key: Object) -> Array:
+        return self._buffer[self._layout.slices[key]]
+
+    def get(self, obj: Object, feature_name: str) -> Any:
+        idx = self._layout.feature_indices[obj.type][feature_name]
+        return self._buffer[self._layout.offsets[obj] + idx]
+
+    def set(self, obj: Object, feature_name: str, feature_val: Any) -> None:
+        idx = self._layout.feature_indices[obj.type][feature_name]
+        self._buffer[self._layout.offsets[obj] + idx] = feature_val
+
+    def get_objects(self, object_type: Type) -> List[Object]:
+        return [o for o in self._layout.objects if o.is_instance(object_type)]
+
+    def vec(self, objects: Sequence[Object]) -> Array:
+        if len(objects) == 0:
+            return np.zeros(0, dtype=np.float32)
+        slices = self._layout.slices
+        start = slices[objects[0]].start
+        end = start
+        for obj in objects:
+            if slices[obj].start != end:
+                return np.hstack([self[o] for o in objects])
+            end = slices[obj].stop
+        return self._buffer[start:end].copy()
+
+    def copy(self) -> ArrayState:
+        new_state = ArrayState.__new__(ArrayState)
+        new_state._init_from_buffer(  # pylint: disable=protected-access
+            self._buffer.copy(), self._layout,
+            copy.deepcopy(self.simulator_state))
+        return new_state
+
+    def allclose(self, other: State) -> bool:
+        if not isinstance(other, ArrayState) or \
+            other._layout is not self._layout:
+            return super().allclose(other)
+        if self.simulator_state is not None or \
+            other.simulator_state is not None:
+            if not CFG.allow_state_allclose_comparison_despite_simulator_state:
+                raise NotImplementedError("Cannot use allclose when "
+                                          "simulator_state is not None.")
+            if self.simulator_state != other.simulator_state:
+                return False
+        return bool(np.allclose(self._buffer, other._buffer, atol=1e-3))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The views in _data would be pickled as separate arrays.
+        return {
+            "_buffer": self._buffer,
+            "_layout_objects": self._layout.objects,
+            "simulator_state": self.simulator_state,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self._init_from_buffer(state["_buffer"],
+                               _StateLayout.get(state["_layout_objects"]),
+                               state["simulator_state"])
+
+
 DefaultState = State({})
 
 
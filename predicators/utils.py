@@ -19,12 +19,12 @@ import subprocess
 import sys
 import time
 from argparse import ArgumentParser
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Callable, ClassVar, Collection, Dict, \
-    FrozenSet, Generator, Generic, Hashable, Iterator, List, Optional, \
-    Sequence, Set, Tuple
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Collection, \
+    ContextManager, DefaultDict, Dict, FrozenSet, Generator, Generic, \
+    Hashable, Iterator, List, Optional, Sequence, Set, Tuple
 from typing import Type as TypingType
 from typing import TypeVar, Union, cast
 
@@ -46,8 +46,10 @@ from bosdyn.client import math_helpers
 from pyperplan.heuristics.heuristic_base import \
     Heuristic as _PyperplanBaseHeuristic
 from pyperplan.planner import HEURISTICS as _PYPERPLAN_HEURISTICS
+from scipy.spatial import KDTree
 from scipy.stats import beta as BetaRV
 
+from predicators import heuristics as _heuristics
 from predicators.args import create_arg_parser
 from predicators.pretrained_model_interface import GoogleGeminiVLM, \
     OpenAIVLM, VisionLanguageModel
@@ -342,6 +344,29 @@ def construct_active_sampler_input(state: State, objects: Sequence[Object],
     return np.array(sampler_input_lst)
 
 
+def construct_active_sampler_inputs(
+        state: State, objects: Sequence[Object], params_batch: Array,
+        param_option: ParameterizedOption) -> Array:
+    """Construct the active sampler inputs for each row of params_batch.
+
+    With all the features selected, the inputs only differ in the
+    params, so the rest of the input is constructed once.
+    """
+    if CFG.active_sampler_learning_feature_selection != "all":
+        return np.array([
+            construct_active_sampler_input(state, objects, params,
+                                           param_option)
+            for params in params_batch
+        ])
+    assert not CFG.sampler_learning_use_goals
+    prefix = np.concatenate([[1.0]] + [state[obj] for obj in objects])
+    num_candidates = len(params_batch)
+    return np.hstack([
+        np.tile(prefix, (num_candidates, 1)),
+        np.reshape(params_batch, (num_candidates, -1))
+    ])
+
+
 class _Geom2D(abc.ABC):
     """A 2D shape that contains some points."""
 
@@ -2027,15 +2052,26 @@ _RRTState = TypeVar("_RRTState")
 
 
 class RRT(Generic[_RRTState]):
-    """Rapidly-exploring random tree."""
+    """Rapidly-exploring random tree.
+
+    If embed_fn is given, distance_fn must be the squared Euclidean
+    distance between the embeddings of its arguments (or increase
+    monotonically with it). Nodes are then embedded once, when they are
+    added, and nearest nodes are looked up in a spatial index over the
+    embeddings instead of calling distance_fn on every node.
+    """
 
-    def __init__(self, sample_fn: Callable[[_RRTState], _RRTState],
+    def __init__(self,
+                 sample_fn: Callable[[_RRTState], _RRTState],
                  extend_fn: Callable[[_RRTState, _RRTState],
                                      Iterator[_RRTState]],
                  collision_fn: Callable[[_RRTState], bool],
-                 distance_fn: Callable[[_RRTState, _RRTState],
-                                       float], rng: np.random.Generator,
-                 num_attempts: int, num_iters: int, smooth_amt: int):
+                 distance_fn: Callable[[_RRTState, _RRTState], float],
+                 rng: np.random.Generator,
+                 num_attempts: int,
+                 num_iters: int,
+                 smooth_amt: int,
+                 embed_fn: Optional[Callable[[_RRTState], Array]] = None):
         self._sample_fn = sample_fn
         self._extend_fn = extend_fn
         self._collision_fn = collision_fn
@@ -2044,6 +2080,7 @@ class RRT(Generic[_RRTState]):
         self._num_attempts = num_attempts
         self._num_iters = num_iters
         self._smooth_amt = smooth_amt
+        self._embed_fn = embed_fn
 
     def query(self,
               pt1: _RRTState,
@@ -2109,21 +2146,20 @@ class RRT(Generic[_RRTState]):
         sample_goal_eps: float = 0.0,
     ) -> Optional[List[_RRTState]]:
         root = _RRTNode(pt1)
-        nodes = [root]
+        nodes = self._create_tree(root)
 
         for _ in range(self._num_iters):
             # Sample the goal with a small probability, otherwise randomly
             # choose a point.
             sample_goal = self._rng.random() < sample_goal_eps
             samp = goal_sampler() if sample_goal else self._sample_fn(pt1)
-            min_key = functools.partial(self._get_pt_dist_to_node, samp)
-            nearest = min(nodes, key=min_key)
+            nearest = nodes.nearest(samp)
             reached_goal = False
             for newpt in self._extend_fn(nearest.data, samp):
                 if self._collision_fn(newpt):
                     break
                 nearest = _RRTNode(newpt, parent=nearest)
-                nodes.append(nearest)
+                nodes.add(nearest)
             else:
                 reached_goal = sample_goal
             # Check goal_fn if defined
@@ -2132,9 +2168,9 @@ class RRT(Generic[_RRTState]):
                 return [node.data for node in path]
         return None
 
-    def _get_pt_dist_to_node(self, pt: _RRTState,
-                             node: _RRTNode[_RRTState]) -> float:
-        return self._distance_fn(pt, node.data)
+    def _create_tree(
+            self, root: _RRTNode[_RRTState]) -> _RRTNodeSet[_RRTState]:
+        return _RRTNodeSet(root, self._distance_fn, self._embed_fn)
 
     def _smooth_path(self, path: List[_RRTState]) -> List[_RRTState]:
         assert len(path) > 2
@@ -2173,27 +2209,25 @@ class BiRRT(RRT[_RRTState]):
         # goal_fn and sample_goal_eps are unused
         pt2 = goal_sampler()
         root1, root2 = _RRTNode(pt1), _RRTNode(pt2)
-        nodes1, nodes2 = [root1], [root2]
+        nodes1, nodes2 = self._create_tree(root1), self._create_tree(root2)
 
         for _ in range(self._num_iters):
             if len(nodes1) > len(nodes2):
                 nodes1, nodes2 = nodes2, nodes1
             samp = self._sample_fn(pt1)
-            min_key1 = functools.partial(self._get_pt_dist_to_node, samp)
-            nearest1 = min(nodes1, key=min_key1)
+            nearest1 = nodes1.nearest(samp)
             for newpt in self._extend_fn(nearest1.data, samp):
                 if self._collision_fn(newpt):
                     break
                 nearest1 = _RRTNode(newpt, parent=nearest1)
-                nodes1.append(nearest1)
-            min_key2 = functools.partial(self._get_pt_dist_to_node,
-                                         nearest1.data)
-            nearest2 = min(nodes2, key=min_key2)
+                nodes1.add(nearest1)
+            nearest2 = nodes2.nearest(nearest1.data,
+                                      nodes1.embedding(nearest1))
             for newpt in self._extend_fn(nearest2.data, nearest1.data):
                 if self._collision_fn(newpt):
                     break
                 nearest2 = _RRTNode(newpt, parent=nearest2)
-                nodes2.append(nearest2)
+                nodes2.add(nearest2)
             else:
                 path1 = nearest1.path_from_root()
                 path2 = nearest2.path_from_root()
@@ -2206,14 +2240,95 @@ class BiRRT(RRT[_RRTState]):
         return None
 
 
+class LazyBiRRT(BiRRT[_RRTState]):
+    """Bidirectional rapidly-exploring random tree with lazy collision
+    checking.
+
+    The trees are grown without checking collisions, so they connect on
+    every iteration. The candidate path is then validated in bisection
+    order, because collisions tend to be far from the endpoints, which are
+    known to be collision-free. The result of every check is cached on the
+    node, so that the edges shared with earlier candidate paths are not
+    checked again. If a node is in collision, it is pruned from its tree,
+    along with all of its descendants.
+    """
+
+    def _rrt_connect(
+        self,
+        pt1: _RRTState,
+        goal_sampler: Callable[[], _RRTState],
+        goal_fn: Optional[Callable[[_RRTState], bool]] = None,
+        sample_goal_eps: float = 0.0,
+    ) -> Optional[List[_RRTState]]:
+        # goal_fn and sample_goal_eps are unused
+        pt2 = goal_sampler()
+        root1, root2 = _RRTNode(pt1), _RRTNode(pt2)
+        # The roots were already checked in query().
+        root1.collision_free = root2.collision_free = True
+        nodes1, nodes2 = self._create_tree(root1), self._create_tree(root2)
+
+        for _ in range(self._num_iters):
+            if len(nodes1) > len(nodes2):
+                nodes1, nodes2 = nodes2, nodes1
+            samp = self._sample_fn(pt1)
+            nearest1 = nodes1.nearest(samp)
+            for newpt in self._extend_fn(nearest1.data, samp):
+                nearest1 = _RRTNode(newpt, parent=nearest1)
+                nodes1.add(nearest1)
+            nearest2 = nodes2.nearest(nearest1.data,
+                                      nodes1.embedding(nearest1))
+            for newpt in self._extend_fn(nearest2.data, nearest1.data):
+                nearest2 = _RRTNode(newpt, parent=nearest2)
+                nodes2.add(nearest2)
+            path1 = nearest1.path_from_root()
+            path2 = nearest2.path_from_root()
+            if path1[0] != root1:
+                path1, path2 = path2, path1
+            assert path1[0] == root1
+            path = path1[:-1] + path2[::-1]
+            colliding_node = self._find_colliding_node(path)
+            if colliding_node is None:
+                return [node.data for node in path]
+            if colliding_node.path_from_root()[0] == nodes1.root:
+                nodes1.remove_subtree(colliding_node)
+            else:
+                nodes2.remove_subtree(colliding_node)
+        return None
+
+    def _find_colliding_node(
+        self, path: List[_RRTNode[_RRTState]]
+    ) -> Optional[_RRTNode[_RRTState]]:
+        """Helper for _rrt_connect(); check the nodes of the path in
+        bisection order and return the first one found in collision."""
+        intervals = deque([(0, len(path) - 1)])
+        while intervals:
+            lo, hi = intervals.popleft()
+            if hi - lo < 2:
+                continue
+            mid = (lo + hi) // 2
+            node = path[mid]
+            if node.collision_free is None:
+                node.collision_free = not self._collision_fn(node.data)
+            if not node.collision_free:
+                return node
+            intervals.append((lo, mid))
+            intervals.append((mid, hi))
+        return None
+
+
 class _RRTNode(Generic[_RRTState]):
-    """A node for RRT."""
+    """A node for RRT.
+
+    collision_free caches the result of the collision check of the node,
+    for LazyBiRRT, which does not check nodes when they are added.
+    """
 
     def __init__(self,
                  data: _RRTState,
                  parent: Optional[_RRTNode[_RRTState]] = None) -> None:
         self.data = data
         self.parent = parent
+        self.collision_free: Optional[bool] = None
 
     def path_from_root(self) -> List[_RRTNode[_RRTState]]:
         """Return the path from the root to this node."""
@@ -2225,6 +2340,108 @@ class _RRTNode(Generic[_RRTState]):
         return sequence[::-1]
 
 
+class _RRTNodeSet(Generic[_RRTState]):
+    """The nodes of a tree grown by RRT, with nearest-node lookup.
+
+    Without an embed_fn, nearest() calls distance_fn on every node. With
+    one, every node is embedded once, when it is added. The embeddings are
+    kept in a KD-tree, which is rebuilt whenever the number of nodes has
+    doubled since the last build. The nodes added since then are scanned
+    with vectorized numpy operations.
+    """
+    _MIN_KD_TREE_SIZE: ClassVar[int] = 64
+
+    def __init__(self, root: _RRTNode[_RRTState],
+                 distance_fn: Callable[[_RRTState, _RRTState], float],
+                 embed_fn: Optional[Callable[[_RRTState], Array]]) -> None:
+        self._nodes: List[_RRTNode[_RRTState]] = []
+        self._distance_fn = distance_fn
+        self._embed_fn = embed_fn
+        # The embeddings of the nodes, in order, in a buffer whose capacity
+        # doubles when it is full.
+        self._embeddings: Optional[Array] = None
+        self._kd_tree: Optional[KDTree] = None
+        self._kd_tree_size = 0
+        self._embedding_idxs: Dict[int, int] = {}
+        self.root = root
+        self.add(root)
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def remove_subtree(self, node: _RRTNode[_RRTState]) -> None:
+        """Remove a node other than the root, and all of its descendants,
+        from the set."""
+        assert node is not self.root
+        # Parents are always added before their children.
+        removed = {id(node)}
+        kept = []
+        for n in self._nodes:
+            if id(n) in removed or id(n.parent) in removed:
+                removed.add(id(n))
+            else:
+                kept.append(n)
+        if self._embeddings is not None:
+            kept_idxs = [self._embedding_idxs[id(n)] for n in kept]
+            self._embeddings = self._embeddings[kept_idxs]
+            self._embedding_idxs = {id(n): i for i, n in enumerate(kept)}
+            self._kd_tree = None
+            self._kd_tree_size = 0
+        self._nodes = kept
+
+    def add(self, node: _RRTNode[_RRTState]) -> None:
+        """Add a node to the set."""
+        if self._embed_fn is not None:
+            embedding = np.asarray(self._embed_fn(node.data), dtype=float)
+            num_nodes = len(self._nodes)
+            if self._embeddings is None:
+                self._embeddings = np.empty((16, len(embedding)))
+            elif num_nodes == len(self._embeddings):
+                self._embeddings = np.concatenate(
+                    [self._embeddings,
+                     np.empty_like(self._embeddings)])
+            self._embeddings[num_nodes] = embedding
+            self._embedding_idxs[id(node)] = num_nodes
+        self._nodes.append(node)
+
+    def embedding(self, node: _RRTNode[_RRTState]) -> Optional[Array]:
+        """The cached embedding of a node in the set, if there is an
+        embed_fn."""
+        if self._embeddings is None:
+            return None
+        return self._embeddings[self._embedding_idxs[id(node)]]
+
+    def nearest(self,
+                pt: _RRTState,
+                pt_embedding: Optional[Array] = None) -> _RRTNode[_RRTState]:
+        """Return the node closest to the given point (the earliest added
+        one, in case of ties).
+
+        The embedding of the point can be given if it is known.
+        """
+        if self._embed_fn is None:
+            return min(self._nodes,
+                       key=lambda n: self._distance_fn(pt, n.data))
+        assert self._embeddings is not None
+        if pt_embedding is None:
+            pt_embedding = np.asarray(self._embed_fn(pt), dtype=float)
+        num_nodes = len(self._nodes)
+        if num_nodes >= max(2 * self._kd_tree_size, self._MIN_KD_TREE_SIZE):
+            self._kd_tree = KDTree(self._embeddings[:num_nodes])
+            self._kd_tree_size = num_nodes
+        best_idx, best_dist = -1, float("inf")
+        if self._kd_tree is not None:
+            dist, best_idx = self._kd_tree.query(pt_embedding)
+            best_dist = dist**2
+        if num_nodes > self._kd_tree_size:
+            new_embeddings = self._embeddings[self._kd_tree_size:num_nodes]
+            dists = np.sum((new_embeddings - pt_embedding)**2, axis=1)
+            new_idx = int(np.argmin(dists))
+            if dists[new_idx] < best_dist:
+                best_idx = self._kd_tree_size + new_idx
+        return self._nodes[best_idx]
+
+
 def strip_predicate(predicate: Predicate) -> Predicate:
     """Remove the classifier from the given predicate to make a new Predicate.
 
@@ -2938,13 +3155,72 @@ def get_applicable_operators(
     """Iterate over ground operators whose preconditions are satisfied.
 
     Note: the order may be nondeterministic. Users should be invariant.
+    If ground_ops is a SuccessorGenerator, its precondition index is used
+    instead of a linear scan.
     """
+    if isinstance(ground_ops, SuccessorGenerator):
+        yield from ground_ops.get_applicable_operators(atoms)
+        return
     for op in ground_ops:
         applicable = op.preconditions.issubset(atoms)
         if applicable:
             yield op
 
 
+class SuccessorGenerator:
+    """An index over the preconditions of a fixed collection of ground
+    operators, built once per task, for fast applicable-operator lookup.
+
+    Each ground operator is put on the watch list of each of its
+    preconditions. To find the applicable operators in a set of atoms,
+    we count how many preconditions of each watching operator are true,
+    so the cost scales with the watch lists of the true atoms rather
+    than with the total number of ground operators.
+
+    Can be used in place of the collection of ground operators that it
+    indexes; iteration and lookup results follow the original order.
+    """
+
+    def __init__(self,
+                 ground_ops: Collection[GroundNSRTOrSTRIPSOperator]) -> None:
+        self._ops = list(ground_ops)
+        self._num_preconditions = [len(op.preconditions) for op in self._ops]
+        self._no_precondition_idxs = [
+            i for i, n in enumerate(self._num_preconditions) if n == 0
+        ]
+        self._precondition_to_idxs: Dict[GroundAtom,
+                                         List[int]] = defaultdict(list)
+        for i, op in enumerate(self._ops):
+            for atom in op.preconditions:
+                self._precondition_to_idxs[atom].append(i)
+
+    def __iter__(self) -> Iterator[GroundNSRTOrSTRIPSOperator]:
+        return iter(self._ops)
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def __contains__(self, op: object) -> bool:
+        return op in self._ops
+
+    def get_applicable_operators(
+            self, atoms: Collection[GroundAtom]
+    ) -> List[GroundNSRTOrSTRIPSOperator]:
+        """Get the ground operators whose preconditions are satisfied, in
+        the order in which they were given to the constructor."""
+        if not isinstance(atoms, (set, frozenset)):
+            atoms = set(atoms)  # duplicates would break the counting
+        num_true: Dict[int, int] = defaultdict(int)
+        for atom in atoms:
+            for i in self._precondition_to_idxs.get(atom, ()):
+                num_true[i] += 1
+        applicable_idxs = self._no_precondition_idxs + [
+            i for i, n in num_true.items() if n == self._num_preconditions[i]
+        ]
+        applicable_idxs.sort()
+        return [self._ops[i] for i in applicable_idxs]
+
+
 def apply_operator(op: GroundNSRTOrSTRIPSOperator,
                    atoms: Set[GroundAtom]) -> Set[GroundAtom]:
     """Get a next set of atoms given a current set and a ground operator."""
@@ -2960,6 +3236,128 @@ def apply_operator(op: GroundNSRTOrSTRIPSOperator,
     return new_atoms
 
 
+class AtomBitsetEncoder:
+    """Interns a fixed universe of ground atoms to integer ids, so that sets
+    of atoms can be represented as Python int bitsets.
+
+    Bit i of an encoded set is on iff the i-th interned atom is in the
+    set. The universe is fixed at construction time so that masks
+    derived from it (e.g., for ignore effects) never go stale.
+    """
+
+    def __init__(self, atoms: Collection[GroundAtom]) -> None:
+        # Sort to ensure that the encoding is deterministic.
+        self._atoms: List[GroundAtom] = sorted(set(atoms))
+        self._atom_to_id = {a: i for i, a in enumerate(self._atoms)}
+        self._predicate_to_mask: Dict[Predicate, int] = defaultdict(int)
+        for i, atom in enumerate(self._atoms):
+            self._predicate_to_mask[atom.predicate] |= 1 << i
+
+    def __len__(self) -> int:
+        return len(self._atoms)
+
+    def encode(self, atoms: Collection[GroundAtom]) -> int:
+        """Encode a set of atoms, all of which must be in the universe."""
+        bits = 0
+        for atom in atoms:
+            bits |= 1 << self._atom_to_id[atom]
+        return bits
+
+    def try_encode(self, atoms: Collection[GroundAtom]) -> Optional[int]:
+        """Encode a set of atoms, or return None if some of them are not in
+        the universe."""
+        bits = 0
+        for atom in atoms:
+            atom_id = self._atom_to_id.get(atom)
+            if atom_id is None:
+                return None
+            bits |= 1 << atom_id
+        return bits
+
+    def decode(self, bits: int) -> Set[GroundAtom]:
+        """Decode a bitset back into a set of atoms."""
+        atoms = set()
+        while bits:
+            lowest_bit = bits & -bits
+            atoms.add(self._atoms[lowest_bit.bit_length() - 1])
+            bits ^= lowest_bit
+        return atoms
+
+    def predicates_mask(self, predicates: Collection[Predicate]) -> int:
+        """Get the bitset of all atoms in the universe whose predicate is in
+        the given collection."""
+        mask = 0
+        for pred in predicates:
+            mask |= self._predicate_to_mask.get(pred, 0)
+        return mask
+
+
+@dataclass(frozen=True)
+class BitsetGroundOperator:
+    """A ground operator compiled against an AtomBitsetEncoder.
+
+    The keep mask has every bit on except for the delete effects and the
+    atoms of ignored predicates, mirroring apply_operator().
+    """
+    op: GroundNSRTOrSTRIPSOperator
+    preconditions: int
+    add_effects: int
+    keep_mask: int
+
+    def is_applicable(self, bits: int) -> bool:
+        """Check whether the preconditions hold in the encoded atoms."""
+        return bits & self.preconditions == self.preconditions
+
+    def apply(self, bits: int) -> int:
+        """Get the encoded next atoms given encoded current atoms."""
+        return (bits & self.keep_mask) | self.add_effects
+
+
+class BitsetAbstractTask:
+    """A task planning problem compiled into bitset form.
+
+    Atoms are interned once per task, after which applicability checks
+    and successor generation are integer bit operations rather than
+    GroundAtom set operations.
+    """
+
+    def __init__(self, init_atoms: Collection[GroundAtom],
+                 goal: Collection[GroundAtom],
+                 ground_ops: Sequence[GroundNSRTOrSTRIPSOperator]) -> None:
+        # Every atom that can ever be true is either initially true or added
+        # by some operator, so this universe is closed under the operators.
+        universe = set(init_atoms) | set(goal)
+        for op in ground_ops:
+            universe |= op.preconditions | op.add_effects | op.delete_effects
+        self.encoder = AtomBitsetEncoder(universe)
+        self.init = self.encoder.encode(init_atoms)
+        self.goal = self.encoder.encode(goal)
+        # Preserve the order of the ground operators so that search is
+        # deterministic and consistent with get_applicable_operators().
+        self.operators: List[BitsetGroundOperator] = []
+        for op in ground_ops:
+            remove_mask = self.encoder.encode(op.delete_effects) | \
+                self.encoder.predicates_mask(op.ignore_effects)
+            self.operators.append(
+                BitsetGroundOperator(op,
+                                     self.encoder.encode(op.preconditions),
+                                     self.encoder.encode(op.add_effects),
+                                     ~remove_mask))
+
+    def goal_holds(self, bits: int) -> bool:
+        """Check whether the goal holds in the encoded atoms."""
+        return bits & self.goal == self.goal
+
+    def get_successors(
+        self, bits: int
+    ) -> Iterator[Tuple[GroundNSRTOrSTRIPSOperator, int]]:
+        """Iterate over (ground operator, encoded next atoms) for each
+        applicable ground operator."""
+        for op in self.operators:
+            if bits & op.preconditions == op.preconditions:
+                yield op.op, (bits & op.keep_mask) | op.add_effects
+
+
 def compute_necessary_atoms_seq(
         skeleton: List[_GroundNSRT], atoms_seq: List[Set[GroundAtom]],
         goal: Set[GroundAtom]) -> List[Set[GroundAtom]]:
@@ -3059,8 +3457,8 @@ def replace_nsrt_predicates(
         new_nsrts.append(new_nsrt)
     return new_nsrts
 
-# Note: create separate `heuristics.py` module if we need to add new
-#  heuristics in the future.
+# Note: the delete-relaxation heuristics are implemented natively in
+#  `heuristics.py`; the remaining pyperplan heuristics go through the glue below.
 
 
 def create_task_planning_heuristic(
@@ -3073,6 +3471,13 @@ def create_task_planning_heuristic(
 ) -> _TaskPlanningHeuristic:
     """Create a task planning heuristic that consumes ground atoms and
     estimates the cost-to-go."""
+    if heuristic_name in _heuristics.RELAXATION_HEURISTICS and not (
+            heuristic_name == "hff" and CFG.sesame_use_pyperplan_hff):
+        relaxed_task = _heuristics.RelaxedTask(init_atoms, goal, ground_ops)
+        return _RelaxationHeuristic(
+            heuristic_name, init_atoms, goal, ground_ops, relaxed_task,
+            _heuristics.RELAXATION_HEURISTICS[heuristic_name],
+            HeuristicCache(CFG.sesame_heuristic_cache_size))
     if heuristic_name in _PYPERPLAN_HEURISTICS:
         return _create_pyperplan_heuristic(heuristic_name, init_atoms, goal,
                                            ground_ops, predicates, objects)
@@ -3092,6 +3497,142 @@ class _TaskPlanningHeuristic:
     def __call__(self, atoms: Collection[GroundAtom]) -> float:
         raise NotImplementedError("Override me!")
 
+    def record_cache_stats(self, metrics: Metrics) -> None:
+        """Count the hits and misses of this heuristic's cache (if any) in
+        the given metrics from now on."""
+
+
+class HeuristicCache:
+    """A bounded LRU memo of heuristic values, owned by a single heuristic
+    (and so scoped to a single planning problem).
+
+    If metrics are given via record_cache_stats(), hits and misses are
+    counted there as num_heuristic_cache_hits and
+    num_heuristic_cache_misses.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._values: OrderedDict[Hashable, float] = OrderedDict()
+        self._metrics: Optional[Metrics] = None
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def record_cache_stats(self, metrics: Metrics) -> None:
+        """Count hits and misses in the given metrics from now on."""
+        self._metrics = metrics
+
+    def get_or_compute(self, key: Hashable,
+                       compute: Callable[[], float]) -> float:
+        """Look up the value for the key, computing and storing it on a
+        miss."""
+        value = self._values.get(key)
+        if value is not None:
+            self._values.move_to_end(key)
+            if self._metrics is not None:
+                self._metrics["num_heuristic_cache_hits"] += 1
+            return value
+        if self._metrics is not None:
+            self._metrics["num_heuristic_cache_misses"] += 1
+        value = compute()
+        if self._max_size > 0:
+            self._values[key] = value
+            if len(self._values) > self._max_size:
+                self._values.popitem(last=False)
+        return value
+
+
+class PlanningProfiler:
+    """Accumulates the wall time and the number of calls of planning phases.
+
+    The totals of a phase are stored in the given metrics as
+    profile_<phase>_time (in seconds, including nested phases) and
+    profile_<phase>_calls. If CFG.sesame_profile is False, phase() and
+    count() are no-ops.
+
+    The self time of every stack of nested phases is also accumulated for
+    the whole process, and can be appended to a file with dump_trace() in
+    the folded format read by flamegraph.pl.
+    """
+    _stack: ClassVar[List[str]] = []
+    _child_times: ClassVar[List[float]] = []
+    _folded_self_times: ClassVar[DefaultDict[str, float]] = defaultdict(float)
+
+    def __init__(self, metrics: Metrics) -> None:
+        self._metrics = metrics
+        self._enabled = CFG.sesame_profile
+
+    def phase(self, name: str) -> ContextManager[None]:
+        """Time the code run inside the returned context as the given
+        phase."""
+        if not self._enabled:
+            return contextlib.nullcontext()
+        return self._timed_phase(name)
+
+    def iterate(self, name: str, iterator: Iterator[_T]) -> Iterator[_T]:
+        """Iterate lazily over the given iterator, timing each step of the
+        iteration (but not the code run on its items) as the given
+        phase."""
+        if not self._enabled:
+            yield from iterator
+            return
+        while True:
+            with self._timed_phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str) -> None:
+        """Count one occurrence of an event that is not worth timing, like
+        a backtracking step, as profile_<name>_calls."""
+        if self._enabled:
+            self._metrics[f"profile_{name}_calls"] += 1
+
+    @contextlib.contextmanager
+    def _timed_phase(self, name: str) -> Iterator[None]:
+        stack, child_times = self._stack, self._child_times
+        stack.append(name)
+        child_times.append(0.0)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self._folded_self_times[";".join(stack)] += (elapsed -
+                                                         child_times.pop())
+            stack.pop()
+            if child_times:
+                child_times[-1] += elapsed
+            self._metrics[f"profile_{name}_time"] += elapsed
+            self._metrics[f"profile_{name}_calls"] += 1
+
+    @classmethod
+    def pop_folded_self_times(cls) -> Dict[str, float]:
+        """Get the self times (in seconds) of the stacks of phases recorded
+        so far, and forget them."""
+        folded_self_times = dict(cls._folded_self_times)
+        cls._folded_self_times.clear()
+        return folded_self_times
+
+    @classmethod
+    def add_folded_self_times(cls, folded_self_times: Dict[str,
+                                                           float]) -> None:
+        """Add self times from pop_folded_self_times() (e.g., in another
+        process) to those recorded so far."""
+        for folded_stack, self_time in folded_self_times.items():
+            cls._folded_self_times[folded_stack] += self_time
+
+    @classmethod
+    def dump_trace(cls, filepath: str) -> None:
+        """Append the self times (in microseconds) of the stacks of phases
+        recorded so far to the given file, and forget them."""
+        with open(filepath, "a", encoding="utf-8") as f:
+            for folded_stack, self_time in cls.pop_folded_self_times().items():
+                f.write(f"{folded_stack} {int(round(self_time * 1e6))}\n")
+
 
 class GoalCountHeuristic(_TaskPlanningHeuristic):
     """The number of goal atoms that are not in the current state."""
@@ -3101,6 +3642,23 @@ class GoalCountHeuristic(_TaskPlanningHeuristic):
         return len(self.goal.difference(atoms))
 
 
+@dataclass(frozen=True)
+class _RelaxationHeuristic(_TaskPlanningHeuristic):
+    """A delete-relaxation heuristic (hadd, hmax, hff, or lmcut) evaluated on
+    the task compiled to integer fact ids."""
+    _relaxed_task: _heuristics.RelaxedTask
+    _heuristic_fn: Callable[[_heuristics.RelaxedTask, Sequence[int]], float]
+    _cache: HeuristicCache
+
+    def __call__(self, atoms: Collection[GroundAtom]) -> float:
+        fact_ids = self._relaxed_task.encode(atoms)
+        return self._cache.get_or_compute(
+            fact_ids, lambda: self._heuristic_fn(self._relaxed_task, fact_ids))
+
+    def record_cache_stats(self, metrics: Metrics) -> None:
+        self._cache.record_cache_stats(metrics)
+
+
 ############################### Pyperplan Glue ###############################
 
 
@@ -3121,9 +3679,10 @@ def _create_pyperplan_heuristic(
                                             predicates, objects, static_atoms)
     pyperplan_heuristic = pyperplan_heuristic_cls(pyperplan_task)
     pyperplan_goal = _atoms_to_pyperplan_facts(goal - static_atoms)
-    return _PyperplanHeuristicWrapper(heuristic_name, init_atoms, goal,
-                                      ground_ops, static_atoms,
-                                      pyperplan_heuristic, pyperplan_goal)
+    return _PyperplanHeuristicWrapper(
+        heuristic_name, init_atoms, goal, ground_ops, static_atoms,
+        pyperplan_heuristic, pyperplan_goal,
+        HeuristicCache(CFG.sesame_heuristic_cache_size))
 
 
 _PyperplanFacts = FrozenSet[str]
@@ -3160,22 +3719,22 @@ class _PyperplanHeuristicWrapper(_TaskPlanningHeuristic):
     _static_atoms: Set[GroundAtom]
     _pyperplan_heuristic: _PyperplanBaseHeuristic
     _pyperplan_goal: _PyperplanFacts
+    _cache: HeuristicCache
 
     def __call__(self, atoms: Collection[GroundAtom]) -> float:
         # Note: filtering out static atoms.
         pyperplan_facts = _atoms_to_pyperplan_facts(set(atoms) \
                                                     - self._static_atoms)
-        return self._evaluate(pyperplan_facts, self._pyperplan_goal,
-                              self._pyperplan_heuristic)
+        return self._cache.get_or_compute(
+            pyperplan_facts, lambda: self._evaluate(pyperplan_facts))
 
-    @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def _evaluate(pyperplan_facts: _PyperplanFacts,
-                  pyperplan_goal: _PyperplanFacts,
-                  pyperplan_heuristic: _PyperplanBaseHeuristic) -> float:
-        pyperplan_node = _PyperplanNode(pyperplan_facts, pyperplan_goal)
+    def record_cache_stats(self, metrics: Metrics) -> None:
+        self._cache.record_cache_stats(metrics)
+
+    def _evaluate(self, pyperplan_facts: _PyperplanFacts) -> float:
+        pyperplan_node = _PyperplanNode(pyperplan_facts, self._pyperplan_goal)
         logging.disable(logging.DEBUG)
-        result = pyperplan_heuristic(pyperplan_node)
+        result = self._pyperplan_heuristic(pyperplan_node)
         logging.disable(logging.NOTSET)
         return result
 